@@ -7,12 +7,15 @@ import sqlalchemy as sa
 from fastapi import Depends, HTTPException, Path, Query, status
 from fastapi.responses import Response
 from fastapi.routing import APIRouter
+from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload, selectinload
 
 from app import deps, models, schemas
 from app.clone.controller import Controller
 from app.clone.db import CreatorCloneDB
+from app.clone.ingestion import IngestionQueue
+from app.clone.preamble import preamble_cache
 from app.clone.shared import DynamicTextSplitter
 from app.embedding import EmbeddingClient
 from clonr.data_structures import Document, Monologue
@@ -260,6 +263,8 @@ async def patch_clone(
 
     db.add(clone)
     await db.commit()
+    # the changed fields already key these out, this just frees them up
+    preamble_cache.invalidate(clone.id)
     await db.refresh(clone)
     return clone
 
@@ -362,6 +367,58 @@ async def create_document(
     return doc_model
 
 
+@router.post(
+    "/{clone_id}/documents/jobs",
+    response_model=schemas.DocumentJob,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def create_document_job(
+    doc_create: schemas.DocumentJobCreate,
+    clone_id: Annotated[uuid.UUID, Path()],
+    user: Annotated[models.User, Depends(deps.get_current_active_user)],
+    clonedb: Annotated[CreatorCloneDB, Depends(deps.get_creator_clonedb)],
+    conn: Annotated[Redis, Depends(deps.get_async_redis)],
+):
+    """Queues the document for the ingestion worker instead of building its index
+    inside the request. Poll the returned job for progress."""
+    doc = Document(**doc_create.model_dump(exclude_unset=True))
+    if await clonedb.db.scalar(
+        sa.select(models.Document.id)
+        .where(
+            sa.or_(models.Document.name == doc.name, models.Document.hash == doc.hash)
+        )
+        .where(models.Document.clone_id == clone_id)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Document with name {doc.name} or the same content already exists.",
+        )
+    job = schemas.DocumentJob(
+        id=uuid.uuid4(),
+        clone_id=clone_id,
+        user_id=user.id,
+        document_id=doc.id,
+        index_type=doc_create.index_type,
+    )
+    await IngestionQueue(conn=conn).enqueue(job=job, doc=doc)
+    return job
+
+
+@router.get("/{clone_id}/documents/jobs/{job_id}", response_model=schemas.DocumentJob)
+async def get_document_job(
+    clone_id: Annotated[uuid.UUID, Path()],
+    job_id: Annotated[uuid.UUID, Path()],
+    clonedb: Annotated[CreatorCloneDB, Depends(deps.get_creator_clonedb)],
+    conn: Annotated[Redis, Depends(deps.get_async_redis)],
+):
+    job = await IngestionQueue(conn=conn).get_job(job_id)
+    if job is None or job.clone_id != clone_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Job does not exist."
+        )
+    return job
+
+
 @router.get("/{clone_id}/documents", response_model=list[schemas.Document])
 async def get_documents(
     clonedb: Annotated[CreatorCloneDB, Depends(deps.get_creator_clonedb)],
@@ -7,7 +7,7 @@ from typing import Annotated
 import sqlalchemy as sa
 from fastapi import Depends, HTTPException, Path, Query, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.routing import APIRouter
 from loguru import logger
 from redis.asyncio import Redis
@@ -15,6 +15,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
 from app import deps, models, schemas
+from app.clone.cache import CloneCache
 from app.clone.controller import Controller
 from app.clone.types import AdaptationStrategy, InformationStrategy, MemoryStrategy
 from app.deps.limiter import user_id_cookie_fixed_window_ratelimiter
@@ -498,6 +499,33 @@ async def receive_message(
     return msg
 
 
+def _check_revision_allowed(controller: Controller, msg_gen: schemas.MessageGenerate):
+    if (
+        msg_gen.is_revision
+        and controller.conversation.memory_strategy != MemoryStrategy.zero
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Message regeneration is not allowed for anything but the Zero Memory Strategy",
+        )
+
+
+async def _count_free_message(controller: Controller):
+    if controller.subscription_plan == schemas.Plan.free:
+        if controller.user.num_free_messages_sent >= FREE_MESSAGE_LIMIT:
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail=(
+                    f"Free users are limited to {FREE_MESSAGE_LIMIT} messages per month. "
+                    "Please upgrade to a paying plan for more messages."
+                ),
+            )
+        controller.user.num_free_messages_sent = (
+            controller.user.num_free_messages_sent + 1
+        )
+        await controller.clonedb.db.commit()
+
+
 @router.post(
     "/{conversation_id}/generate",
     response_model=schemas.Message,
@@ -514,14 +542,7 @@ async def generate_clone_message(
     conversation_id: Annotated[uuid.UUID, Path()],
     controller: Annotated[Controller, Depends(deps.get_controller)],
 ):
-    if (
-        msg_gen.is_revision
-        and controller.conversation.memory_strategy != MemoryStrategy.zero
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Message regeneration is not allowed for anything but the Zero Memory Strategy",
-        )
+    _check_revision_allowed(controller, msg_gen)
     key = f"{conversation_id}::generating"
     if (await controller.clonedb.cache.conn.get(key)) is not None:
         raise HTTPException(
@@ -533,19 +554,7 @@ async def generate_clone_message(
         )
     await controller.clonedb.cache.conn.set(key, b"", ex=60)
     try:
-        if controller.subscription_plan == schemas.Plan.free:
-            if controller.user.num_free_messages_sent >= FREE_MESSAGE_LIMIT:
-                raise HTTPException(
-                    status_code=status.HTTP_402_PAYMENT_REQUIRED,
-                    detail=(
-                        f"Free users are limited to {FREE_MESSAGE_LIMIT} messages per month. "
-                        "Please upgrade to a paying plan for more messages."
-                    ),
-                )
-            controller.user.num_free_messages_sent = (
-                controller.user.num_free_messages_sent + 1
-            )
-            await controller.clonedb.db.commit()
+        await _count_free_message(controller)
         msg = await controller.generate_message(msg_gen)
 
     finally:
@@ -553,6 +562,74 @@ async def generate_clone_message(
     return msg
 
 
+def _sse_event(event: str, data: str) -> str:
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return f"event: {event}\n{lines}\n"
+
+
+@router.post(
+    "/{conversation_id}/generate/stream",
+    response_class=StreamingResponse,
+    status_code=200,
+    dependencies=[
+        Depends(user_id_cookie_fixed_window_ratelimiter("3000/month")),
+        Depends(
+            user_id_cookie_fixed_window_ratelimiter("300/day"),
+        ),
+    ],
+)
+async def generate_clone_message_stream(
+    msg_gen: schemas.MessageGenerate,
+    conversation_id: Annotated[uuid.UUID, Path()],
+    controller: Annotated[Controller, Depends(deps.get_controller)],
+):
+    """Same as /generate, but streams the response back as server-sent events.
+    Each `token` event carries a chunk of content as it is generated, and the final
+    `message` event carries the saved message (with timestamps etc. cleaned up).
+    Errors after the stream has started are sent as an `error` event.
+    """
+    _check_revision_allowed(controller, msg_gen)
+    key = f"{conversation_id}::generating"
+    if (await controller.clonedb.cache.conn.get(key)) is not None:
+        raise HTTPException(
+            status_code=status.HTTP_423_LOCKED,
+            detail=(
+                "Cannot send a generate while the clone is receiving a response. "
+                "Please wait until current message has been received."
+            ),
+        )
+    await controller.clonedb.cache.conn.set(key, b"", ex=60)
+    try:
+        await _count_free_message(controller)
+        stream = await controller.generate_message_stream(msg_gen)
+    except BaseException:
+        await controller.clonedb.cache.conn.delete(key)
+        raise
+
+    async def events():
+        try:
+            async for x in stream:
+                if isinstance(x, str):
+                    yield _sse_event("token", json.dumps(dict(content=x)))
+                else:
+                    msg = schemas.Message.model_validate(x)
+                    yield _sse_event("message", msg.model_dump_json())
+        except Exception as e:
+            logger.exception(e)
+            detail = (
+                e.detail if isinstance(e, HTTPException) else "Internal server error"
+            )
+            yield _sse_event("error", json.dumps(dict(detail=detail)))
+        finally:
+            await controller.clonedb.cache.conn.delete(key)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get(
     "/{conversation_id}/current_revisions", response_model=list[schemas.Message]
 )
@@ -581,6 +658,7 @@ async def delete_message(
     message_id: Annotated[uuid.UUID, Path()],
     conversation_id: Annotated[uuid.UUID, Path()],
     db: Annotated[AsyncSession, Depends(deps.get_async_session)],
+    conn: Annotated[Redis, Depends(deps.get_async_redis)],
     user: Annotated[models.User, Depends(deps.get_current_active_user)],
 ):
     msg = await db.get(models.Message, message_id)
@@ -617,6 +695,7 @@ async def delete_message(
     for m in r.all():
         m.is_active = False
     await db.commit()
+    await CloneCache(conn=conn).invalidate_messages(conversation_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
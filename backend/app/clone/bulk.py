@@ -0,0 +1,59 @@
+"""Bulk writes that skip the ORM. Rows go straight to asyncpg with COPY on the
+session's own connection, so they share its transaction. Nothing ends up in the
+session; select the rows back if you need the models.
+"""
+from typing import Any, Iterable
+
+import asyncpg
+import sqlalchemy as sa
+from opentelemetry import trace
+from pgvector.sqlalchemy import Vector
+from pgvector.utils import from_db_binary, to_db_binary
+from sqlalchemy.ext.asyncio import AsyncSession
+
+tracer = trace.get_tracer(__name__)
+
+
+async def _driver_connection(db: AsyncSession) -> asyncpg.Connection:
+    conn = await db.connection()
+    raw = await conn.get_raw_connection()
+    driver_conn: asyncpg.Connection = raw.driver_connection  # type: ignore
+    if not driver_conn.is_in_transaction():
+        # the asyncpg adapter only opens its transaction on the first statement,
+        # and the COPY has to be inside it to commit or roll back with the session
+        await conn.execute(sa.text("SELECT 1"))
+    return driver_conn
+
+
+def _has_vector_column(table: sa.Table, columns: Iterable[str]) -> bool:
+    return any(isinstance(table.c[c].type, Vector) for c in columns)
+
+
+async def copy_rows(
+    db: AsyncSession, table: sa.Table, rows: list[dict[str, Any]]
+) -> int:
+    """COPYs `rows` (dicts keyed by column name, all with the same keys) into
+    `table`. Columns left out get their server defaults. Returns the row count."""
+    if not rows:
+        return 0
+    columns = list(rows[0])
+    records = [tuple(row[c] for c in columns) for row in rows]
+    with tracer.start_as_current_span(f"copy_rows_{table.name}"):
+        driver_conn = await _driver_connection(db)
+        if not _has_vector_column(table, columns):
+            await driver_conn.copy_records_to_table(
+                table.name, records=records, columns=columns
+            )
+            return len(records)
+        # COPY is always binary in asyncpg, but SQLAlchemy binds vectors as text
+        # literals. Swap the binary codec in for just this statement.
+        await driver_conn.set_type_codec(
+            "vector", encoder=to_db_binary, decoder=from_db_binary, format="binary"
+        )
+        try:
+            await driver_conn.copy_records_to_table(
+                table.name, records=records, columns=columns
+            )
+        finally:
+            await driver_conn.reset_type_codec("vector")
+    return len(records)
@@ -1,10 +1,54 @@
+import datetime
 import json
 import uuid
+from typing import Any, TypeVar
 
+import sqlalchemy as sa
 from fastapi.encoders import jsonable_encoder
+from opentelemetry import metrics
 from redis.asyncio import Redis
 
 from app import models
+from app.settings import settings
+
+meter = metrics.get_meter(settings.BACKEND_APP_NAME)
+
+conversation_cache_hit_meter = meter.create_counter(
+    name="conversation_cache_hits",
+    description="Reads of conversation hot state served from redis, by kind",
+)
+conversation_cache_miss_meter = meter.create_counter(
+    name="conversation_cache_misses",
+    description="Reads of conversation hot state that had to go to postgres, by kind",
+)
+
+M = TypeVar("M", models.Message, models.AgentSummary, models.EntityContextSummary)
+
+# cached summaries can also record that there isn't one yet
+_NONE = b"null"
+
+
+def _dump_model(obj: Any) -> bytes:
+    # embeddings are big and nothing reads them off of cached rows
+    data = {
+        c.key: getattr(obj, c.key)
+        for c in sa.inspect(type(obj)).column_attrs
+        if c.key != "embedding"
+    }
+    return json.dumps(jsonable_encoder(data)).encode()
+
+
+def _load_model(model: type[M], raw: bytes) -> M:
+    data = json.loads(raw)
+    for c in sa.inspect(model).column_attrs:
+        if (v := data.get(c.key)) is None:
+            continue
+        python_type = c.columns[0].type.python_type
+        if python_type is datetime.datetime:
+            data[c.key] = datetime.datetime.fromisoformat(v)
+        elif python_type is uuid.UUID:
+            data[c.key] = uuid.UUID(v)
+    return model(**data)
 
 
 class CacheCounter:
@@ -60,6 +104,108 @@ class CloneCache:
             key=f"{self._conversation_key(conversation_id)}::entity_context_counter",
         )
 
+    def _recent_messages_key(self, conversation_id: str | uuid.UUID) -> str:
+        return f"{self._conversation_key(conversation_id)}::recent_messages"
+
+    def _agent_summary_key(self, conversation_id: str | uuid.UUID) -> str:
+        return f"{self._conversation_key(conversation_id)}::agent_summary"
+
+    def _entity_context_summary_key(
+        self, conversation_id: str | uuid.UUID, entity_name: str
+    ) -> str:
+        k = self._conversation_key(conversation_id)
+        return f"{k}::entity_context_summary::{entity_name}"
+
+    async def get_recent_messages(
+        self, conversation_id: str | uuid.UUID
+    ) -> list[models.Message] | None:
+        """The last `CONVERSATION_CACHE_NUM_MESSAGES` main branch messages, newest first,
+        or None if they aren't cached. The messages are detached copies without
+        embeddings, so they can be read but not modified through the session."""
+        r = await self.conn.lrange(self._recent_messages_key(conversation_id), 0, -1)
+        attributes = dict(kind="messages")
+        if not r:
+            conversation_cache_miss_meter.add(amount=1, attributes=attributes)
+            return None
+        conversation_cache_hit_meter.add(amount=1, attributes=attributes)
+        return [_load_model(models.Message, x) for x in r]
+
+    async def set_recent_messages(
+        self, conversation_id: str | uuid.UUID, messages: list[models.Message]
+    ):
+        key = self._recent_messages_key(conversation_id)
+        messages = messages[: settings.CONVERSATION_CACHE_NUM_MESSAGES]
+        async with self.conn.pipeline(transaction=True) as p:
+            p.delete(key)
+            if messages:
+                p.rpush(key, *[_dump_model(m) for m in messages])
+                p.expire(key, settings.CONVERSATION_CACHE_TTL_SECONDS)
+            await p.execute()
+
+    async def push_message(
+        self,
+        conversation_id: str | uuid.UUID,
+        message: models.Message,
+        replaces_last: bool = False,
+    ):
+        """Write-through for a new main branch message. Does nothing if the window
+        isn't cached, it gets filled from postgres on the next read instead. With
+        `replaces_last`, the newest message is swapped out (i.e. a new revision)."""
+        key = self._recent_messages_key(conversation_id)
+        async with self.conn.pipeline(transaction=True) as p:
+            if replaces_last:
+                p.lpop(key)
+            p.lpushx(key, _dump_model(message))
+            p.ltrim(key, 0, settings.CONVERSATION_CACHE_NUM_MESSAGES - 1)
+            await p.execute()
+
+    async def invalidate_messages(self, conversation_id: str | uuid.UUID):
+        await self.conn.delete(self._recent_messages_key(conversation_id))
+
+    async def _get_summary(self, key: str, model: type[M], kind: str) -> list[M] | None:
+        r = await self.conn.get(key)
+        attributes = dict(kind=kind)
+        if r is None:
+            conversation_cache_miss_meter.add(amount=1, attributes=attributes)
+            return None
+        conversation_cache_hit_meter.add(amount=1, attributes=attributes)
+        return [] if r == _NONE else [_load_model(model, r)]
+
+    async def _set_summary(self, key: str, summary: Any | None):
+        value = _NONE if summary is None else _dump_model(summary)
+        await self.conn.set(key, value, ex=settings.CONVERSATION_CACHE_TTL_SECONDS)
+
+    async def get_agent_summary(
+        self, conversation_id: str | uuid.UUID
+    ) -> list[models.AgentSummary] | None:
+        """The latest agent summary as a list of at most one, or None if it isn't
+        cached. An empty list means the conversation doesn't have one yet."""
+        key = self._agent_summary_key(conversation_id)
+        return await self._get_summary(key, models.AgentSummary, kind="agent_summary")
+
+    async def set_agent_summary(
+        self, conversation_id: str | uuid.UUID, summary: models.AgentSummary | None
+    ):
+        await self._set_summary(self._agent_summary_key(conversation_id), summary)
+
+    async def get_entity_context_summary(
+        self, conversation_id: str | uuid.UUID, entity_name: str
+    ) -> list[models.EntityContextSummary] | None:
+        """Same as get_agent_summary, for the latest summary about `entity_name`."""
+        key = self._entity_context_summary_key(conversation_id, entity_name)
+        return await self._get_summary(
+            key, models.EntityContextSummary, kind="entity_context_summary"
+        )
+
+    async def set_entity_context_summary(
+        self,
+        conversation_id: str | uuid.UUID,
+        entity_name: str,
+        summary: models.EntityContextSummary | None,
+    ):
+        key = self._entity_context_summary_key(conversation_id, entity_name)
+        await self._set_summary(key, summary)
+
     async def increment_all_counters(
         self, conversation_ids: list[uuid.UUID], importance: int
     ):
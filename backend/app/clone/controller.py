@@ -1,7 +1,11 @@
 # TODO (Jonny): add opentelemetry metrics. consider doing this at a high level here or a lower level, i.e.
 # making an LLM callback for the llm calls, and adding in the metrics for performance of queries in clonedb
+import asyncio
 import re
+import time
 import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Generic, TypeVar
 
 import sqlalchemy as sa
 from fastapi import BackgroundTasks, HTTPException, status
@@ -22,8 +26,15 @@ from clonr.tokenizer import Tokenizer
 
 # TODO (Jonny): protect the route?
 # from app.external.moderation import openai_moderation_check
+from . import retrieval
 from .cache import CloneCache
 from .db import CloneDB, CreatorCloneDB
+from .preamble import (
+    PREAMBLE_SEAM_TOKENS,
+    compile_preamble,
+    long_term_memory_preamble,
+    zero_memory_preamble,
+)
 from .types import (
     AdaptationStrategy,
     GenAgentsSearchParams,
@@ -40,6 +51,16 @@ special_subroutine_meter = meter.create_up_down_counter(
     name="controller_current_special_subroutines",
     description="Which control branches of controller are curently executing, such as memory addition, reflections, entity context summarization and agent summarization",
 )
+ttft_meter = meter.create_histogram(
+    name="generate_time_to_first_token_seconds",
+    description="Time from a streamed message generation request until the first token is sent, including retrieval",
+    unit="s",
+)
+retrieval_stage_duration_meter = meter.create_histogram(
+    name="retrieval_stage_duration_seconds",
+    description="Time spent in each concurrent retrieval stage of message generation",
+    unit="s",
+)
 
 # the Gen Agents paper uses a threshold of 150 (that's what he said during the talk)
 # min memory importance is 1 and max is 10, so a score of 100 ~ 20 memories on avg.
@@ -86,6 +107,65 @@ class UnsupportedStrategy(Exception):
     pass
 
 
+R = TypeVar("R")
+
+
+@dataclass
+class RetrievalStage(Generic[R]):
+    """An independent retrieval step of message generation. If it doesn't finish
+    within `timeout` seconds, generation goes ahead with `default` instead."""
+
+    name: str
+    run: Callable[[CloneDB], Awaitable[R]]
+    timeout: float
+    default: R
+
+
+async def _run_retrieval_stage(clonedb: CloneDB, stage: RetrievalStage[R]) -> R:
+    with tracer.start_as_current_span(f"retrieval_stage_{stage.name}") as span:
+        outcome = "ok"
+        start = time.perf_counter()
+        try:
+            async with clonedb.fork() as stage_db:
+                return await asyncio.wait_for(
+                    stage.run(stage_db), timeout=stage.timeout
+                )
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning(
+                f"Retrieval stage {stage.name} timed out after {stage.timeout}s, "
+                "continuing without it."
+            )
+            return stage.default
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            span.set_attribute("duration_seconds", duration)
+            span.set_attribute("outcome", outcome)
+            retrieval_stage_duration_meter.record(
+                amount=duration, attributes=dict(stage=stage.name, outcome=outcome)
+            )
+
+
+async def run_retrieval_stages(
+    clonedb: CloneDB, stages: list[RetrievalStage]
+) -> list[Any]:
+    """Runs the stages concurrently, each on its own short-lived session, so that
+    retrieval takes as long as the slowest stage rather than the sum of them."""
+    return await asyncio.gather(*[_run_retrieval_stage(clonedb, x) for x in stages])
+
+
+@dataclass
+class PreparedMessage:
+    """Everything needed to generate and then save the next clone message."""
+
+    generate_kwargs: dict[str, Any]
+    parent_id: uuid.UUID | None
+    msg_to_unset: models.Message | None
+
+
 class Controller:
     def __init__(
         self,
@@ -314,6 +394,7 @@ class Controller:
         memory = await CloneDB.add_public_memories(
             db=db,
             embedding_client=embedding_client,
+            tokenizer=tokenizer,
             clone_id=clone.id,
             memories=[memory_struct],
         )[0]
@@ -362,10 +443,10 @@ class Controller:
             num_tokens -= 60
             params = GenAgentsSearchParams(max_items=max_items, max_tokens=num_tokens)
 
-            for q in queries:
-                cur = await self.clonedb.query_memories(
-                    query=q, params=params, update_access_date=True
-                )
+            results = await self.clonedb.query_memories_many(
+                queries=queries, params=params, update_access_date=True
+            )
+            for cur in results:
                 retrieved_memories.extend([c.model for c in cur])
             retrieved_memories.sort(key=lambda x: x.timestamp)
 
@@ -427,11 +508,11 @@ class Controller:
             max_tokens = self.llm.context_length - 190 - 512 - 512
             max_tokens = int(max_tokens // max(1, len(queries)))
             params = GenAgentsSearchParams(max_items=12, max_tokens=max_tokens)
-            for q in queries:
-                # TODO (Jonny): should we update access date for this?
-                cur = await self.clonedb.query_memories(
-                    query=q, params=params, update_access_date=True
-                )
+            # TODO (Jonny): should we update access date for this?
+            results = await self.clonedb.query_memories_many(
+                queries=queries, params=params, update_access_date=True
+            )
+            for cur in results:
                 retrieved_memories.extend([c.model for c in cur])
             retrieved_memories.sort(key=lambda x: x.timestamp)
 
@@ -518,11 +599,11 @@ class Controller:
             max_tokens = self.llm.context_length - 150 - 512 - 512
             max_tokens = int(max_tokens // max(1, len(queries)))
             params = GenAgentsSearchParams(max_items=12, max_tokens=max_tokens)
-            for q in queries:
-                # TODO (Jonny): should we update access date for this?
-                cur = await self.clonedb.query_memories(
-                    query=q, params=params, update_access_date=True
-                )
+            # TODO (Jonny): should we update access date for this?
+            results = await self.clonedb.query_memories_many(
+                queries=queries, params=params, update_access_date=True
+            )
+            for cur in results:
                 statements.extend([c.model for c in cur])
             statements.sort(key=lambda x: x.timestamp)
 
@@ -606,6 +687,9 @@ class Controller:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
         await self.clonedb.db.commit()
         await self.clonedb.db.refresh(msg)
+        await self.clonedb.cache.push_message(
+            self.conversation.id, msg, replaces_last=True
+        )
         return msg
 
     @tracer.start_as_current_span("generate_message_queries")
@@ -661,8 +745,9 @@ class Controller:
         # pull at most 2 messages
         token_budget = 128
         last_msgs: list[str] = []
-        for m in recent_msgs[:2]:
-            token_budget -= self.clonedb.tokenizer.length(m.content) + 4
+        lengths = retrieval.num_tokens_batch(recent_msgs[:2], self.clonedb.tokenizer)
+        for m, length in zip(recent_msgs[:2], lengths):
+            token_budget -= length + 4
             if token_budget < 0:
                 break
             last_msgs.append(m.content)
@@ -677,10 +762,10 @@ class Controller:
         logger.info(f"Conversation ({self.conversation.id}) message queries: {queries}")
         return queries
 
-    @tracer.start_as_current_span("generate_zero_memory_message")
-    async def _generate_zero_memory_message(
+    @tracer.start_as_current_span("prepare_zero_memory_message")
+    async def _prepare_zero_memory_message(
         self, msg_gen: schemas.MessageGenerate
-    ) -> models.Message:
+    ) -> PreparedMessage:
         msg_to_unset: models.Message | None = None
         if msg_gen.is_revision:
             last_messages: list[models.Message] = await self.clonedb.get_messages(
@@ -727,10 +812,14 @@ class Controller:
             retrieved_nodes: list[models.Node] = []
             max_fact_tokens = get_num_fact_tokens(extra_space=True) + 50
             search_params = VectorSearchParams(max_items=3, max_tokens=max_fact_tokens)
-            for q in queries:
-                # empirically, plain vector search seems to do better
-                cur = await self.clonedb.query_nodes(query=q, params=search_params)
+            # empirically, plain vector search seems to do better
+            results = await self.clonedb.query_nodes_many(
+                queries=queries, params=search_params
+            )
+            for cur in results:
                 retrieved_nodes.extend([x.model for x in cur])
+            # queries often overlap, drop repeated nodes before collapsing overlaps
+            retrieved_nodes = list({x.id: x for x in retrieved_nodes}.values())
             # the sort op is important, the tuple is unique across all nodes, so it
             # ensures that identical nodes will be adjacent.
             retrieved_nodes.sort(key=lambda x: (x.document_id, x.depth, x.index))
@@ -755,20 +844,17 @@ class Controller:
             # ]
             facts = None
 
-        cur_prompt = templates.ZeroMemoryMessageV2.render(
-            char=self.clone.name,
-            user=self.user_name,
-            short_description=self.clone.short_description,
-            long_description=self.clone.long_description,
-            llm=self.llm,
-            messages=[],
-            scenario=self.clone.scenario,
-            example_dialogues=self.clone.fixed_dialogues,
-            sys_prompt_header=self.clone.sys_prompt_header,
-            facts=facts,
+        # the static parts of the prompt are rendered and counted once per clone edit,
+        # so only the retrieved facts need tokenizing here
+        compiled = zero_memory_preamble(
+            clone=self.clone, user_name=self.user_name, llm=self.llm
+        )
+        context = templates.ZeroMemoryMessageV2.render_context(
+            char=self.clone.name, facts=facts
         )
         tokens_remaining = self.llm.context_length
-        tokens_remaining -= self.llm.num_tokens(cur_prompt)
+        tokens_remaining -= compiled.num_tokens + PREAMBLE_SEAM_TOKENS
+        tokens_remaining -= self.llm.num_tokens(context)
         if (
             max_tokens := generate.Params.generate_zero_memory_message.max_tokens
         ) is None:
@@ -788,7 +874,7 @@ class Controller:
 
         # TODO (Jonny): it's possible that this thing spans multiple lines
         # so we need to return multiple messages
-        content = await generate.generate_zero_memory_message(
+        generate_kwargs = dict(
             char=self.clone.name,
             user_name=self.user_name,
             short_description=self.clone.short_description,
@@ -799,23 +885,92 @@ class Controller:
             sys_prompt_header=self.clone.sys_prompt_header,
             facts=facts,
             llm=self.llm,
+            preamble=compiled.preamble,
             # TODO (Jonny): Figure out the use_timestamps logic here
         )
-        # content = remove_timestamps_from_msg(new_msg_content)
-        new_msg_struct = Message(
-            content=content,
-            sender_name=self.clone.name,
-            is_clone=True,
+        return PreparedMessage(
+            generate_kwargs=generate_kwargs,
             parent_id=parent_id,
+            msg_to_unset=msg_to_unset,
         )
-        new_msg = await self.clonedb.add_message(new_msg_struct, msg_to_unset)
 
-        return new_msg
-
-    @tracer.start_as_current_span("generate_long_term_memory_message")
-    async def _generate_long_term_memory_message(
+    @tracer.start_as_current_span("generate_zero_memory_message")
+    async def _generate_zero_memory_message(
         self, msg_gen: schemas.MessageGenerate
     ) -> models.Message:
+        prepared = await self._prepare_zero_memory_message(msg_gen=msg_gen)
+        content = await generate.generate_zero_memory_message(
+            **prepared.generate_kwargs
+        )
+        return await self._save_generated_message(content=content, prepared=prepared)
+
+    async def _retrieve_monologues(
+        self, clonedb: CloneDB, query: str, max_tokens: int
+    ) -> list[Monologue]:
+        # Retrieve relevant monologues (max 300 tokens)
+        results = await clonedb.query_monologues_with_rerank(
+            query=query,
+            params=ReRankSearchParams(max_items=10, max_tokens=max_tokens),
+        )
+        return [
+            Monologue(
+                id=m.model.id,
+                content=m.model.content,
+                source=m.model.source,
+                hash=m.model.hash,
+            )
+            for m in results
+        ]
+
+    async def _retrieve_facts(
+        self, clonedb: CloneDB, queries: list[str], max_tokens: int
+    ) -> list[str] | None:
+        # Retrieve relevant facts (max 450 tokens)
+        if self.information_strategy not in [
+            InformationStrategy.internal,
+            InformationStrategy.external,
+        ]:
+            return None
+        retrieved_nodes: list[models.Node] = []
+        search_params = VectorSearchParams(max_items=3, max_tokens=max_tokens)
+        results = await clonedb.query_nodes_many(queries=queries, params=search_params)
+        for cur in results:
+            retrieved_nodes.extend([x.model for x in cur])
+        # queries often overlap, drop repeated nodes before collapsing overlaps
+        retrieved_nodes = list({x.id: x for x in retrieved_nodes}.values())
+        retrieved_nodes.sort(key=lambda x: (x.document_id, x.depth, x.index))
+        facts = [x.content for x in retrieved_nodes]
+        return remove_overlaps_in_list_of_strings(facts)
+
+    async def _retrieve_memories(
+        self, clonedb: CloneDB, queries: list[str], max_tokens: int
+    ) -> list[Memory]:
+        # Retrieve relevant memories (max 512 tokens)
+        memories: list[Memory] = []
+        vis_mem: set[uuid.UUID] = set()
+        results = await clonedb.query_memories_many(
+            queries=queries,
+            params=GenAgentsSearchParams(max_tokens=max_tokens, max_items=3),
+            update_access_date=False,
+        )
+        for cur in results:
+            for c in cur:
+                if c.model.id not in vis_mem:
+                    vis_mem.add(c.model.id)
+                    mem = Memory(
+                        id=c.model.id,
+                        content=c.model.content,
+                        timestamp=c.model.timestamp,
+                        importance=c.model.importance,
+                        is_shared=c.model.is_shared,
+                    )
+                    memories.append(mem)
+        return memories
+
+    @tracer.start_as_current_span("prepare_long_term_memory_message")
+    async def _prepare_long_term_memory_message(
+        self, msg_gen: schemas.MessageGenerate
+    ) -> PreparedMessage:
         msg_to_unset: models.Message | None = None
         if msg_gen.is_revision:
             _tmp_last_msgs = await self.clonedb.get_messages(num_messages=1)
@@ -887,74 +1042,70 @@ class Controller:
         fact_tokens = get_num_fact_tokens(extra_space)
         memory_tokens = get_num_memory_tokens(extra_space)
 
-        # Retrieve relevant monologues (max 300 tokens)
-        results = await self.clonedb.query_monologues_with_rerank(
-            query=mashed_query,
-            params=ReRankSearchParams(max_items=10, max_tokens=monologue_tokens),
+        # monologues, facts and memories don't depend on each other, so fetch them
+        # all at once. A stage that runs past its deadline is left out of the prompt.
+        monologues, facts, memories = await run_retrieval_stages(
+            self.clonedb,
+            [
+                RetrievalStage(
+                    name="monologues",
+                    run=lambda db: self._retrieve_monologues(
+                        db, query=mashed_query, max_tokens=monologue_tokens
+                    ),
+                    timeout=settings.RETRIEVAL_MONOLOGUES_TIMEOUT_SECONDS,
+                    default=[],
+                ),
+                RetrievalStage(
+                    name="facts",
+                    run=lambda db: self._retrieve_facts(
+                        db, queries=queries, max_tokens=fact_tokens
+                    ),
+                    timeout=settings.RETRIEVAL_FACTS_TIMEOUT_SECONDS,
+                    default=None,
+                ),
+                RetrievalStage(
+                    name="memories",
+                    run=lambda db: self._retrieve_memories(
+                        db, queries=queries, max_tokens=memory_tokens
+                    ),
+                    timeout=settings.RETRIEVAL_MEMORIES_TIMEOUT_SECONDS,
+                    default=[],
+                ),
+            ],
         )
-        monologues = [
-            Monologue(
-                id=m.model.id,
-                content=m.model.content,
-                source=m.model.source,
-                hash=m.model.hash,
-            )
-            for m in results
-        ]
 
-        # Retrieve relevant facts (max 450 tokens)
-        facts: list[str] | None = None
-        if self.information_strategy in [
-            InformationStrategy.internal,
-            InformationStrategy.external,
-        ]:
-            retrieved_nodes: list[models.Node] = []
-            search_params = VectorSearchParams(max_items=3, max_tokens=fact_tokens)
-            for q in queries:
-                cur = await self.clonedb.query_nodes(query=q, params=search_params)
-                retrieved_nodes.extend([x.model for x in cur])
-            retrieved_nodes.sort(key=lambda x: (x.document_id, x.depth, x.index))
-            facts = [x.content for x in retrieved_nodes]
-            facts = remove_overlaps_in_list_of_strings(facts)
-
-        # Retrieve relevant memories (max 512 tokens)
-        memories: list[Memory] = []
-        vis_mem: set[uuid.UUID] = set()
-        for q in queries:
-            cur = await self.clonedb.query_memories(
-                q,
-                params=GenAgentsSearchParams(max_tokens=memory_tokens, max_items=3),
-                update_access_date=False,
+        compiled = long_term_memory_preamble(
+            clone=self.clone, user_name=self.user_name, llm=self.llm
+        )
+        budget_preamble = compiled
+        if long_description is not self.clone.long_description:
+            # high adaptation swaps in the latest agent summary, which changes too
+            # often to be worth caching
+            budget_preamble = compile_preamble(
+                self.llm,
+                templates.LongTermMemoryMessage.render_preamble(
+                    char=char,
+                    user_name=self.user_name,
+                    short_description=short_description,
+                    long_description=long_description,
+                    llm=self.llm,
+                ),
             )
-            for c in cur:
-                if c.model.id not in vis_mem:
-                    vis_mem.add(c.model.id)
-                    mem = Memory(
-                        id=c.model.id,
-                        content=c.model.content,
-                        timestamp=c.model.timestamp,
-                        importance=c.model.importance,
-                        is_shared=c.model.is_shared,
-                    )
-                    memories.append(mem)
 
         # we will prune overlapping memories with messages later, so this is a conservative
         # overcount early on in the convo
-        cur_prompt = templates.LongTermMemoryMessage.render(
+        context = templates.LongTermMemoryMessage.render_context(
             char=char,
             user_name=self.user_name,
-            short_description=short_description,
-            long_description=long_description,
             monologues=monologues,
             facts=facts,
             memories=memories,
             agent_summary=agent_summary,
             entity_context_summary=entity_context_summary,
-            llm=self.llm,
-            messages=[],
         )
         tokens_remaining = self.llm.context_length
-        tokens_remaining -= self.llm.num_tokens(cur_prompt)
+        tokens_remaining -= budget_preamble.num_tokens + PREAMBLE_SEAM_TOKENS
+        tokens_remaining -= self.llm.num_tokens(context)
         max_tokens = generate.Params.generate_long_term_memory_message.max_tokens
         if max_tokens is None:
             raise TypeError(
@@ -982,7 +1133,7 @@ class Controller:
             if m.is_shared or m.depth > 0 or m.timestamp < oldest_msg_timestamp
         ]
 
-        new_msg_content = await generate.generate_long_term_memory_message(
+        generate_kwargs = dict(
             char=self.clone.name,
             user_name=self.user_name,
             short_description=self.clone.short_description,
@@ -994,18 +1145,42 @@ class Controller:
             entity_context_summary=entity_context_summary,
             facts=facts,
             llm=self.llm,
+            preamble=compiled.preamble,
+        )
+        return PreparedMessage(
+            generate_kwargs=generate_kwargs,
+            parent_id=parent_id,
+            msg_to_unset=msg_to_unset,
         )
-        content = remove_timestamps_from_msg(new_msg_content)
+
+    @tracer.start_as_current_span("generate_long_term_memory_message")
+    async def _generate_long_term_memory_message(
+        self, msg_gen: schemas.MessageGenerate
+    ) -> models.Message:
+        prepared = await self._prepare_long_term_memory_message(msg_gen=msg_gen)
+        content = await generate.generate_long_term_memory_message(
+            **prepared.generate_kwargs
+        )
+        return await self._save_generated_message(content=content, prepared=prepared)
+
+    async def _save_generated_message(
+        self, content: str, prepared: PreparedMessage
+    ) -> models.Message:
+        if self.memory_strategy == MemoryStrategy.long_term:
+            content = remove_timestamps_from_msg(content)
         new_msg_struct = Message(
             content=content,
             sender_name=self.clone.name,
             is_clone=True,
-            parent_id=parent_id,
+            parent_id=prepared.parent_id,
         )
-        new_msg = await self.clonedb.add_message(new_msg_struct, msg_to_unset)
-        mem_content = f'I messaged {self.user_name}, "{new_msg.content}"'
-        # don't block on these
-        self.background_tasks.add_task(self._add_private_memory, content=mem_content)
+        new_msg = await self.clonedb.add_message(new_msg_struct, prepared.msg_to_unset)
+        if self.memory_strategy == MemoryStrategy.long_term:
+            mem_content = f'I messaged {self.user_name}, "{new_msg.content}"'
+            # don't block on these
+            self.background_tasks.add_task(
+                self._add_private_memory, content=mem_content
+            )
         return new_msg
 
     @tracer.start_as_current_span("generate_message")
@@ -1030,6 +1205,54 @@ class Controller:
                     detail=f"Invalid memory strategy: {self.memory_strategy}",
                 )
 
+    async def generate_message_stream(
+        self, msg_gen: schemas.MessageGenerate
+    ) -> AsyncIterator[str | models.Message]:
+        """Streaming version of generate_message. Retrieval and prompt building happen
+        before this returns, so any HTTPException is raised before the response starts.
+        The returned iterator yields content tokens as the LLM produces them, and the
+        persisted models.Message as its final item.
+        """
+        start_time = time.perf_counter()
+        match self.memory_strategy:
+            case MemoryStrategy.zero:
+                prepared = await self._prepare_zero_memory_message(msg_gen=msg_gen)
+                tokens = generate.stream_zero_memory_message(**prepared.generate_kwargs)
+            case MemoryStrategy.long_term:
+                prepared = await self._prepare_long_term_memory_message(msg_gen=msg_gen)
+                tokens = generate.stream_long_term_memory_message(
+                    **prepared.generate_kwargs
+                )
+            case _:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Invalid memory strategy: {self.memory_strategy}",
+                )
+        return self._stream_message(
+            tokens=tokens, prepared=prepared, start_time=start_time
+        )
+
+    async def _stream_message(
+        self,
+        tokens: AsyncIterator[str],
+        prepared: PreparedMessage,
+        start_time: float,
+    ) -> AsyncIterator[str | models.Message]:
+        chunks: list[str] = []
+        async for token in tokens:
+            if not chunks:
+                ttft_meter.record(
+                    amount=time.perf_counter() - start_time,
+                    attributes=dict(
+                        memory_strategy=self.memory_strategy.value,
+                        model=self.llm.model,
+                    ),
+                )
+            chunks.append(token)
+            yield token
+        content = "".join(chunks).strip()
+        yield await self._save_generated_message(content=content, prepared=prepared)
+
     @classmethod
     @tracer.start_as_current_span("generate_long_description")
     async def generate_long_description(
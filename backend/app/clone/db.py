@@ -1,10 +1,11 @@
 # FixMe (Jonny): ASAP try to fix this. It's fucking impossible to properly type the goddamn retrieval functions.
 import time
 import uuid
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime
-from functools import wraps
-from typing import Callable, Sequence, TypeVar
+from functools import lru_cache, wraps
+from typing import AsyncIterator, Callable, Iterable, Sequence, TypeVar
 
 import numpy as np
 import sqlalchemy as sa
@@ -15,13 +16,14 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from typing_extensions import ParamSpec
 
 from app import models
+from app.db.db import async_session_maker
 from app.embedding import EmbeddingClient
 from app.settings import settings
 from clonr.data_structures import Dialogue, Document, Memory, Message, Monologue, Node
 from clonr.tokenizer import Tokenizer
 from clonr.utils import get_current_datetime
 
-from . import retrieval
+from . import bulk, retrieval
 from .cache import CloneCache
 from .types import MetricType
 
@@ -61,6 +63,19 @@ def report_duration(fn: Callable[P, T]):
 
 
 INF = 1_000_000
+# add 4 tokens per message due to <|im_start|>role\n and \n
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def count_tokens(tokenizer: Tokenizer, texts: list[str]) -> list[int]:
+    return tokenizer.length_batch(texts)
+
+
+@lru_cache(maxsize=1024)
+def _timestamp_length(tokenizer: Tokenizer, time_str: str) -> int:
+    # there are only so many distinct time strings, and they change over time
+    # so they can't be stored with the message.
+    return tokenizer.length(f"[{time_str}] ")
 
 
 @dataclass
@@ -103,29 +118,236 @@ class QueryMemoryResult:
     metric: MetricType
 
 
-def inplace_convert_embeddings_to_hierarchical_weighting(
+def hierarchical_embeddings(
     nodes: list[Node], weight_decay_factor: float
-):
-    # If the doc is indexed as a tree, we add in the embeddings of parent
-    # elements to better match, as x1 + (1/gamma) * x2 + (1/gamma)^2 * x3 + ...
-    # this operates in place!
-    if weight_decay_factor > 0:
-        _node_dict: dict[uuid.UUID, Node] = {nd.id: nd for nd in nodes}
-        # since nodes are weighted using parents, sorting will make sure everything
-        # is done in order
-        ids = sorted(list(range(len(nodes))), key=lambda i: nodes[i].depth)
-        for i in ids:
-            nd = nodes[i]
-            if nd.parent_id:
-                new_nd = nd
-                emb = np.array(nd.embedding)
-                gamma = weight_decay_factor
-                while new_nd.parent_id:
-                    new_nd = _node_dict[new_nd.parent_id]
-                    emb += gamma * np.array(new_nd.embedding)
-                    gamma *= weight_decay_factor
-                emb /= np.linalg.norm(emb)
-                nd.embedding = emb.flatten().tolist()
+) -> np.ndarray:
+    """If the doc is indexed as a tree, we add in the embeddings of parent elements
+    to better match, as x1 + gamma * x2 + gamma^2 * x3 + ..., normalized. Nodes
+    without a parent (all of them, for a list index) keep their raw embedding.
+    Returns a (len(nodes), dim) float32 matrix in the same order as `nodes`."""
+    emb = np.array([nd.embedding for nd in nodes], dtype=np.float32)
+    if weight_decay_factor <= 0 or not nodes:
+        return emb
+    pos = {nd.id: i for i, nd in enumerate(nodes)}
+    parent = np.array(
+        [pos[nd.parent_id] if nd.parent_id in pos else -1 for nd in nodes]
+    )
+    # number of ancestors, found by walking every chain up one step at a time
+    generation = np.zeros(len(nodes), dtype=np.int64)
+    ancestor = parent.copy()
+    while (alive := ancestor >= 0).any():
+        generation[alive] += 1
+        if generation.max() > len(nodes):
+            raise ValueError("Node parents contain a cycle.")
+        ancestor[alive] = parent[ancestor[alive]]
+    # the chain sums satisfy s(x) = e(x) + gamma * s(parent(x)), so going down one
+    # generation at a time every row only needs its parent's finished row
+    weighted = emb.copy()
+    for g in range(1, generation.max() + 1):
+        idx = np.flatnonzero(generation == g)
+        weighted[idx] += weight_decay_factor * weighted[parent[idx]]
+    has_parent = parent >= 0
+    weighted[has_parent] /= np.linalg.norm(weighted[has_parent], axis=1, keepdims=True)
+    return weighted
+
+
+# Shared by the CreatorCloneDB methods and their CloneDB classmethod twins. Rows go
+# in through COPY (see bulk.py) in the caller's transaction, the caller commits.
+async def _insert_document(
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID,
+    doc: Document,
+    nodes: list[Node],
+    weighted_embeddings: np.ndarray | None = None,
+) -> None:
+    if weighted_embeddings is None:
+        weighted_embeddings = hierarchical_embeddings(nodes, weight_decay_factor=0)
+    await db.execute(
+        sa.insert(models.Document).values(
+            id=doc.id,
+            content=doc.content,
+            hash=doc.hash,
+            name=doc.name,
+            description=doc.description,
+            type=doc.type,
+            url=doc.url,
+            index_type=doc.index_type,
+            max_chunk_size=doc.max_chunk_size,
+            chunk_overlap=doc.chunk_overlap,
+            text_splitter=doc.text_splitter,
+            embedding=doc.embedding,
+            embedding_model=doc.embedding_model,
+            clone_id=clone_id,
+        )
+    )
+    contents = [x.content.strip() for x in nodes]
+    num_tokens = count_tokens(tokenizer, contents)
+    # parent_id references rows in the same COPY, postgres checks foreign keys
+    # at the end of the statement so the order doesn't matter
+    await bulk.copy_rows(
+        db,
+        models.Node.__table__,
+        [
+            dict(
+                id=node.id,
+                index=node.index,
+                content=content,
+                context=node.context,
+                embedding=node.embedding,
+                weighted_embedding=weighted,
+                embedding_model=node.embedding_model,
+                num_tokens=n_tokens,
+                tokenizer_name=tokenizer.name,
+                is_leaf=node.is_leaf,
+                depth=node.depth,
+                parent_id=node.parent_id,
+                document_id=node.document_id,
+                clone_id=clone_id,
+            )
+            for node, content, n_tokens, weighted in zip(
+                nodes, contents, num_tokens, weighted_embeddings
+            )
+        ],
+    )
+
+
+async def _insert_memories(
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID,
+    conversation_id: uuid.UUID | None,
+    memories: list[Memory],
+) -> list[models.Memory]:
+    num_tokens = count_tokens(tokenizer, [x.content for x in memories])
+    await bulk.copy_rows(
+        db,
+        models.Memory.__table__,
+        [
+            dict(
+                id=memory.id,
+                content=memory.content,
+                embedding=memory.embedding,
+                embedding_model=memory.embedding_model,
+                num_tokens=n_tokens,
+                tokenizer_name=tokenizer.name,
+                timestamp=memory.timestamp,
+                last_accessed_at=memory.last_accessed_at,
+                importance=memory.importance,
+                is_shared=memory.is_shared,
+                depth=memory.depth,
+                conversation_id=conversation_id,
+                clone_id=clone_id,
+            )
+            for memory, n_tokens in zip(memories, num_tokens)
+        ],
+    )
+    # This is unique to us, memories can be hierarchical (i.e. reflections)
+    # and so we must link all children that they depend on. Children that
+    # don't exist (anymore) are skipped, same as when they were loaded one by one.
+    if child_ids := {c for m in memories for c in m.child_ids}:
+        existing = set(
+            await db.scalars(
+                sa.select(models.Memory.id).where(models.Memory.id.in_(child_ids))
+            )
+        )
+        await bulk.copy_rows(
+            db,
+            models.memory_to_memory,
+            [
+                dict(parent_id=m.id, child_id=c)
+                for m in memories
+                for c in dict.fromkeys(m.child_ids)
+                if c in existing
+            ],
+        )
+    return await _select_in_order(db, models.Memory, [m.id for m in memories])
+
+
+async def _insert_monologues(
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID,
+    monologues: list[Monologue],
+    embeddings: list[list[float]],
+    embedding_model: str,
+) -> list[models.Monologue]:
+    num_tokens = count_tokens(tokenizer, [m.content for m in monologues])
+    await bulk.copy_rows(
+        db,
+        models.Monologue.__table__,
+        [
+            dict(
+                id=m.id,
+                content=m.content,
+                source=m.source,
+                embedding=emb,
+                embedding_model=embedding_model,
+                num_tokens=n_tokens,
+                tokenizer_name=tokenizer.name,
+                hash=m.hash,
+                clone_id=clone_id,
+            )
+            for m, emb, n_tokens in zip(monologues, embeddings, num_tokens)
+        ],
+    )
+    return await _select_in_order(db, models.Monologue, [m.id for m in monologues])
+
+
+async def _insert_dialogue(
+    db: AsyncSession, clone_id: uuid.UUID, dialogue: Dialogue
+) -> None:
+    await db.execute(
+        sa.insert(models.ExampleDialogue).values(
+            id=dialogue.id,
+            source=dialogue.source,
+            embedding=dialogue.embedding,
+            embedding_model=dialogue.embedding_model,
+            clone_id=clone_id,
+        )
+    )
+    existing = set(
+        await db.scalars(
+            sa.select(models.ExampleDialogueMessage.id).where(
+                models.ExampleDialogueMessage.id.in_([m.id for m in dialogue.messages])
+            )
+        )
+    )
+    await bulk.copy_rows(
+        db,
+        models.ExampleDialogueMessage.__table__,
+        [
+            dict(
+                id=m.id,
+                index=m.index,
+                content=m.content,
+                sender_name=m.sender_name,
+                is_clone=m.is_clone,
+                embedding=m.embedding,
+                embedding_model=m.embedding_model,
+                dialogue_id=dialogue.id,
+                clone_id=clone_id,
+            )
+            for m in dialogue.messages
+            if m.id not in existing
+        ],
+    )
+    if existing:
+        await db.execute(
+            sa.update(models.ExampleDialogueMessage)
+            .where(models.ExampleDialogueMessage.id.in_(existing))
+            .values(dialogue_id=dialogue.id)
+        )
+
+
+async def _select_in_order(
+    db: AsyncSession, model: type[T], ids: list[uuid.UUID]
+) -> list[T]:
+    rows = {
+        x.id: x
+        for x in await db.scalars(sa.select(model).where(model.id.in_(ids)))  # type: ignore
+    }
+    return [rows[id] for id in ids if id in rows]
 
 
 class CreatorCloneDB:
@@ -162,67 +384,44 @@ class CreatorCloneDB:
                 detail="Document with the provided content already exists!",
             )
 
-        # Add embedding stuff. Doc embeddings are just the mean of all node embeddings
-        embs = await self.embedding_client.encode_passage(
-            [x.content.strip() for x in nodes]
-        )
+        # Add embedding stuff. Doc embeddings are just the mean of all node embeddings.
+        # Nodes embedded ahead of time (by the ingestion worker) are left alone.
         encoder_name = await self.embedding_client.encoder_name()
-        for i, node in enumerate(nodes):
-            node.embedding = embs[i]
-            node.embedding_model = encoder_name
+        if missing := [
+            node
+            for node in nodes
+            if node.embedding is None or node.embedding_model != encoder_name
+        ]:
+            embs = await self.embedding_client.encode_passage(
+                [x.content.strip() for x in missing]
+            )
+            for node, emb in zip(missing, embs):
+                node.embedding = emb
+                node.embedding_model = encoder_name
         arr = np.array([node.embedding for node in nodes]).mean(0)
         if await self.embedding_client.is_normalized():
             arr /= np.linalg.norm(arr)
         doc.embedding = arr.tolist()
         doc.embedding_model = await self.embedding_client.encoder_name()
 
-        if doc.index_type == "tree" and hierarchical_weight_decay_factor > 0:
-            inplace_convert_embeddings_to_hierarchical_weighting(
-                nodes=node, weight_decay_factor=hierarchical_weight_decay_factor
-            )
+        # raw and weighted embeddings are both stored, retrieval picks one per query
+        decay = hierarchical_weight_decay_factor if doc.index_type == "tree" else 0
+        weighted_embeddings = hierarchical_embeddings(
+            nodes=nodes, weight_decay_factor=decay
+        )
 
         # Add together to prevent inconsistency, or out-of-order addition
-        doc_model = models.Document(
-            id=doc.id,
-            content=doc.content,
-            hash=doc.hash,
-            name=doc.name,
-            description=doc.description,
-            type=doc.type,
-            url=doc.url,
-            index_type=doc.index_type,
-            max_chunk_size=doc.max_chunk_size,
-            chunk_overlap=doc.chunk_overlap,
-            text_splitter=doc.text_splitter,
-            embedding=doc.embedding,
-            embedding_model=doc.embedding_model,
+        await _insert_document(
+            db=self.db,
+            tokenizer=self.tokenizer,
             clone_id=self.clone_id,
+            doc=doc,
+            nodes=nodes,
+            weighted_embeddings=weighted_embeddings,
         )
-        node_models = {
-            node.id: models.Node(
-                id=node.id,
-                index=node.index,
-                content=node.content.strip(),
-                context=node.context,
-                embedding=node.embedding,
-                embedding_model=node.embedding_model,
-                is_leaf=node.is_leaf,
-                depth=node.depth,
-                document_id=node.document_id,
-                clone_id=self.clone_id,
-            )
-            for node in nodes
-        }
-
-        # this will work for trees where each node has at most one parent!
-        for node in nodes:
-            if node.parent_id and (parent := node_models.get(node.parent_id)):
-                node_models[node.id].parent = parent
-
-        self.db.add(doc_model)
-        self.db.add_all(node_models.values())
         await self.db.commit()
-        await self.db.refresh(doc_model)
+        doc_model = await self.db.get(models.Document, doc.id)
+        assert doc_model is not None
         return doc_model
 
     @tracer.start_as_current_span("add_dialogues")
@@ -253,30 +452,9 @@ class CreatorCloneDB:
 
             # Actually add the dialogues now. I haven't checked this since the updates.
             # But since dialogues are a V2 feature, hopefully this shouldn't matter too much.
-            msgs: list[models.ExampleDialogueMessage] = []
-            for m in dialogue.messages:
-                if not (x := await self.db.get(models.ExampleDialogueMessage, m.id)):
-                    x = models.ExampleDialogueMessage(
-                        index=m.index,
-                        content=m.content,
-                        sender_name=m.sender_name,
-                        is_clone=m.is_clone,
-                        embedding=m.embedding,
-                        embedding_model=m.embedding_model,
-                        dialogue_id=m.dialogue_id,
-                        clone_id=self.clone_id,
-                    )
-                msgs.append(x)
-            dlg = models.ExampleDialogue(
-                source=dialogue.source,
-                messages=msgs,
-                embedding=dialogue.embedding,
-                embedding_model=dialogue.embedding_model,
-                clone_id=self.clone_id,
+            await _insert_dialogue(
+                db=self.db, clone_id=self.clone_id, dialogue=dialogue
             )
-
-            self.db.add_all(msgs)
-            self.db.add(dlg)
             await self.db.commit()
 
     @tracer.start_as_current_span("add_monologues")
@@ -285,7 +463,6 @@ class CreatorCloneDB:
         self,
         monologues: list[Monologue],
     ) -> Sequence[models.Monologue]:
-        monologue_models: list[models.Monologue] = []
         hashes = [m.hash for m in monologues]
         r = await self.db.execute(
             sa.select(models.Monologue.hash)
@@ -300,18 +477,14 @@ class CreatorCloneDB:
             [m.content for m in monologues]
         )
         embedding_model = await self.embedding_client.encoder_name()
-        for m, emb in zip(monologues, embeddings):
-            m1 = models.Monologue(
-                id=m.id,
-                content=m.content,
-                source=m.source,
-                embedding=emb,
-                embedding_model=embedding_model,
-                hash=m.hash,
-                clone_id=self.clone_id,
-            )
-            monologue_models.append(m1)
-        self.db.add_all(monologue_models)
+        monologue_models = await _insert_monologues(
+            db=self.db,
+            tokenizer=self.tokenizer,
+            clone_id=self.clone_id,
+            monologues=monologues,
+            embeddings=embeddings,
+            embedding_model=embedding_model,
+        )
         await self.db.commit()
         return monologue_models
 
@@ -331,34 +504,13 @@ class CreatorCloneDB:
             m.embedding_model = embedding_model
 
         # add all of the memories
-        mem_models: list[models.Memory] = []
-        for memory in memories:
-            # This is unique to us, memories can be hierarchical (i.e. reflections)
-            # and so we must pull all children that they depend on
-            children: list[models.Memory] = []
-            if memory.child_ids:
-                r = await self.db.scalars(
-                    sa.select(models.Memory).where(
-                        models.Memory.id.in_(tuple(memory.child_ids))
-                    )
-                )
-                children = list(r.all())
-            mem = models.Memory(
-                content=memory.content,
-                embedding=memory.embedding,
-                embedding_model=memory.embedding_model,
-                timestamp=memory.timestamp,
-                last_accessed_at=memory.last_accessed_at,
-                importance=memory.importance,
-                is_shared=memory.is_shared,
-                depth=memory.depth,
-                children=children,
-                conversation_id=None,
-                clone_id=self.clone_id,
-            )
-            self.db.add(mem)
-            mem_models.append(mem)
-        # NOTE (Jonny): is it going to be an issue that we don't refresh these?
+        mem_models = await _insert_memories(
+            db=self.db,
+            tokenizer=self.tokenizer,
+            clone_id=self.clone_id,
+            conversation_id=None,
+            memories=memories,
+        )
         await self.db.commit()
         return mem_models
 
@@ -394,6 +546,22 @@ class CloneDB:
         self.conversation_id = conversation_id
         self.user_id = user_id
 
+    @asynccontextmanager
+    async def fork(self) -> AsyncIterator["CloneDB"]:
+        """A copy of this CloneDB on its own short-lived session. An AsyncSession can't
+        run statements concurrently, so independent reads each need one of these to
+        run at the same time. Rows loaded through it are detached once it closes."""
+        async with async_session_maker() as db:
+            yield CloneDB(
+                db=db,
+                cache=self.cache,
+                tokenizer=self.tokenizer,
+                embedding_client=self.embedding_client,
+                clone_id=self.clone_id,
+                conversation_id=self.conversation_id,
+                user_id=self.user_id,
+            )
+
     @tracer.start_as_current_span("add_document")
     @report_duration
     @classmethod
@@ -401,6 +569,7 @@ class CloneDB:
         cls,
         db: AsyncSession,
         embedding_client: EmbeddingClient,
+        tokenizer: Tokenizer,
         clone_id: uuid.UUID,
         doc: Document,
         nodes: list[Node],
@@ -429,44 +598,12 @@ class CloneDB:
         doc.embedding_model = await embedding_client.encoder_name()
 
         # Add together to prevent inconsistency, or out-of-order addition
-        doc_model = models.Document(
-            id=doc.id,
-            content=doc.content,
-            hash=doc.hash,
-            name=doc.name,
-            description=doc.description,
-            type=doc.type,
-            url=doc.url,
-            index_type=doc.index_type,
-            embedding=doc.embedding,
-            embedding_model=doc.embedding_model,
-            clone_id=clone_id,
+        await _insert_document(
+            db=db, tokenizer=tokenizer, clone_id=clone_id, doc=doc, nodes=nodes
         )
-        node_models = {
-            node.id: models.Node(
-                id=node.id,
-                index=node.index,
-                content=node.content,
-                context=node.context,
-                embedding=node.embedding,
-                embedding_model=node.embedding_model,
-                is_leaf=node.is_leaf,
-                depth=node.depth,
-                document_id=node.document_id,
-                clone_id=clone_id,
-            )
-            for node in nodes
-        }
-
-        # this will work for trees where each node has at most one parent!
-        for node in nodes:
-            if node.parent_id and (parent := node_models.get(node.parent_id)):
-                node_models[node.id].parent = parent
-
-        db.add(doc_model)
-        db.add_all(node_models.values())
         await db.commit()
-        await db.refresh(doc_model)
+        doc_model = await db.get(models.Document, doc.id)
+        assert doc_model is not None
         return doc_model
 
     @tracer.start_as_current_span("add_dialogues")
@@ -501,30 +638,7 @@ class CloneDB:
 
             # Actually add the dialogues now. I haven't checked this since the updates.
             # But since dialogues are a V2 feature, hopefully this shouldn't matter too much.
-            msgs: list[models.ExampleDialogueMessage] = []
-            for m in dialogue.messages:
-                if not (x := await db.get(models.ExampleDialogueMessage, m.id)):
-                    x = models.ExampleDialogueMessage(
-                        index=m.index,
-                        content=m.content,
-                        sender_name=m.sender_name,
-                        is_clone=m.is_clone,
-                        embedding=m.embedding,
-                        embedding_model=m.embedding_model,
-                        dialogue_id=m.dialogue_id,
-                        clone_id=clone_id,
-                    )
-                msgs.append(x)
-            dlg = models.ExampleDialogue(
-                source=dialogue.source,
-                messages=msgs,
-                embedding=dialogue.embedding,
-                embedding_model=dialogue.embedding_model,
-                clone_id=clone_id,
-            )
-
-            db.add_all(msgs)
-            db.add(dlg)
+            await _insert_dialogue(db=db, clone_id=clone_id, dialogue=dialogue)
             await db.commit()
 
     @tracer.start_as_current_span("add_monologues")
@@ -534,10 +648,10 @@ class CloneDB:
         cls,
         db: AsyncSession,
         embedding_client: EmbeddingClient,
+        tokenizer: Tokenizer,
         clone_id: uuid.UUID,
         monologues: list[Monologue],
     ) -> Sequence[models.Monologue]:
-        monologue_models: list[models.Monologue] = []
         hashes = [m.hash for m in monologues]
         r = await db.execute(
             sa.select(models.Monologue.hash)
@@ -552,18 +666,14 @@ class CloneDB:
             [m.content for m in monologues]
         )
         embedding_model = await embedding_client.encoder_name()
-        for m, emb in zip(monologues, embeddings):
-            m1 = models.Monologue(
-                id=m.id,
-                content=m.content,
-                source=m.source,
-                embedding=emb,
-                embedding_model=embedding_model,
-                hash=m.hash,
-                clone_id=clone_id,
-            )
-            monologue_models.append(m1)
-        db.add_all(monologue_models)
+        monologue_models = await _insert_monologues(
+            db=db,
+            tokenizer=tokenizer,
+            clone_id=clone_id,
+            monologues=monologues,
+            embeddings=embeddings,
+            embedding_model=embedding_model,
+        )
         await db.commit()
         return monologue_models
 
@@ -580,34 +690,13 @@ class CloneDB:
             m.embedding_model = embedding_model
 
         # add all of the memories
-        mem_models: list[models.Memory] = []
-        for memory in memories:
-            # This is unique to us, memories can be hierarchical (i.e. reflections)
-            # and so we must pull all children that they depend on
-            children: list[models.Memory] = []
-            if memory.child_ids:
-                r = await self.db.scalars(
-                    sa.select(models.Memory).where(
-                        models.Memory.id.in_(tuple(memory.child_ids))
-                    )
-                )
-                children = list(list(r.all()))
-            mem = models.Memory(
-                content=memory.content,
-                embedding=memory.embedding,
-                embedding_model=memory.embedding_model,
-                timestamp=memory.timestamp,
-                last_accessed_at=memory.last_accessed_at,
-                importance=memory.importance,
-                is_shared=memory.is_shared,
-                depth=memory.depth,
-                children=children,
-                conversation_id=self.conversation_id,
-                clone_id=self.clone_id,
-            )
-            self.db.add(mem)
-            mem_models.append(mem)
-        # NOTE (Jonny): is it going to be an issue that we don't refresh these?
+        mem_models = await _insert_memories(
+            db=self.db,
+            tokenizer=self.tokenizer,
+            clone_id=self.clone_id,
+            conversation_id=self.conversation_id,
+            memories=memories,
+        )
         await self.db.commit()
         return mem_models
 
@@ -619,6 +708,7 @@ class CloneDB:
         clone_id: uuid.UUID,
         db: AsyncSession,
         embedding_client: EmbeddingClient,
+        tokenizer: Tokenizer,
         memories: list[Memory],
     ) -> Sequence[models.Memory]:
         # batch embed
@@ -631,34 +721,13 @@ class CloneDB:
             m.embedding_model = embedding_model
 
         # add all of the memories
-        mem_models: list[models.Memory] = []
-        for memory in memories:
-            # This is unique to us, memories can be hierarchical (i.e. reflections)
-            # and so we must pull all children that they depend on
-            children: list[models.Memory] = []
-            if memory.child_ids:
-                r = await db.scalars(
-                    sa.select(models.Memory).where(
-                        models.Memory.id.in_(tuple(memory.child_ids))
-                    )
-                )
-                children = list(r.all())
-            mem = models.Memory(
-                content=memory.content,
-                embedding=memory.embedding,
-                embedding_model=memory.embedding_model,
-                timestamp=memory.timestamp,
-                last_accessed_at=memory.last_accessed_at,
-                importance=memory.importance,
-                is_shared=memory.is_shared,
-                depth=memory.depth,
-                children=children,
-                conversation_id=None,
-                clone_id=clone_id,
-            )
-            db.add(mem)
-            mem_models.append(mem)
-        # NOTE (Jonny): is it going to be an issue that we don't refresh these?
+        mem_models = await _insert_memories(
+            db=db,
+            tokenizer=tokenizer,
+            clone_id=clone_id,
+            conversation_id=None,
+            memories=memories,
+        )
         await db.commit()
         return mem_models
 
@@ -686,12 +755,23 @@ class CloneDB:
             user_id=self.user_id,
             embedding=embedding[0],
             embedding_model=embedding_model,
+            num_tokens=self.tokenizer.length(message.content),
+            tokenizer_name=self.tokenizer.name,
         )
         self.db.add(msg)
         if msg_to_unset is not None:
+            # could be a detached copy out of the conversation cache
+            await self.db.execute(
+                sa.update(models.Message)
+                .where(models.Message.id == msg_to_unset.id)
+                .values(is_main=False)
+            )
             msg_to_unset.is_main = False
         await self.db.commit()
         await self.db.refresh(msg)
+        await self.cache.push_message(
+            self.conversation_id, msg, replaces_last=msg_to_unset is not None
+        )
         return msg
 
     @tracer.start_as_current_span("add_entity_context_summary")
@@ -715,6 +795,9 @@ class CloneDB:
         self.db.add(obj)
         await self.db.commit()
         await self.db.refresh(obj)
+        await self.cache.set_entity_context_summary(
+            self.conversation_id, entity_name, obj
+        )
         return obj
 
     @tracer.start_as_current_span("add_agent_summary")
@@ -734,6 +817,7 @@ class CloneDB:
         self.db.add(obj)
         await self.db.commit()
         await self.db.refresh(obj)
+        await self.cache.set_agent_summary(self.conversation_id, obj)
         return obj
 
     @tracer.start_as_current_span("query_nodes")
@@ -755,6 +839,28 @@ class CloneDB:
             for x in retrieved_nodes
         ]
 
+    @tracer.start_as_current_span("query_nodes_many")
+    @report_duration
+    async def query_nodes_many(
+        self, queries: list[str], params: retrieval.VectorSearchParams
+    ) -> list[list[QueryNodeResult]]:
+        retrieved_nodes = await retrieval.vector_search_many(  # type: ignore
+            queries=queries,
+            model=models.Node,
+            params=params,
+            db=self.db,
+            embedding_client=self.embedding_client,
+            tokenizer=self.tokenizer,
+            filters=[models.Node.clone_id == self.clone_id],
+        )
+        return [
+            [
+                QueryNodeResult(model=x.model, distance=x.distance, metric=x.metric)  # type: ignore
+                for x in cur
+            ]
+            for cur in retrieved_nodes
+        ]
+
     @tracer.start_as_current_span("query_nodes_with_rerank")
     @report_duration
     async def query_nodes_with_rerank(
@@ -822,14 +928,7 @@ class CloneDB:
             for x in retrieved_monologues
         ]
 
-    @tracer.start_as_current_span("query_memories")
-    @report_duration
-    async def query_memories(
-        self,
-        query: str,
-        params: retrieval.GenAgentsSearchParams,
-        update_access_date: bool,
-    ) -> list[QueryMemoryResult]:
+    def _memory_filters(self) -> list[sa.ColumnElement[bool]]:
         # We filter to retrieve either private memories for the conversation, or public memories
         # shared across all conversations
         is_public = sa.and_(
@@ -842,7 +941,16 @@ class CloneDB:
             filters = [is_public]
 
         filters = [sa.or_(is_public, is_private)]
+        return filters
 
+    @tracer.start_as_current_span("query_memories")
+    @report_duration
+    async def query_memories(
+        self,
+        query: str,
+        params: retrieval.GenAgentsSearchParams,
+        update_access_date: bool,
+    ) -> list[QueryMemoryResult]:
         retrieved_memories = await retrieval.gen_agents_search(  # type: ignore
             query=query,
             model=models.Memory,
@@ -850,7 +958,7 @@ class CloneDB:
             db=self.db,
             embedding_client=self.embedding_client,
             tokenizer=self.tokenizer,
-            filters=filters,
+            filters=self._memory_filters(),
         )
 
         # For memories, we have to update their `last_accessed_at` field each
@@ -875,44 +983,128 @@ class CloneDB:
 
         return memory_results
 
+    @tracer.start_as_current_span("query_memories_many")
+    @report_duration
+    async def query_memories_many(
+        self,
+        queries: list[str],
+        params: retrieval.GenAgentsSearchParams,
+        update_access_date: bool,
+    ) -> list[list[QueryMemoryResult]]:
+        retrieved_memories = await retrieval.gen_agents_search_many(  # type: ignore
+            queries=queries,
+            model=models.Memory,
+            params=params,
+            db=self.db,
+            embedding_client=self.embedding_client,
+            tokenizer=self.tokenizer,
+            filters=self._memory_filters(),
+        )
+
+        if update_access_date:
+            timestamp = get_current_datetime()
+            for cur in retrieved_memories:
+                for r in cur:
+                    r.model.last_accessed_at = timestamp
+            await self.db.commit()
+
+        return [
+            [
+                QueryMemoryResult(
+                    model=x.model,  # type: ignore
+                    recency_score=x.recency_score,
+                    relevance_score=x.relevance_score,
+                    importance_score=x.importance_score,
+                    metric=x.metric,
+                    score=x.score,
+                )
+                for x in cur
+            ]
+            for cur in retrieved_memories
+        ]
+
     # get operations
+    def _take_messages(
+        self, msgs: Iterable[models.Message], num_messages: int, num_tokens: int
+    ) -> tuple[list[models.Message], bool]:
+        """Takes messages from newest to oldest until either limit is hit. Also returns
+        whether a limit was hit, as opposed to running out of messages."""
+        msgs = list(msgs)
+        lengths = (
+            retrieval.num_tokens_batch(msgs, self.tokenizer)
+            if num_tokens < INF
+            else [0] * len(msgs)
+        )
+        messages: list[models.Message] = []
+        for msg, length in zip(msgs, lengths):
+            if len(messages) >= num_messages:
+                return messages, True
+            if num_tokens < INF:
+                # TODO (Jonny): find a way to make sure this is in sync with the templates
+                # this should hopefully be an upper bound on how bad it can be. (if we omit timestamps)
+                # formatted as f"[{msg.time_str}] {msg.content}"
+                num_tokens -= (
+                    length
+                    + _timestamp_length(self.tokenizer, msg.time_str)
+                    + MESSAGE_TOKEN_OVERHEAD
+                )
+                if num_tokens < 0:
+                    return messages, True
+            messages.append(msg)
+        return messages, False
+
+    async def _query_messages(
+        self, num_messages: int, num_tokens: int
+    ) -> list[models.Message]:
+        # the SQL cutoff leaves out the timestamps, so it only ever lets through extra
+        # messages that are then dropped in _take_messages.
+        q = retrieval.select_within_token_budget(
+            model=models.Message,
+            columns=[],
+            order_by=models.Message.timestamp.desc(),
+            limit=num_messages,
+            max_tokens=num_tokens,
+            tokenizer=self.tokenizer,
+            filters=[
+                models.Message.conversation_id == self.conversation_id,
+                models.Message.is_main,
+                models.Message.is_active,
+            ],
+            overhead=MESSAGE_TOKEN_OVERHEAD,
+        )
+        msg_itr = await self.db.scalars(q)
+        messages, _ = self._take_messages(msg_itr, num_messages, num_tokens)
+        return messages
+
     @tracer.start_as_current_span("get_messages")
     @report_duration
     async def get_messages(
         self, num_messages: int | None = None, num_tokens: int | None = None
     ) -> Sequence[models.Message]:
         """Returns the recent messages in chronological order, i.e.
-        [newest, ..., oldest]"""
+        [newest, ..., oldest]
+
+        These usually come out of the conversation cache as detached copies, so they
+        shouldn't be modified through the session."""
         if self.conversation_id is None:
             raise ValueError("Retrieving memories requires conversation_id.")
         if num_messages is None or num_messages < 1:
             num_messages = INF
         if num_tokens is None or num_tokens < 1:
             num_tokens = INF
-        q = (
-            sa.select(models.Message)
-            .where(models.Message.conversation_id == self.conversation_id)
-            .where(models.Message.is_main)
-            .where(models.Message.is_active)
-            .order_by(models.Message.timestamp.desc())
-            .limit(num_messages)
-        )
-        msg_itr = await self.db.scalars(q)
 
-        if num_tokens >= INF:
-            return list(msg_itr.all())
-
-        messages: list[models.Message] = []
-        for msg in msg_itr:
-            # TODO (Jonny): find a way to make sure this is in sync with the templates
-            # this should hopefully be an upper bound on how bad it can be. (if we omit timestamps)
-            formatted_content = f"[{msg.time_str}] {msg.content}"
-            # add 4 tokens per message due to <|im_start|>role\n and \n
-            num_tokens -= self.tokenizer.length(formatted_content) + 4
-            if num_tokens < 0:
-                break
-            messages.append(msg)
-        return messages
+        window = await self.cache.get_recent_messages(self.conversation_id)
+        if window is None:
+            window = await self._query_messages(
+                num_messages=settings.CONVERSATION_CACHE_NUM_MESSAGES, num_tokens=INF
+            )
+            await self.cache.set_recent_messages(self.conversation_id, window)
+        messages, done = self._take_messages(window, num_messages, num_tokens)
+        # a short window is the whole conversation, otherwise there may be more
+        # messages within the limits than what is cached
+        if done or len(window) < settings.CONVERSATION_CACHE_NUM_MESSAGES:
+            return messages
+        return await self._query_messages(num_messages, num_tokens)
 
     @tracer.start_as_current_span("get_memories")
     @report_duration
@@ -927,20 +1119,24 @@ class CloneDB:
             num_messages = INF
         if num_tokens is None or num_tokens < 1:
             num_tokens = INF
-        q = (
-            sa.select(models.Memory)
-            .where(models.Memory.conversation_id == self.conversation_id)
-            .order_by(models.Memory.timestamp.desc())
-            .limit(num_messages)
+        q = retrieval.select_within_token_budget(
+            model=models.Memory,
+            columns=[],
+            order_by=models.Memory.timestamp.desc(),
+            limit=num_messages,
+            max_tokens=num_tokens,
+            tokenizer=self.tokenizer,
+            filters=[models.Memory.conversation_id == self.conversation_id],
         )
         mem_itr = await self.db.scalars(q)
 
         if num_tokens >= INF:
             return list(mem_itr.all())
 
+        mems = list(mem_itr.all())
         memories: list[models.Memory] = []
-        for mem in mem_itr:
-            num_tokens -= self.tokenizer.length(mem.content)
+        for mem, length in zip(mems, retrieval.num_tokens_batch(mems, self.tokenizer)):
+            num_tokens -= length
             if num_tokens < 0:
                 break
             memories.append(mem)
@@ -955,20 +1151,25 @@ class CloneDB:
             num_messages = INF
         if num_tokens is None or num_tokens < 1:
             num_tokens = INF
-        q = (
-            sa.select(models.Monologue)
-            .where(models.Monologue.clone_id == self.clone_id)
-            .order_by(models.Message.created_at.desc())
-            .limit(num_messages)
+        q = retrieval.select_within_token_budget(
+            model=models.Monologue,
+            columns=[],
+            order_by=models.Monologue.created_at.desc(),
+            limit=num_messages,
+            max_tokens=num_tokens,
+            tokenizer=self.tokenizer,
+            filters=[models.Monologue.clone_id == self.clone_id],
         )
         monologue_itr = await self.db.scalars(q)
 
         if num_tokens >= INF:
             return list(monologue_itr.all())
 
+        rows = list(monologue_itr.all())
         monologues: list[models.Monologue] = []
-        for monologue in monologue_itr:
-            dec = self.tokenizer.length(monologue.content)
+        for monologue, dec in zip(
+            rows, retrieval.num_tokens_batch(rows, self.tokenizer)
+        ):
             num_tokens -= dec
             if num_tokens < 0:
                 break
@@ -984,6 +1185,16 @@ class CloneDB:
             raise ValueError(
                 "Retrieving entity context summary requires conversation_id."
             )
+        if (
+            n == 1
+            and (
+                cached := await self.cache.get_entity_context_summary(
+                    self.conversation_id, entity_name
+                )
+            )
+            is not None
+        ):
+            return cached
         q = (
             sa.select(models.EntityContextSummary)
             .where(models.EntityContextSummary.conversation_id == self.conversation_id)
@@ -991,22 +1202,36 @@ class CloneDB:
             .order_by(models.EntityContextSummary.created_at.desc())
             .limit(n)
         )
-        summaries = await self.db.scalars(q)
-        return summaries.all()
+        summaries = (await self.db.scalars(q)).all()
+        if n == 1:
+            await self.cache.set_entity_context_summary(
+                self.conversation_id, entity_name, summaries[0] if summaries else None
+            )
+        return summaries
 
     @tracer.start_as_current_span("get_agent_summary")
     @report_duration
     async def get_agent_summary(self, n: int = 1) -> Sequence[models.AgentSummary]:
         if self.conversation_id is None:
             raise ValueError("Retrieving agent summary requires conversation_id.")
+        if (
+            n == 1
+            and (cached := await self.cache.get_agent_summary(self.conversation_id))
+            is not None
+        ):
+            return cached
         q = (
             sa.select(models.AgentSummary)
             .where(models.AgentSummary.conversation_id == self.conversation_id)
             .order_by(models.AgentSummary.created_at.desc())
             .limit(n)
         )
-        summaries = await self.db.scalars(q)
-        return summaries.all()
+        summaries = (await self.db.scalars(q)).all()
+        if n == 1:
+            await self.cache.set_agent_summary(
+                self.conversation_id, summaries[0] if summaries else None
+            )
+        return summaries
 
     @tracer.start_as_current_span("increment_reflection_counter")
     async def increment_reflection_counter(self, importance: int) -> int:
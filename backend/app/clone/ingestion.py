@@ -0,0 +1,387 @@
+import asyncio
+import time
+import uuid
+from typing import Callable
+
+import sqlalchemy as sa
+from fastapi import HTTPException
+from loguru import logger
+from opentelemetry import metrics, trace
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models, schemas
+from app.db.db import async_session_maker
+from app.embedding import EmbeddingClient
+from app.settings import settings
+from clonr.data_structures import Document, IndexType, Node
+from clonr.index import ListIndex, TreeIndex
+from clonr.llms import LLM
+from clonr.text_splitters import TextSplitter
+from clonr.tokenizer import Tokenizer
+from clonr.utils import aggregate_by_length, get_current_datetime
+
+from .cache import CloneCache
+from .db import CreatorCloneDB
+
+tracer = trace.get_tracer(__name__)
+meter = metrics.get_meter(settings.BACKEND_APP_NAME)
+
+ingestion_jobs_meter = meter.create_counter(
+    name="ingestion_jobs_total",
+    description="Document ingestion jobs finished by the worker, by status",
+)
+ingestion_stage_duration = meter.create_histogram(
+    name="ingestion_stage_duration_seconds",
+    description="Time spent in each stage of a document ingestion job",
+    unit="s",
+)
+
+Stage = schemas.DocumentJobStage
+Status = schemas.DocumentJobStatus
+STAGES = list(Stage)
+
+# Moves the oldest queued job onto the processing list and takes its lease in one
+# step, so `recover` can never find a claimed job without a lease and hand it to a
+# second worker. The lease key is built in the script from a template (ARGV[1]),
+# which is fine on a single redis but not on a cluster.
+CLAIM_SCRIPT = """
+local job_id = redis.call("LMOVE", KEYS[1], KEYS[2], "RIGHT", "LEFT")
+if job_id then
+    local lease_key = string.gsub(ARGV[1], "{job_id}", job_id)
+    redis.call("SET", lease_key, 1, "EX", ARGV[2])
+end
+return job_id
+"""
+
+
+class Checkpoint(BaseModel):
+    doc: Document
+    nodes: list[Node] = []
+
+    def dump(self) -> str:
+        # unset embeddings are None, which their list[float] annotation won't load
+        return self.model_dump_json(exclude_none=True)
+
+
+class IngestionQueue:
+    """Redis-backed queue of document ingestion jobs.
+
+    New jobs are pushed onto the left of the queue list and workers atomically move
+    them from the right onto the processing list, so a job is never in neither. A
+    worker takes a lease on its job in the same step, and keeps renewing it; if the worker dies, the
+    lease runs out and `recover` puts the job back at the front of the queue. Jobs
+    checkpoint their document and nodes after every stage, so the next worker picks
+    up after the last completed one.
+    """
+
+    queue_key = "ingestion::queue"
+    processing_key = "ingestion::processing"
+
+    def __init__(self, conn: Redis):
+        self.conn = conn
+        self._claim = conn.register_script(CLAIM_SCRIPT)
+
+    def _job_key(self, job_id: str | uuid.UUID) -> str:
+        return f"ingestion::job::{job_id}"
+
+    def _checkpoint_key(self, job_id: str | uuid.UUID) -> str:
+        return f"ingestion::job::{job_id}::checkpoint"
+
+    def _lease_key(self, job_id: str | uuid.UUID) -> str:
+        return f"ingestion::job::{job_id}::lease"
+
+    def _running_key(self, clone_id: str | uuid.UUID) -> str:
+        return f"ingestion::clone_id::{clone_id}::running"
+
+    async def enqueue(self, job: schemas.DocumentJob, doc: Document):
+        ttl = settings.INGESTION_JOB_TTL_SECONDS
+        async with self.conn.pipeline(transaction=True) as pipe:
+            pipe.set(self._job_key(job.id), job.model_dump_json(), ex=ttl)
+            pipe.set(
+                self._checkpoint_key(job.id),
+                Checkpoint(doc=doc).dump(),
+                ex=ttl,
+            )
+            pipe.lpush(self.queue_key, str(job.id))
+            await pipe.execute()
+
+    async def get_job(self, job_id: str | uuid.UUID) -> schemas.DocumentJob | None:
+        if (raw := await self.conn.get(self._job_key(job_id))) is None:
+            return None
+        return schemas.DocumentJob.model_validate_json(raw)
+
+    async def save_job(self, job: schemas.DocumentJob):
+        job.updated_at = get_current_datetime()
+        await self.conn.set(
+            self._job_key(job.id),
+            job.model_dump_json(),
+            ex=settings.INGESTION_JOB_TTL_SECONDS,
+        )
+
+    async def load_checkpoint(self, job_id: str | uuid.UUID) -> Checkpoint:
+        if (raw := await self.conn.get(self._checkpoint_key(job_id))) is None:
+            raise ValueError(f"Ingestion job {job_id} has no checkpoint.")
+        return Checkpoint.model_validate_json(raw)
+
+    async def save_checkpoint(self, job_id: str | uuid.UUID, checkpoint: Checkpoint):
+        await self.conn.set(
+            self._checkpoint_key(job_id),
+            checkpoint.dump(),
+            ex=settings.INGESTION_JOB_TTL_SECONDS,
+        )
+
+    async def claim(self, timeout: float) -> schemas.DocumentJob | None:
+        """Blocks for up to `timeout` seconds for a job. Returns None if there was
+        nothing to do, or if the job's clone already has the maximum number of jobs
+        running, in which case it goes to the back of the queue."""
+        # wait for a job without taking it (moving the queue's tail back onto its own
+        # tail changes nothing), then take it along with its lease in one step.
+        # Another worker can get there first, in which case there's nothing to do.
+        if not await self.conn.blmove(
+            self.queue_key, self.queue_key, timeout, "RIGHT", "RIGHT"
+        ):
+            return None
+        raw = await self._claim(
+            keys=[self.queue_key, self.processing_key],
+            args=[self._lease_key("{job_id}"), settings.INGESTION_LEASE_SECONDS],
+        )
+        if raw is None:
+            return None
+        job_id = raw.decode()
+        if (job := await self.get_job(job_id)) is None:
+            # expired while it sat in the queue
+            await self.conn.lrem(self.processing_key, 0, job_id)
+            return None
+        running_key = self._running_key(job.clone_id)
+        await self.conn.sadd(running_key, job_id)
+        if await self.conn.scard(running_key) > settings.INGESTION_MAX_JOBS_PER_CLONE:
+            async with self.conn.pipeline(transaction=True) as pipe:
+                pipe.srem(running_key, job_id)
+                pipe.lrem(self.processing_key, 0, job_id)
+                pipe.delete(self._lease_key(job_id))
+                pipe.lpush(self.queue_key, job_id)
+                await pipe.execute()
+            # otherwise a queue of only capped jobs would spin
+            await asyncio.sleep(settings.INGESTION_POLL_SECONDS)
+            return None
+        return job
+
+    async def heartbeat(self, job_id: str | uuid.UUID):
+        await self.conn.set(
+            self._lease_key(job_id), 1, ex=settings.INGESTION_LEASE_SECONDS
+        )
+
+    async def release(self, job: schemas.DocumentJob, requeue: bool = False):
+        async with self.conn.pipeline(transaction=True) as pipe:
+            pipe.srem(self._running_key(job.clone_id), str(job.id))
+            pipe.lrem(self.processing_key, 0, str(job.id))
+            pipe.delete(self._lease_key(job.id))
+            if requeue:
+                pipe.lpush(self.queue_key, str(job.id))
+            elif job.status == Status.completed:
+                pipe.delete(self._checkpoint_key(job.id))
+            await pipe.execute()
+
+    async def recover(self) -> int:
+        """Puts jobs whose worker stopped renewing its lease back on the queue."""
+        n = 0
+        for raw in await self.conn.lrange(self.processing_key, 0, -1):
+            job_id = raw.decode()
+            if await self.conn.exists(self._lease_key(job_id)):
+                continue
+            if not await self.conn.lrem(self.processing_key, 0, job_id):
+                # someone else got to it first
+                continue
+            if (job := await self.get_job(job_id)) is not None:
+                await self.conn.srem(self._running_key(job.clone_id), job_id)
+                await self.conn.rpush(self.queue_key, job_id)
+                n += 1
+        return n
+
+
+def embedding_batches(
+    nodes: list[Node], tokenizer: Tokenizer, max_tokens: int
+) -> list[list[Node]]:
+    """Consecutive runs of nodes with at most `max_tokens` tokens each (a longer
+    node gets a batch to itself), so a big document turns into many short
+    embedding calls instead of one that can run into the passage timeout."""
+    lengths = dict(
+        zip([x.id for x in nodes], tokenizer.length_batch([x.content for x in nodes]))
+    )
+    return aggregate_by_length(
+        nodes, max_size=max_tokens, length_fn=lambda x: lengths[x.id]
+    )
+
+
+class IngestionPipeline:
+    """Runs a document ingestion job one stage at a time: split the document into
+    leaf nodes, embed them in token-budgeted batches, summarize them into a tree
+    for tree indexes (embedding the summaries too), then insert the whole thing.
+    After each stage the job and a checkpoint are saved, so a job that was
+    interrupted resumes after its last completed stage."""
+
+    def __init__(
+        self,
+        queue: IngestionQueue,
+        tokenizer: Tokenizer,
+        splitter: TextSplitter,
+        embedding_client: EmbeddingClient,
+        llm_factory: Callable[[AsyncSession, schemas.DocumentJob], LLM],
+    ):
+        self.queue = queue
+        self.tokenizer = tokenizer
+        self.splitter = splitter
+        self.embedding_client = embedding_client
+        self.llm_factory = llm_factory
+
+    async def run(self, job: schemas.DocumentJob):
+        checkpoint = await self.queue.load_checkpoint(job.id)
+        for stage in STAGES[STAGES.index(job.stage) + 1 :]:
+            logger.info(f"Ingestion job {job.id}: running stage {stage.value}")
+            with tracer.start_as_current_span(f"ingestion_{stage.value}"):
+                start = time.perf_counter()
+                checkpoint = await getattr(self, f"_{stage.value}")(job, checkpoint)
+                ingestion_stage_duration.record(
+                    time.perf_counter() - start, attributes=dict(stage=stage.value)
+                )
+            job.stage = stage
+            if stage != STAGES[-1]:
+                await self.queue.save_checkpoint(job.id, checkpoint)
+            await self.queue.save_job(job)
+
+    async def _split(
+        self, job: schemas.DocumentJob, checkpoint: Checkpoint
+    ) -> Checkpoint:
+        index = ListIndex(tokenizer=self.tokenizer, splitter=self.splitter)
+        nodes = await index.abuild(doc=checkpoint.doc)
+        checkpoint.doc.index_type = job.index_type
+        job.num_nodes = len(nodes)
+        return Checkpoint(doc=checkpoint.doc, nodes=nodes)
+
+    async def _embed_nodes(self, job: schemas.DocumentJob, nodes: list[Node]):
+        encoder_name = await self.embedding_client.encoder_name()
+        todo = [x for x in nodes if x.embedding is None]
+        for batch in embedding_batches(
+            todo, self.tokenizer, settings.INGESTION_EMBED_BATCH_TOKENS
+        ):
+            embs = await self.embedding_client.encode_passage(
+                [x.content.strip() for x in batch]
+            )
+            for node, emb in zip(batch, embs):
+                node.embedding = emb
+                node.embedding_model = encoder_name
+            job.num_embedded += len(batch)
+            await self.queue.save_job(job)
+
+    async def _embed(
+        self, job: schemas.DocumentJob, checkpoint: Checkpoint
+    ) -> Checkpoint:
+        await self._embed_nodes(job, checkpoint.nodes)
+        return checkpoint
+
+    async def _summarize(
+        self, job: schemas.DocumentJob, checkpoint: Checkpoint
+    ) -> Checkpoint:
+        if job.index_type != IndexType.tree or len(checkpoint.nodes) <= 1:
+            return checkpoint
+        async with async_session_maker() as db:
+            index = TreeIndex(
+                tokenizer=self.tokenizer,
+                splitter=self.splitter,
+                llm=self.llm_factory(db, job),
+            )
+            nodes = await index.asummarize(doc=checkpoint.doc, nodes=checkpoint.nodes)
+        job.num_nodes = len(nodes)
+        await self._embed_nodes(job, nodes)
+        return Checkpoint(doc=checkpoint.doc, nodes=nodes)
+
+    async def _insert(
+        self, job: schemas.DocumentJob, checkpoint: Checkpoint
+    ) -> Checkpoint:
+        async with async_session_maker() as db:
+            # the worker may have died between committing and saving the stage
+            if await db.scalar(
+                sa.select(models.Document.id).where(
+                    models.Document.id == checkpoint.doc.id
+                )
+            ):
+                return checkpoint
+            clonedb = CreatorCloneDB(
+                db=db,
+                cache=CloneCache(conn=self.queue.conn),
+                tokenizer=self.tokenizer,
+                embedding_client=self.embedding_client,
+                clone_id=job.clone_id,
+            )
+            await clonedb.add_document(doc=checkpoint.doc, nodes=checkpoint.nodes)
+        return checkpoint
+
+
+class IngestionWorker:
+    """Pulls jobs off the queue and runs up to `concurrency` of them at once.
+    Failed jobs are retried from their last completed stage up to
+    INGESTION_MAX_ATTEMPTS times."""
+
+    def __init__(self, pipeline: IngestionPipeline, concurrency: int):
+        self.pipeline = pipeline
+        self.queue = pipeline.queue
+        self.concurrency = concurrency
+        self._stopped = asyncio.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def run(self):
+        await asyncio.gather(
+            self._recover_loop(), *(self._loop() for _ in range(self.concurrency))
+        )
+
+    async def _recover_loop(self):
+        while not self._stopped.is_set():
+            if n := await self.queue.recover():
+                logger.warning(f"Requeued {n} ingestion jobs with expired leases")
+            try:
+                await asyncio.wait_for(
+                    self._stopped.wait(), timeout=settings.INGESTION_LEASE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _loop(self):
+        while not self._stopped.is_set():
+            job = await self.queue.claim(timeout=settings.INGESTION_POLL_SECONDS)
+            if job is not None:
+                await self._process(job)
+
+    async def _heartbeat(self, job: schemas.DocumentJob):
+        while True:
+            await asyncio.sleep(settings.INGESTION_LEASE_SECONDS / 3)
+            await self.queue.heartbeat(job.id)
+
+    async def _process(self, job: schemas.DocumentJob):
+        job.status = Status.running
+        job.attempts += 1
+        job.error = None
+        await self.queue.save_job(job)
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        requeue = False
+        try:
+            await self.pipeline.run(job)
+            job.status = Status.completed
+        except Exception as e:
+            logger.exception(f"Ingestion job {job.id} failed at stage {job.stage}")
+            job.error = e.detail if isinstance(e, HTTPException) else repr(e)
+            # bad requests (e.g. a duplicate document) won't go any better next time
+            requeue = (
+                not isinstance(e, HTTPException)
+                and job.attempts < settings.INGESTION_MAX_ATTEMPTS
+            )
+            job.status = Status.queued if requeue else Status.failed
+        finally:
+            heartbeat.cancel()
+        await self.queue.save_job(job)
+        await self.queue.release(job, requeue=requeue)
+        if not requeue:
+            ingestion_jobs_meter.add(1, attributes=dict(status=job.status.value))
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+from opentelemetry import metrics
+
+from app import models
+from app.settings import settings
+from clonr import templates
+from clonr.llms import LLM
+from clonr.templates import Preamble
+
+meter = metrics.get_meter(settings.BACKEND_APP_NAME)
+
+preamble_cache_hit_meter = meter.create_counter(
+    name="preamble_cache_hits",
+    description="Message prompts built from an already rendered clone preamble, by template",
+)
+
+preamble_cache_miss_meter = meter.create_counter(
+    name="preamble_cache_misses",
+    description="Clone preambles that had to be rendered and tokenized, by template",
+)
+
+# The preamble, context and messages are tokenized apart from each other, and a BPE
+# merge across the seams can make the sum a few tokens off from the whole prompt.
+# This is also plenty to cover the (empty) message section when there are no messages.
+PREAMBLE_SEAM_TOKENS = 8
+
+
+@dataclass(frozen=True)
+class CompiledPreamble:
+    preamble: Preamble
+    num_tokens: int
+
+
+# template name, template version, clone id, clone digest, user name, llm
+PreambleKey = tuple[str, str, uuid.UUID, str, str, str]
+
+MessageTemplate = (
+    type[templates.ZeroMemoryMessageV2] | type[templates.LongTermMemoryMessage]
+)
+
+
+class PreambleCache:
+    """Bounded in-process LRU of rendered clone preambles, with a TTL on every entry.
+
+    Keys carry a digest of the clone fields that get rendered, so an edited clone just
+    stops hitting its old entries. invalidate drops them right away, for the process
+    that made the edit.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[
+            PreambleKey, tuple[float, CompiledPreamble]
+        ] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: PreambleKey) -> CompiledPreamble | None:
+        if (item := self._data.get(key)) is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: PreambleKey, value: CompiledPreamble):
+        self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, clone_id: uuid.UUID):
+        for key in [k for k in self._data if k[2] == clone_id]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+preamble_cache = PreambleCache(
+    max_size=settings.PREAMBLE_CACHE_SIZE,
+    ttl_seconds=settings.PREAMBLE_CACHE_TTL_SECONDS,
+)
+
+
+def compile_preamble(llm: LLM, preamble: Preamble) -> CompiledPreamble:
+    num_tokens = llm.num_tokens(preamble.head) + llm.num_tokens(preamble.tail)
+    return CompiledPreamble(preamble=preamble, num_tokens=num_tokens)
+
+
+def llm_identity(llm: LLM) -> str:
+    return f"{type(llm).__name__}:{getattr(llm, 'model', '')}"
+
+
+def clone_digest(clone: models.Clone) -> str:
+    """Hash of the clone fields the preambles render. Not updated_at, which the
+    message counters bump on every turn."""
+    fields = [
+        clone.name,
+        clone.short_description,
+        clone.long_description,
+        clone.scenario,
+        clone.fixed_dialogues,
+        clone.sys_prompt_header,
+    ]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+def _cached(
+    template: MessageTemplate,
+    clone: models.Clone,
+    user_name: str,
+    llm: LLM,
+    render: Callable[[], Preamble],
+) -> CompiledPreamble:
+    key: PreambleKey = (
+        template.__name__,
+        template.version,
+        clone.id,
+        clone_digest(clone),
+        user_name,
+        llm_identity(llm),
+    )
+    attributes = dict(template=template.__name__)
+    if settings.PREAMBLE_CACHE_ENABLED and (res := preamble_cache.get(key)):
+        preamble_cache_hit_meter.add(1, attributes)
+        return res
+    preamble_cache_miss_meter.add(1, attributes)
+    res = compile_preamble(llm, render())
+    if settings.PREAMBLE_CACHE_ENABLED:
+        preamble_cache.set(key, res)
+    return res
+
+
+def zero_memory_preamble(
+    clone: models.Clone, user_name: str, llm: LLM
+) -> CompiledPreamble:
+    return _cached(
+        templates.ZeroMemoryMessageV2,
+        clone=clone,
+        user_name=user_name,
+        llm=llm,
+        render=lambda: templates.ZeroMemoryMessageV2.render_preamble(
+            char=clone.name,
+            user=user_name,
+            short_description=clone.short_description,
+            long_description=clone.long_description,
+            llm=llm,
+            scenario=clone.scenario,
+            example_dialogues=clone.fixed_dialogues,
+            sys_prompt_header=clone.sys_prompt_header,
+        ),
+    )
+
+
+def long_term_memory_preamble(
+    clone: models.Clone, user_name: str, llm: LLM
+) -> CompiledPreamble:
+    return _cached(
+        templates.LongTermMemoryMessage,
+        clone=clone,
+        user_name=user_name,
+        llm=llm,
+        render=lambda: templates.LongTermMemoryMessage.render_preamble(
+            char=clone.name,
+            user_name=user_name,
+            short_description=clone.short_description,
+            long_description=clone.long_description,
+            llm=llm,
+        ),
+    )
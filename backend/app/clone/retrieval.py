@@ -1,10 +1,15 @@
-from typing import Any, Iterator, TypeVar
+import re
+from typing import Any, Protocol, TypeVar
 
 import numpy as np
 import sqlalchemy as sa
+from pgvector.sqlalchemy import Vector
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from app.embedding import EmbeddingClient
+from app.models import EMBEDDING_DIMENSION
+from app.settings import settings
 from clonr.tokenizer import Tokenizer
 
 from .types import (
@@ -21,11 +26,181 @@ from .types import (
 
 INF = int(1e6)
 DEFAULT_RERANK_FIRST_PASS_MAX_ITEMS = 20
+MAX_EF_SEARCH = 1000  # upper bound enforced by pgvector
+ITERATIVE_SCAN_MIN_PGVECTOR = (0, 8, 0)
+
+# the installed pgvector version, looked up on the first indexed search
+_pgvector_version: tuple[int, ...] | None = None
 
 T = TypeVar("T", bound=VectorSearchable)
 S = TypeVar("S", bound=GenAgentsSearchable)
 
 
+class TokenCounted(Protocol):
+    content: str
+    num_tokens: int | None
+    tokenizer_name: str | None
+
+
+def num_tokens(x: TokenCounted, tokenizer: Tokenizer) -> int:
+    """Token count stored on the row at insert time. Rows counted with a different
+    tokenizer (or from before counts were stored) are tokenized on the spot."""
+    if x.num_tokens is not None and x.tokenizer_name == tokenizer.name:
+        return x.num_tokens
+    return tokenizer.length(x.content)
+
+
+def num_tokens_batch(xs: list[TokenCounted], tokenizer: Tokenizer) -> list[int]:
+    """num_tokens for many rows, with a single batched tokenize for any stale ones."""
+    stale = [
+        i
+        for i, x in enumerate(xs)
+        if x.num_tokens is None or x.tokenizer_name != tokenizer.name
+    ]
+    lengths = [x.num_tokens for x in xs]
+    for i, n in zip(stale, tokenizer.length_batch([xs[i].content for i in stale])):
+        lengths[i] = n
+    return lengths  # type: ignore
+
+
+def _budget_lengths(
+    xs: list[TokenCounted], tokenizer: Tokenizer, max_tokens: int
+) -> list[int]:
+    # unbounded budgets never look at the counts, so don't tokenize anything
+    if max_tokens >= INF:
+        return [0] * len(xs)
+    return num_tokens_batch(xs, tokenizer)
+
+
+def stored_num_tokens(model: Any, tokenizer: Tokenizer) -> sa.ColumnElement[int]:
+    # stale or missing counts are 0 here, so the SQL cutoff can only ever let through
+    # too many rows. The exact budget is still applied in python with num_tokens.
+    return sa.func.coalesce(
+        sa.case((model.tokenizer_name == tokenizer.name, model.num_tokens)), 0
+    )
+
+
+def running_num_tokens(
+    model: Any,
+    tokenizer: Tokenizer,
+    order_by: sa.ColumnElement,
+    overhead: int = 0,
+) -> sa.Over:
+    return sa.func.sum(stored_num_tokens(model, tokenizer) + overhead).over(
+        order_by=order_by, rows=(None, 0)
+    )
+
+
+def select_within_token_budget(
+    model: Any,
+    columns: list[sa.Label],
+    order_by: sa.ColumnElement,
+    limit: int,
+    max_tokens: int,
+    tokenizer: Tokenizer,
+    filters: list[sa.ColumnElement[bool]] | None = None,
+    overhead: int = 0,
+) -> sa.Select:
+    """SELECT model, *columns WHERE filters ORDER BY order_by LIMIT limit, where rows
+    stop coming back once the running total of their stored token counts (plus
+    `overhead` per row) goes over `max_tokens`. The window shares the ORDER BY of the
+    scan, so postgres computes it on the fly and can still use an index for the order.
+    """
+    stmt = sa.select(model, *columns)
+    for f in filters or []:
+        stmt = stmt.where(f)
+    if max_tokens >= INF:
+        return stmt.order_by(order_by).limit(limit)
+
+    running = running_num_tokens(
+        model, tokenizer, order_by=order_by, overhead=overhead
+    ).label("running_tokens")
+    row_number = sa.func.row_number().over(order_by=order_by).label("row_number")
+    sub = (
+        stmt.add_columns(running, row_number).order_by(order_by).limit(limit).subquery()
+    )
+    entity = aliased(model, sub)
+    return (
+        sa.select(entity, *[sub.c[c.name] for c in columns])
+        .where(sub.c.running_tokens <= max_tokens)
+        .order_by(sub.c.row_number)
+    )
+
+
+def _query_vectors(embeddings: list[list[float]]) -> sa.Subquery:
+    # VALUES columns of unknown type resolve to text in postgres, so cast them back to
+    # vectors in a wrapping select before comparing against the embedding column.
+    values = sa.values(
+        sa.column("query_index", sa.Integer),
+        sa.column("embedding", Vector(EMBEDDING_DIMENSION)),
+        name="query_values",
+    ).data(list(enumerate(embeddings)))
+    return sa.select(
+        values.c.query_index,
+        sa.cast(values.c.embedding, Vector(EMBEDDING_DIMENSION)).label("embedding"),
+    ).subquery("queries")
+
+
+def _embedding_column(model: Any, params: VectorSearchParams) -> Any:
+    if not params.hierarchical:
+        return model.embedding
+    if not hasattr(model, "weighted_embedding"):
+        raise TypeError(f"{model.__name__} has no hierarchy-weighted embeddings.")
+    return model.weighted_embedding
+
+
+def parse_version(version: str) -> tuple[int, ...]:
+    return tuple(int(x) for x in re.findall(r"\d+", version)[:3])
+
+
+async def pgvector_version(db: AsyncSession) -> tuple[int, ...]:
+    global _pgvector_version
+    if _pgvector_version is None:
+        version = await db.scalar(
+            sa.text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        )
+        _pgvector_version = parse_version(version or "0")
+    return _pgvector_version
+
+
+async def _configure_hnsw_search(db: AsyncSession, params: VectorSearchParams) -> bool:
+    """Sets ef_search (and iterative scans, where pgvector supports them) for the rest
+    of the transaction. Returns whether iterative scans are on."""
+    # set_config(..., is_local=true) only lasts until the end of the transaction,
+    # and we set it before every indexed search so one query can't leak into the next.
+    # HNSW can return at most ef_search rows, so it has to be at least as big as the limit.
+    ef_search = params.ef_search or settings.HNSW_EF_SEARCH
+    if params.max_items < INF:
+        ef_search = max(ef_search, params.max_items)
+    ef_search = min(ef_search, MAX_EF_SEARCH)
+    configs = [sa.func.set_config("hnsw.ef_search", str(ef_search), True)]
+    # older pgvector reserves the hnsw. prefix, so setting an unknown option errors out
+    iterative = bool(settings.HNSW_ITERATIVE_SCAN) and (
+        await pgvector_version(db) >= ITERATIVE_SCAN_MIN_PGVECTOR
+    )
+    if iterative:
+        configs.append(
+            sa.func.set_config(
+                "hnsw.iterative_scan", settings.HNSW_ITERATIVE_SCAN, True
+            )
+        )
+    await db.execute(sa.select(*configs))
+    return iterative
+
+
+def is_short(lengths: list[int], params: VectorSearchParams) -> bool:
+    """Whether a search came back with fewer rows than it could have. Without
+    iterative scans, HNSW only applies filters to its ef_search candidates, so a
+    selective filter (one clone in a table of many) can leave too few rows. Rows
+    cut by the token budget are fine, which is assumed when another row as big as
+    the biggest one returned wouldn't have fit."""
+    if params.max_items >= INF or len(lengths) >= params.max_items:
+        return False
+    if params.max_tokens >= INF:
+        return True
+    return params.max_tokens - sum(lengths) >= max(lengths, default=0)
+
+
 async def vector_search(
     query: str,
     model: T,
@@ -37,42 +212,87 @@ async def vector_search(
 ) -> list[VectorSearchResult[T]]:
     q = (await embedding_client.encode_query(query))[0]
 
-    if params.metric == MetricType.cosine:
-        dist = model.embedding.cosine_distance(q)
-    elif params.metric == MetricType.euclidean:
-        dist = model.embedding.l2_distance(q)
-    elif params.metric == MetricType.inner_product:
+    if params.metric == MetricType.inner_product:
         assert (
             await embedding_client.is_normalized()
         ), "Cannot user inner product with non-normalized embeddings."
+
+    return await vector_search_by_embedding(
+        embedding=q,
+        model=model,
+        params=params,
+        db=db,
+        tokenizer=tokenizer,
+        filters=filters,
+    )
+
+
+async def vector_search_by_embedding(
+    embedding: list[float],
+    model: T,
+    params: VectorSearchParams,
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    filters: list[sa.SQLColumnExpression] | None = None,
+) -> list[VectorSearchResult[T]]:
+    q = embedding
+    col = _embedding_column(model, params)
+    use_index = False
+
+    if params.metric == MetricType.cosine:
+        dist = col.cosine_distance(q)
+        order_by = dist
+    elif params.metric == MetricType.euclidean:
+        dist = col.l2_distance(q)
+        order_by = dist
+    elif params.metric == MetricType.inner_product:
         # NOTE (Jonny): I have no fucking idea why, but max_inner_product is actually the negative of A \cdot B
         # cosine distance in pgvector is correctly 1 - A \cdot B, so here we have to do 1 + to match it.
-        dist = 1 + model.embedding.max_inner_product(q)
+        dist = 1 + col.max_inner_product(q)
+        # Postgres only uses the HNSW index if we order by the bare operator, `embedding <#> q`.
+        # Ordering by the shifted distance gives the same ranking but forces an exact scan.
+        order_by = dist if params.exact else col.max_inner_product(q)
+        use_index = not params.exact
     else:
         raise TypeError(f"Invalid distance type: ({params.metric})")
 
     dist = dist.label("distance")
 
-    # Order by should be ascending, as we want to minimize distance here
-    stmt = sa.select(model, dist)
+    iterative = False
+    if use_index:
+        iterative = await _configure_hnsw_search(db=db, params=params)
 
-    for f in filters or []:
-        stmt = stmt.where(f)
+    # Order by should be ascending, as we want to minimize distance here
+    stmt = select_within_token_budget(
+        model=model,
+        columns=[dist],
+        order_by=order_by.asc(),
+        limit=params.max_items,
+        max_tokens=params.max_tokens,
+        tokenizer=tokenizer,
+        filters=filters,
+    )
 
-    stmt = stmt.order_by(dist.asc()).limit(params.max_items)
+    rows = (await db.execute(stmt)).all()
+    lengths = _budget_lengths([mdl for mdl, _ in rows], tokenizer, params.max_tokens)
 
-    r = await db.execute(stmt)
+    if use_index and filters and not iterative and is_short(lengths, params):
+        return await vector_search_by_embedding(
+            embedding=embedding,
+            model=model,
+            params=params.model_copy(update=dict(exact=True)),
+            db=db,
+            tokenizer=tokenizer,
+            filters=filters,
+        )
 
     res: list[VectorSearchResult] = []
 
     max_tokens = params.max_tokens  # copy so we don't mess up when using shared params.
 
-    for i, (mdl, scr) in enumerate(r):
+    for i, ((mdl, scr), length) in enumerate(zip(rows, lengths)):
         if max_tokens < INF:
-            # TODO (Jonny) Is this going to be too slow? maybe, tokenizing is expensive.
-            # We should probably save this value, but then the data in the DB will be
-            # wrong if we change tokenizers. such a pain.
-            max_tokens -= tokenizer.length(mdl.content)
+            max_tokens -= length
         if i >= params.max_items or max_tokens < 0:
             break
         cur = VectorSearchResult(model=mdl, distance=scr, metric=params.metric)
@@ -80,6 +300,120 @@ async def vector_search(
     return res
 
 
+async def vector_search_many(
+    queries: list[str],
+    model: T,
+    params: VectorSearchParams,
+    db: AsyncSession,
+    embedding_client: EmbeddingClient,
+    tokenizer: Tokenizer,
+    filters: list[sa.SQLColumnExpression] | None = None,
+) -> list[list[VectorSearchResult[T]]]:
+    """Same as vector_search, but for many queries at once. All queries are embedded in
+    a single gRPC call, and all top-k lists come back from a single statement that
+    runs the per-query search as a LATERAL subquery over a VALUES list of query vectors.
+    The token budget applies to each query's results separately."""
+    if not queries:
+        return []
+
+    embeddings = await embedding_client.encode_query(queries)
+    if params.metric == MetricType.inner_product:
+        assert (
+            await embedding_client.is_normalized()
+        ), "Cannot user inner product with non-normalized embeddings."
+
+    return await vector_search_many_by_embeddings(
+        embeddings=embeddings,
+        model=model,
+        params=params,
+        db=db,
+        tokenizer=tokenizer,
+        filters=filters,
+    )
+
+
+async def vector_search_many_by_embeddings(
+    embeddings: list[list[float]],
+    model: T,
+    params: VectorSearchParams,
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    filters: list[sa.SQLColumnExpression] | None = None,
+) -> list[list[VectorSearchResult[T]]]:
+    q = _query_vectors(embeddings)
+    col = _embedding_column(model, params)
+    use_index = False
+
+    if params.metric == MetricType.cosine:
+        dist = col.cosine_distance(q.c.embedding)
+        order_by = dist
+    elif params.metric == MetricType.euclidean:
+        dist = col.l2_distance(q.c.embedding)
+        order_by = dist
+    elif params.metric == MetricType.inner_product:
+        dist = 1 + col.max_inner_product(q.c.embedding)
+        order_by = dist if params.exact else col.max_inner_product(q.c.embedding)
+        use_index = not params.exact
+    else:
+        raise TypeError(f"Invalid distance type: ({params.metric})")
+
+    iterative = False
+    if use_index:
+        iterative = await _configure_hnsw_search(db=db, params=params)
+
+    top_k = sa.select(
+        model.id.label("id"),
+        dist.label("distance"),
+        running_num_tokens(model, tokenizer, order_by=order_by.asc()).label(
+            "running_tokens"
+        ),
+    )
+    for f in filters or []:
+        top_k = top_k.where(f)
+    top_k = top_k.order_by(order_by.asc())
+    if params.max_items < INF:
+        top_k = top_k.limit(params.max_items)
+    top_k = top_k.correlate(q).lateral("top_k")
+
+    stmt = (
+        sa.select(q.c.query_index, model, top_k.c.distance)
+        .select_from(q)
+        .join(top_k, sa.true())
+        .join(model, model.id == top_k.c.id)
+        .order_by(q.c.query_index, top_k.c.distance.asc())
+    )
+    if params.max_tokens < INF:
+        stmt = stmt.where(top_k.c.running_tokens <= params.max_tokens)
+    rows = (await db.execute(stmt)).all()
+    lengths = _budget_lengths([mdl for _, mdl, _ in rows], tokenizer, params.max_tokens)
+
+    if use_index and filters and not iterative:
+        lengths_by_query: list[list[int]] = [[] for _ in embeddings]
+        for (i, _, _), length in zip(rows, lengths):
+            lengths_by_query[i].append(length)
+        if any(is_short(x, params) for x in lengths_by_query):
+            return await vector_search_many_by_embeddings(
+                embeddings=embeddings,
+                model=model,
+                params=params.model_copy(update=dict(exact=True)),
+                db=db,
+                tokenizer=tokenizer,
+                filters=filters,
+            )
+
+    res: list[list[VectorSearchResult]] = [[] for _ in embeddings]
+    max_tokens = [params.max_tokens for _ in embeddings]
+    for (i, mdl, scr), length in zip(rows, lengths):
+        if max_tokens[i] < 0 or len(res[i]) >= params.max_items:
+            continue
+        if max_tokens[i] < INF:
+            max_tokens[i] -= length
+            if max_tokens[i] < 0:
+                continue
+        res[i].append(VectorSearchResult(model=mdl, distance=scr, metric=params.metric))
+    return res
+
+
 async def rerank_search(
     query: str,
     model: T,
@@ -99,7 +433,12 @@ async def rerank_search(
 
     # Grab the vector search results based on distance first
     first_pass_params = VectorSearchParams(
-        metric=params.metric, max_items=first_pass_max_items, max_tokens=INF
+        metric=params.metric,
+        max_items=first_pass_max_items,
+        max_tokens=INF,
+        ef_search=params.ef_search,
+        exact=params.exact,
+        hierarchical=params.hierarchical,
     )
     vsearch_results = await vector_search(
         query=query,
@@ -124,6 +463,9 @@ async def rerank_search(
     ids = reversed(np.argsort(rerank_scores))
 
     # filter as we did for vector search
+    lengths = _budget_lengths(
+        [x.model for x in vsearch_results], tokenizer, params.max_tokens
+    )
     max_tokens = params.max_tokens
     res: list[ReRankResult] = []
     for i, j in enumerate(ids):
@@ -132,7 +474,7 @@ async def rerank_search(
         if i >= params.max_items or max_tokens < 0:
             break
         if max_tokens < INF:
-            max_tokens -= tokenizer.length(r.model.content)
+            max_tokens -= lengths[j]
         cur = ReRankResult(
             model=r.model, distance=r.distance, metric=params.metric, rerank_score=scr
         )
@@ -140,15 +482,9 @@ async def rerank_search(
     return res
 
 
-async def gen_agents_search(
-    query: str,
-    model: S,
-    params: GenAgentsSearchParams,
-    db: AsyncSession,
-    embedding_client: EmbeddingClient,
-    tokenizer: Tokenizer,
-    filters: list[sa.ColumnElement[Any]] | None = None,
-) -> list[GenAgentsSearchResult[S]]:
+def _gen_agents_scores(
+    model: S, params: GenAgentsSearchParams, q: list[float] | sa.ColumnElement
+) -> tuple[sa.ColumnElement[float], ...]:
     alpha_sum = params.alpha_relevance + params.alpha_importance + params.alpha_recency
     time_decay = 0.5 ** (1 / params.half_life_seconds)  # Eq: gamma^t = 1/2
 
@@ -159,7 +495,6 @@ async def gen_agents_search(
     recency_score = sa.func.pow(time_decay, seconds)
 
     # relevance score
-    q = (await embedding_client.encode_query(query))[0]
     dist = model.embedding.cosine_distance(
         q
     )  # TODO (Jonny): check if inner product is ok
@@ -174,27 +509,51 @@ async def gen_agents_search(
         + params.alpha_recency * recency_score
         + params.alpha_relevance * relevance_score
     ) / alpha_sum
-    gen_agents_score = gen_agents_score.label("gen_agents_score")
+    return gen_agents_score, recency_score, relevance_score, importance_score
 
+
+async def gen_agents_search(
+    query: str,
+    model: S,
+    params: GenAgentsSearchParams,
+    db: AsyncSession,
+    embedding_client: EmbeddingClient,
+    tokenizer: Tokenizer,
+    filters: list[sa.ColumnElement[Any]] | None = None,
+) -> list[GenAgentsSearchResult[S]]:
+    q = (await embedding_client.encode_query(query))[0]
+    (
+        gen_agents_score,
+        recency_score,
+        relevance_score,
+        importance_score,
+    ) = _gen_agents_scores(model=model, params=params, q=q)
     # Order by should be descending, as we want to maximize the score
-    stmt = sa.select(
-        model, gen_agents_score, recency_score, relevance_score, importance_score
+    stmt = select_within_token_budget(
+        model=model,
+        columns=[
+            gen_agents_score.label("gen_agents_score"),
+            recency_score.label("recency_score"),
+            relevance_score.label("relevance_score"),
+            importance_score.label("importance_score"),
+        ],
+        order_by=gen_agents_score.desc(),
+        limit=params.max_items,
+        max_tokens=params.max_tokens,
+        tokenizer=tokenizer,
+        filters=filters,
     )
-    for f in filters or []:
-        stmt = stmt.where(f)
-    stmt = stmt.order_by(gen_agents_score.desc()).limit(params.max_items)
-    result_itr: Iterator[
-        tuple[GenAgentsSearchable, float, float, float, float]
-    ] = await db.execute(
-        stmt
-    )  # type: ignore
+    rows = (await db.execute(stmt)).all()
+    lengths = _budget_lengths([row[0] for row in rows], tokenizer, params.max_tokens)
 
     # filter as we did for vector search
     max_tokens = params.max_tokens
     res: list[GenAgentsSearchResult] = []
-    for i, (x, ga_scr, rec_scr, rel_scr, imp_scr) in enumerate(result_itr):
+    for i, ((x, ga_scr, rec_scr, rel_scr, imp_scr), length) in enumerate(
+        zip(rows, lengths)
+    ):
         if max_tokens < INF:
-            max_tokens -= tokenizer.length(x.content)
+            max_tokens -= length
         if i >= params.max_items or max_tokens < 0:
             break
         cur = GenAgentsSearchResult(
@@ -207,3 +566,83 @@ async def gen_agents_search(
         )
         res.append(cur)
     return res
+
+
+async def gen_agents_search_many(
+    queries: list[str],
+    model: S,
+    params: GenAgentsSearchParams,
+    db: AsyncSession,
+    embedding_client: EmbeddingClient,
+    tokenizer: Tokenizer,
+    filters: list[sa.ColumnElement[Any]] | None = None,
+) -> list[list[GenAgentsSearchResult[S]]]:
+    """Batched gen_agents_search. One embedding call and one LATERAL statement for
+    all queries, with the token budget applied to each query's results separately."""
+    if not queries:
+        return []
+
+    embeddings = await embedding_client.encode_query(queries)
+    q = _query_vectors(embeddings)
+    (
+        gen_agents_score,
+        recency_score,
+        relevance_score,
+        importance_score,
+    ) = _gen_agents_scores(model=model, params=params, q=q.c.embedding)
+
+    top_k = sa.select(
+        model.id.label("id"),
+        gen_agents_score.label("gen_agents_score"),
+        recency_score.label("recency_score"),
+        relevance_score.label("relevance_score"),
+        importance_score.label("importance_score"),
+        running_num_tokens(model, tokenizer, order_by=gen_agents_score.desc()).label(
+            "running_tokens"
+        ),
+    )
+    for f in filters or []:
+        top_k = top_k.where(f)
+    top_k = top_k.order_by(gen_agents_score.desc())
+    if params.max_items < INF:
+        top_k = top_k.limit(params.max_items)
+    top_k = top_k.correlate(q).lateral("top_k")
+
+    stmt = (
+        sa.select(
+            q.c.query_index,
+            model,
+            top_k.c.gen_agents_score,
+            top_k.c.recency_score,
+            top_k.c.relevance_score,
+            top_k.c.importance_score,
+        )
+        .select_from(q)
+        .join(top_k, sa.true())
+        .join(model, model.id == top_k.c.id)
+        .order_by(q.c.query_index, top_k.c.gen_agents_score.desc())
+    )
+    if params.max_tokens < INF:
+        stmt = stmt.where(top_k.c.running_tokens <= params.max_tokens)
+    rows = (await db.execute(stmt)).all()
+    lengths = _budget_lengths([row[1] for row in rows], tokenizer, params.max_tokens)
+
+    res: list[list[GenAgentsSearchResult]] = [[] for _ in queries]
+    max_tokens = [params.max_tokens for _ in queries]
+    for (i, x, ga_scr, rec_scr, rel_scr, imp_scr), length in zip(rows, lengths):
+        if max_tokens[i] < 0 or len(res[i]) >= params.max_items:
+            continue
+        if max_tokens[i] < INF:
+            max_tokens[i] -= length
+            if max_tokens[i] < 0:
+                continue
+        cur = GenAgentsSearchResult(
+            model=x,
+            score=ga_scr,
+            recency_score=rec_scr,
+            relevance_score=rel_scr,
+            importance_score=imp_scr,
+            metric=params.metric,
+        )
+        res[i].append(cur)
+    return res
@@ -30,11 +30,15 @@ class AdaptationStrategy(str, enum.Enum):
 class VectorSearchable(DeclarativeAttributeIntercept):
     embedding: InstrumentedAttribute  # list[float]
     content: str
+    num_tokens: InstrumentedAttribute  # int | None
+    tokenizer_name: InstrumentedAttribute  # str | None
 
 
 class GenAgentsSearchable(DeclarativeAttributeIntercept):
     embedding: InstrumentedAttribute  # list[float]
     content: str
+    num_tokens: InstrumentedAttribute  # int | None
+    tokenizer_name: InstrumentedAttribute  # str | None
     importance: InstrumentedAttribute  # int
     last_accessed_at: datetime.datetime
 
@@ -98,6 +102,19 @@ class VectorSearchParams(BaseModel):
         default=MetricType.inner_product,
         detail="Which metric to use. Inner product is faster, and equal to cosine if all embeddings are normalized (which they should be for us).",
     )
+    ef_search: int | None = Field(
+        default=None,
+        ge=1,
+        detail="Size of the HNSW candidate list at query time. Higher is slower with better recall. Defaults to the server setting, and is never less than max_items.",
+    )
+    exact: bool = Field(
+        default=False,
+        detail="Skip the ANN index and compute exact distances. Useful for tiny clones and for measuring recall.",
+    )
+    hierarchical: bool = Field(
+        default=False,
+        detail="Search by the hierarchy-weighted embeddings (a node plus its decayed parent summaries) instead of the raw ones. Only nodes have these.",
+    )
 
 
 class ReRankSearchParams(VectorSearchParams):
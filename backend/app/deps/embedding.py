@@ -1,6 +1,13 @@
-from app.embedding import EmbeddingClient
+from typing import Annotated
 
+from fastapi import Depends
+from redis.asyncio import Redis
 
-async def get_embedding_client():
-    async with EmbeddingClient() as client:
+from app.embedding import EmbeddingClient, get_embedding_channel
+
+from .db import get_async_redis
+
+
+async def get_embedding_client(conn: Annotated[Redis, Depends(get_async_redis)]):
+    async with EmbeddingClient(cache=conn, channel=get_embedding_channel()) as client:
         yield client
@@ -2,13 +2,21 @@ import os
 import uuid
 from typing import Annotated, AsyncGenerator
 
+import aiohttp
 import sqlalchemy as sa
 from fastapi import Depends, Path
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import models
 from app.settings import settings
-from clonr.llms import LLM, LlamaCpp, MockLLM, OpenAI, OpenAIModelEnum
+from clonr.llms import (
+    LLM,
+    LlamaCpp,
+    MockLLM,
+    OpenAI,
+    OpenAIModelEnum,
+    create_pooled_session,
+)
 from clonr.llms.callbacks import (
     AddToPostgresCallback,
     LLMCallback,
@@ -31,6 +39,28 @@ def is_docker() -> bool:
     return False
 
 
+# process-wide HTTP pool shared by every LLM, opened and closed in the app lifespan
+_llm_session: aiohttp.ClientSession | None = None
+
+
+async def open_llm_session() -> aiohttp.ClientSession:
+    global _llm_session
+    if _llm_session is None or _llm_session.closed:
+        _llm_session = create_pooled_session(
+            limit=settings.LLM_HTTP_POOL_SIZE,
+            limit_per_host=settings.LLM_HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=settings.LLM_HTTP_KEEPALIVE_SECONDS,
+        )
+    return _llm_session
+
+
+async def close_llm_session():
+    global _llm_session
+    if _llm_session is not None:
+        await _llm_session.close()
+        _llm_session = None
+
+
 def _get_llm(
     model_name: str, tokenizer: Tokenizer, callbacks: list[LLMCallback]
 ) -> LLM:
@@ -51,6 +81,7 @@ def _get_llm(
             api_key="",
             tokenizer=tokenizer,
             callbacks=callbacks,
+            session=_llm_session,
         )
     elif model_name == "colab":
         api_base = "<NGROK URL HERE>/v1"
@@ -62,6 +93,7 @@ def _get_llm(
             api_key="none",
             tokenizer=tokenizer,
             callbacks=callbacks,
+            session=_llm_session,
         )
     elif model_name.startswith("gpt"):
         return OpenAI(
@@ -69,6 +101,7 @@ def _get_llm(
             api_key=settings.OPENAI_API_KEY,
             tokenizer=tokenizer,
             callbacks=callbacks,
+            session=_llm_session,
         )
     else:
         raise ValueError("Invalid model name:" + model_name)
@@ -1,12 +1,207 @@
+import asyncio
+import hashlib
 import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 
 import grpc
+import numpy as np
 from loguru import logger
+from opentelemetry import metrics
+from redis.asyncio import Redis
 from tenacity import after_log, before_log, retry, stop_after_attempt, wait_exponential
 
 from app.settings import settings
 from pb import embed_pb2, embed_pb2_grpc
 
+meter = metrics.get_meter(settings.BACKEND_APP_NAME)
+
+embedding_cache_hit_meter = meter.create_counter(
+    name="embedding_cache_hits",
+    description="Number of embeddings served from the embedding cache, by tier",
+)
+
+embedding_cache_miss_meter = meter.create_counter(
+    name="embedding_cache_misses",
+    description="Number of embeddings that had to be computed by the embedding server",
+)
+
+
+class EmbeddingCache:
+    """Bounded in-process LRU of float32 embeddings with a TTL on every entry."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> np.ndarray | None:
+        if (item := self._data.get(key)) is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: np.ndarray):
+        self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+# Shared by every client in the process, since clients only live for a single request.
+embedding_cache = EmbeddingCache(
+    max_size=settings.EMBEDDING_CACHE_SIZE,
+    ttl_seconds=settings.EMBEDDING_CACHE_TTL_SECONDS,
+)
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def embedding_cache_key(encoder_name: str, mode: str, text: str) -> str:
+    digest = hashlib.sha256(_normalize_text(text).encode()).hexdigest()
+    return f"embedding::{encoder_name}::{mode}::{digest}"
+
+
+PACKED_DTYPES = {
+    embed_pb2.FLOAT32: np.dtype("<f4"),
+    embed_pb2.FLOAT16: np.dtype("<f2"),
+}
+
+
+def unpack_embeddings(r: embed_pb2.PackedEmbeddingResponse) -> np.ndarray:
+    arr = np.frombuffer(r.data, dtype=PACKED_DTYPES[r.dtype]).reshape(tuple(r.shape))
+    return arr.astype(np.float32, copy=False)
+
+
+@dataclass(frozen=True)
+class EncoderInfo:
+    name: str
+    dimension: int
+    is_normalized: bool
+
+
+def embedding_target() -> str:
+    if settings.EMBEDDINGS_GRPC_TARGET:
+        return settings.EMBEDDINGS_GRPC_TARGET
+    # the dns resolver returns every replica behind the host, e.g. a headless service
+    return f"dns:///{settings.EMBEDDINGS_GRPC_HOST}:{settings.EMBEDDINGS_GRPC_PORT}"
+
+
+class EmbeddingChannel:
+    """A long-lived gRPC channel to the embedding server(s).
+
+    Every request multiplexes over the same HTTP/2 connections, and with several
+    replicas behind the target the calls are round-robined between them. The encoder
+    metadata is fetched once and refetched whenever the channel reconnects, in case
+    it came back up pointing at a different model.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        timeout: float = settings.EMBEDDING_TIMEOUT_SECONDS,
+        passage_timeout: float = settings.EMBEDDING_PASSAGE_TIMEOUT_SECONDS,
+        keepalive_seconds: int = settings.EMBEDDING_KEEPALIVE_SECONDS,
+    ):
+        self.target = target
+        self.timeout = timeout
+        self.passage_timeout = passage_timeout
+        self.keepalive_seconds = keepalive_seconds
+        self._info: EncoderInfo | None = None
+        # flipped off the first time the server says it has no packed RPCs
+        self.packed = True
+        self._watcher: asyncio.Task | None = None
+
+    async def open(self):
+        options = [
+            ("grpc.lb_policy_name", "round_robin"),
+            ("grpc.keepalive_time_ms", 1000 * self.keepalive_seconds),
+            ("grpc.keepalive_timeout_ms", 10_000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+        self.channel = grpc.aio.insecure_channel(self.target, options=options)
+        self.stub = embed_pb2_grpc.EmbedStub(self.channel)
+        self._watcher = asyncio.create_task(self._watch_connectivity())
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        await self.channel.close()
+
+    async def _watch_connectivity(self):
+        state = self.channel.get_state(try_to_connect=True)
+        while True:
+            await self.channel.wait_for_state_change(state)
+            new_state = self.channel.get_state()
+            if (
+                new_state == grpc.ChannelConnectivity.READY
+                and state != grpc.ChannelConnectivity.READY
+            ):
+                self._info = None
+                self.packed = True
+            state = new_state
+
+    async def encoder_info(self) -> EncoderInfo:
+        if self._info is not None:
+            return self._info
+        request = embed_pb2.Empty()
+        try:
+            r = await self.stub.GetEncoderInfo(request=request, timeout=self.timeout)
+            info = EncoderInfo(
+                name=r.name, dimension=r.dimension, is_normalized=r.is_normalized
+            )
+        except grpc.aio.AioRpcError as e:
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                raise
+            # older embedding servers don't have GetEncoderInfo
+            name = await self.stub.GetEncoderName(request=request, timeout=self.timeout)
+            norm = await self.stub.IsNormalized(request=request, timeout=self.timeout)
+            info = EncoderInfo(
+                name=name.name,
+                dimension=settings.EMBEDDING_DIMENSION,
+                is_normalized=norm.is_normalized,
+            )
+        self._info = info
+        return info
+
+
+# process-wide channel, opened and closed in the app lifespan
+_embedding_channel: EmbeddingChannel | None = None
+
+
+async def open_embedding_channel() -> EmbeddingChannel:
+    global _embedding_channel
+    if _embedding_channel is None:
+        _embedding_channel = EmbeddingChannel(target=embedding_target())
+        await _embedding_channel.open()
+    return _embedding_channel
+
+
+async def close_embedding_channel():
+    global _embedding_channel
+    if _embedding_channel is not None:
+        await _embedding_channel.close()
+        _embedding_channel = None
+
+
+def get_embedding_channel() -> EmbeddingChannel | None:
+    return _embedding_channel
+
 
 # TODO (Jonny): switch to multilingual model!
 class EmbeddingClient:
@@ -14,49 +209,162 @@ class EmbeddingClient:
         self,
         port: int = settings.EMBEDDINGS_GRPC_PORT,
         host: str = settings.EMBEDDINGS_GRPC_HOST,
+        cache: Redis | None = None,
+        use_cache: bool = settings.EMBEDDING_CACHE_ENABLED,
+        channel: EmbeddingChannel | None = None,
     ):
         self.port = port
         self.host = host
-        self.addr = f"{host}:{port}"
+        self.addr = channel.target if channel else f"{host}:{port}"
+        self.cache = cache
+        self.use_cache = use_cache
+        # without a shared channel, the client opens (and closes) its own
+        self._owns_channel = channel is None
+        if channel is not None:
+            self.channel = channel
 
     async def __aenter__(self):
-        self.channel = grpc.aio.insecure_channel(self.addr)
-        self.stub = embed_pb2_grpc.EmbedStub(self.channel)
+        if self._owns_channel:
+            self.channel = EmbeddingChannel(target=self.addr)
+            await self.channel.open()
         return self
 
     async def __aexit__(self, *args, **kwargs):
-        await self.channel.close()
+        if self._owns_channel:
+            await self.channel.close()
+
+    @property
+    def stub(self) -> embed_pb2_grpc.EmbedStub:
+        return self.channel.stub
+
+    async def _encode(self, text: list[str], mode: str, timeout: float) -> np.ndarray:
+        if self.channel.packed:
+            rpc = (
+                self.stub.EncodeQueriesPacked
+                if mode == "query"
+                else self.stub.EncodePassagesPacked
+            )
+            dtype = embed_pb2.Dtype.Value(settings.EMBEDDING_PACKED_DTYPE.upper())
+            request = embed_pb2.PackedEncodeRequest(text=text, dtype=dtype)
+            try:
+                return unpack_embeddings(await rpc(request=request, timeout=timeout))
+            except grpc.aio.AioRpcError as e:
+                if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                    raise
+                logger.warning(
+                    f"Embedding server at {self.addr} has no packed RPCs, "
+                    "falling back to repeated floats"
+                )
+                self.channel.packed = False
+        if mode == "query":
+            r = await self.stub.EncodeQueries(
+                request=embed_pb2.EncodeQueryRequest(text=text), timeout=timeout
+            )
+        else:
+            r = await self.stub.EncodePassages(
+                request=embed_pb2.EncodePassageRequest(text=text), timeout=timeout
+            )
+        return np.array([x.embedding for x in r.embeddings], dtype=np.float32)
+
+    async def _encode_queries(self, text: list[str]) -> np.ndarray:
+        return await self._encode(text, mode="query", timeout=self.channel.timeout)
+
+    async def _redis_get(self, keys: list[str]) -> list[np.ndarray | None]:
+        if self.cache is None or not keys:
+            return [None] * len(keys)
+        try:
+            values = await self.cache.mget(keys)
+        except Exception as e:
+            logger.warning(f"Embedding cache read failed: {e}")
+            return [None] * len(keys)
+        return [
+            None if v is None else np.frombuffer(v, dtype=np.float32) for v in values
+        ]
+
+    async def _redis_set(self, items: dict[str, np.ndarray]):
+        if self.cache is None or not items:
+            return
+        try:
+            async with self.cache.pipeline(transaction=False) as pipe:
+                for k, v in items.items():
+                    pipe.set(k, v.tobytes(), ex=settings.EMBEDDING_CACHE_TTL_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+
+    async def _cached_encode_queries(self, text: list[str]) -> list[np.ndarray]:
+        mode = "query"
+        encoder_name = await self.encoder_name()
+        keys = [embedding_cache_key(encoder_name, mode, t) for t in text]
+        embeddings: list[np.ndarray | None] = [embedding_cache.get(k) for k in keys]
+
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        embedding_cache_hit_meter.add(
+            amount=len(text) - len(missing), attributes=dict(tier="local", mode=mode)
+        )
+
+        if missing:
+            remote = await self._redis_get([keys[i] for i in missing])
+            for i, e in zip(missing, remote):
+                if e is not None:
+                    embeddings[i] = e
+                    embedding_cache.set(keys[i], e)
+            n_remote_hits = sum(e is not None for e in remote)
+            embedding_cache_hit_meter.add(
+                amount=n_remote_hits, attributes=dict(tier="redis", mode=mode)
+            )
+            missing = [i for i in missing if embeddings[i] is None]
+
+        if missing:
+            embedding_cache_miss_meter.add(
+                amount=len(missing), attributes=dict(mode=mode)
+            )
+            # duplicate texts within a batch only need to be encoded once
+            unique_keys = list(dict.fromkeys(keys[i] for i in missing))
+            key_to_text = {keys[i]: text[i] for i in missing}
+            computed = await self._encode_queries([key_to_text[k] for k in unique_keys])
+            new_items = dict(zip(unique_keys, computed))
+            for k, e in new_items.items():
+                embedding_cache.set(k, e)
+            for i in missing:
+                embeddings[i] = new_items[keys[i]]
+            await self._redis_set(new_items)
+
+        return embeddings  # type: ignore
 
     async def encode_query(self, text: str | list[str]) -> list[list[float]]:
         if isinstance(text, str):
             text = [text]
-        request = embed_pb2.EncodeQueryRequest(text=text)
-        r = await self.stub.EncodeQueries(request=request)
-        embedding = [[y for y in x.embedding] for x in r.embeddings]
-        return embedding
+        if self.use_cache:
+            embeddings = await self._cached_encode_queries(text)
+        else:
+            embeddings = await self._encode_queries(text)
+        return [x.tolist() for x in embeddings]
 
     async def encode_passage(self, text: str | list[str]) -> list[list[float]]:
         if isinstance(text, str):
             text = [text]
-        request = embed_pb2.EncodePassageRequest(text=text)
-        r = await self.stub.EncodePassages(request=request)
-        embedding = [[y for y in x.embedding] for x in r.embeddings]
-        return embedding
+        embeddings = await self._encode(
+            text, mode="passage", timeout=self.channel.passage_timeout
+        )
+        return embeddings.tolist()
 
     async def rerank_score(self, query: str, passages: list[str]) -> list[float]:
         request = embed_pb2.RankingScoreRequest(query=query, passages=passages)
-        r = await self.stub.GetRankingScores(request=request)
+        r = await self.stub.GetRankingScores(
+            request=request, timeout=self.channel.timeout
+        )
         return [x for x in r.scores]
 
+    # these are cached on the channel, so they're free after the first call
     async def is_normalized(self) -> bool:
-        request = embed_pb2.Empty()
-        response = await self.stub.IsNormalized(request=request)
-        return response.is_normalized
+        return (await self.channel.encoder_info()).is_normalized
 
     async def encoder_name(self) -> str:
-        request = embed_pb2.Empty()
-        response = await self.stub.GetEncoderName(request=request)
-        return response.name
+        return (await self.channel.encoder_info()).name
+
+    async def dimension(self) -> int:
+        return (await self.channel.encoder_info()).dimension
 
 
 @retry(
@@ -65,7 +373,7 @@ class EmbeddingClient:
     before=before_log(logger, logging.INFO),  # type: ignore
     after=after_log(logger, logging.WARN),  # type: ignore
 )
-async def wait_for_embedding():
-    async with EmbeddingClient() as client:
+async def wait_for_embedding() -> EncoderInfo:
+    async with EmbeddingClient(channel=get_embedding_channel()) as client:
         logger.info(f"Attempting to connect to gRPC server at addr: {client.addr}")
-        return await client.encoder_name()
+        return await client.channel.encoder_info()
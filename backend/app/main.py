@@ -12,7 +12,12 @@ from opentelemetry import metrics
 
 from app import api
 from app.db import clear_db, create_superuser, init_db, wait_for_db, wait_for_redis
-from app.embedding import wait_for_embedding
+from app.deps.llm import close_llm_session, open_llm_session
+from app.embedding import (
+    close_embedding_channel,
+    open_embedding_channel,
+    wait_for_embedding,
+)
 from app.middleware.rate_limiter import IpAddrRateLimitMiddleware
 from app.middleware.tracing import setup_tracing
 from app.settings import settings
@@ -64,8 +69,14 @@ async def lifespan(app: FastAPI):
     await wait_for_redis()
 
     logger.info("Waiting for Embedding gRPC server...")
-    name = await wait_for_embedding()
-    logger.info(f"gRPC server up and running with model: {name}")
+    await open_embedding_channel()
+    info = await wait_for_embedding()
+    logger.info(f"gRPC server up and running with model: {info}")
+    if info.dimension != settings.EMBEDDING_DIMENSION:
+        raise ValueError(
+            f"Embedding server dimension ({info.dimension}) does not match "
+            f"EMBEDDING_DIMENSION ({settings.EMBEDDING_DIMENSION})."
+        )
 
     if settings.USE_ALEMBIC:
         logger.info("Running migration upgrades")
@@ -83,8 +94,14 @@ async def lifespan(app: FastAPI):
             )
         )
 
+    logger.info("Opening LLM connection pool")
+    await open_llm_session()
+
     yield
 
+    await close_llm_session()
+    await close_embedding_channel()
+
     if settings.USE_ALEMBIC:
         logger.warning("Running migration downgrades")
         await run_async_downgrade()
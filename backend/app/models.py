@@ -10,8 +10,16 @@ from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+from app.settings import settings
 from clonr.utils.formatting import DateFormat
 
+# HNSW indexes require a fixed dimension on the column, so every embedding column
+# is typed with the dimension of the embedding model we serve.
+EMBEDDING_DIMENSION = settings.EMBEDDING_DIMENSION
+HNSW_INDEX_PARAMS = dict(
+    m=settings.HNSW_M, ef_construction=settings.HNSW_EF_CONSTRUCTION
+)
+
 
 class CaseInsensitiveComparator(Comparator[str]):
     # taken from https://docs.sqlalchemy.org/en/20/orm/extensions/hybrid.html#building-custom-comparators
@@ -57,7 +65,10 @@ class CaseInsensitiveComparator(Comparator[str]):
 
 
 class Base(DeclarativeBase):
-    type_annotation_map = {list[float]: Vector, dict[str, Any]: JSON}
+    type_annotation_map = {
+        list[float]: Vector(EMBEDDING_DIMENSION),
+        dict[str, Any]: JSON,
+    }
 
 
 class CommonMixin:
@@ -314,6 +325,16 @@ ix_clones_case_insensitive_name = sa.Index(
     postgresql_ops={"name": "gin_trgm_ops"},
 )
 
+# all of our search paths use max_inner_product (embeddings are normalized),
+# so the ANN indexes are built with ip ops. Cosine queries fall back to exact search.
+ix_clones_embedding_hnsw = sa.Index(
+    "ix_clones_embedding_hnsw",
+    Clone.embedding,
+    postgresql_using="hnsw",
+    postgresql_with=HNSW_INDEX_PARAMS,
+    postgresql_ops={"embedding": "vector_ip_ops"},
+)
+
 
 class Conversation(CommonMixin, Base):
     __tablename__ = "conversations"
@@ -433,6 +454,9 @@ class Message(CommonMixin, Base):
     )
     embedding: Mapped[list[float]] = mapped_column(nullable=True)
     embedding_model: Mapped[str] = mapped_column(nullable=True)
+    # token count of content, only valid for the tokenizer that produced it
+    num_tokens: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokenizer_name: Mapped[Optional[str]] = mapped_column(nullable=True)
     parent_id: Mapped[uuid.UUID] = mapped_column(
         sa.ForeignKey("messages.id"), nullable=True
     )
@@ -551,7 +575,14 @@ class Node(CommonMixin, Base):
     content: Mapped[str]
     context: Mapped[Optional[str]] = mapped_column(nullable=True)
     embedding: Mapped[list[float]]
+    # embedding plus the decayed embeddings of its parents, see
+    # hierarchical_embeddings in app.clone.db. Equal to embedding for non-tree docs.
+    weighted_embedding: Mapped[Optional[list[float]]] = mapped_column(
+        nullable=True, deferred=True
+    )
     embedding_model: Mapped[str]
+    num_tokens: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokenizer_name: Mapped[Optional[str]] = mapped_column(nullable=True)
     is_leaf: Mapped[bool]  # Note (Jonny): isn't this redundant with depth?
     depth: Mapped[int]
     parent_id: Mapped[uuid.UUID] = mapped_column(
@@ -582,6 +613,26 @@ class Node(CommonMixin, Base):
         return f"{name}(id={str(self.id)}, index={self.index}, content={content})"
 
 
+# Retrieval always filters on clone_id. HNSW applies the filter after the graph scan,
+# so for small clones the planner should instead pick the btree and do an exact scan
+# over that clone's rows. This keeps recall at 100% where it would otherwise suffer most.
+ix_nodes_clone_id = sa.Index("ix_nodes_clone_id", Node.clone_id)
+ix_nodes_embedding_hnsw = sa.Index(
+    "ix_nodes_embedding_hnsw",
+    Node.embedding,
+    postgresql_using="hnsw",
+    postgresql_with=HNSW_INDEX_PARAMS,
+    postgresql_ops={"embedding": "vector_ip_ops"},
+)
+ix_nodes_weighted_embedding_hnsw = sa.Index(
+    "ix_nodes_weighted_embedding_hnsw",
+    Node.weighted_embedding,
+    postgresql_using="hnsw",
+    postgresql_with=HNSW_INDEX_PARAMS,
+    postgresql_ops={"weighted_embedding": "vector_ip_ops"},
+)
+
+
 class ExampleDialogue(CommonMixin, Base):
     __tablename__ = "example_dialogues"
 
@@ -648,6 +699,8 @@ class Monologue(CommonMixin, Base):
     hash: Mapped[str]
     embedding: Mapped[list[float]]
     embedding_model: Mapped[str]
+    num_tokens: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokenizer_name: Mapped[Optional[str]] = mapped_column(nullable=True)
     clone_id: Mapped[uuid.UUID] = mapped_column(
         sa.ForeignKey("clones.id", ondelete="cascade"), nullable=False
     )
@@ -662,6 +715,16 @@ class Monologue(CommonMixin, Base):
         return f"{name}(source={self.source}, content={content})"
 
 
+ix_monologues_clone_id = sa.Index("ix_monologues_clone_id", Monologue.clone_id)
+ix_monologues_embedding_hnsw = sa.Index(
+    "ix_monologues_embedding_hnsw",
+    Monologue.embedding,
+    postgresql_using="hnsw",
+    postgresql_with=HNSW_INDEX_PARAMS,
+    postgresql_ops={"embedding": "vector_ip_ops"},
+)
+
+
 memory_to_memory = sa.Table(
     "memory_to_memory",
     Base.metadata,
@@ -677,6 +740,8 @@ class Memory(CommonMixin, Base):
     content: Mapped[str]
     embedding: Mapped[list[float]]
     embedding_model: Mapped[str]
+    num_tokens: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokenizer_name: Mapped[Optional[str]] = mapped_column(nullable=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(sa.DateTime(timezone=True))
     last_accessed_at: Mapped[datetime.datetime] = mapped_column(
         sa.DateTime(timezone=True),
@@ -715,6 +780,18 @@ class Memory(CommonMixin, Base):
         )
 
 
+ix_memories_clone_id_conversation_id = sa.Index(
+    "ix_memories_clone_id_conversation_id", Memory.clone_id, Memory.conversation_id
+)
+ix_memories_embedding_hnsw = sa.Index(
+    "ix_memories_embedding_hnsw",
+    Memory.embedding,
+    postgresql_using="hnsw",
+    postgresql_with=HNSW_INDEX_PARAMS,
+    postgresql_ops={"embedding": "vector_ip_ops"},
+)
+
+
 class AgentSummary(CommonMixin, Base):
     __tablename__ = "agent_summaries"
 
@@ -16,6 +16,7 @@ from pydantic import (
 )
 
 from app.clone.types import AdaptationStrategy, InformationStrategy, MemoryStrategy
+from clonr.data_structures import IndexType
 from clonr.utils import get_current_datetime
 
 
@@ -287,6 +288,55 @@ class Document(CommonMixin, DocumentCreate):
     clone_id: uuid.UUID
 
 
+def ingestion_index_type_validator(v: IndexType, info: ValidationInfo) -> IndexType:
+    if v not in (IndexType.list, IndexType.tree):
+        raise ValueError(f"Index type {v.value} is not supported for ingestion.")
+    return v
+
+
+class DocumentJobCreate(DocumentCreate):
+    index_type: Annotated[
+        IndexType, AfterValidator(ingestion_index_type_validator)
+    ] = Field(
+        default=IndexType.list,
+        description="The type of index to build. Tree indexes summarize the document with an LLM.",
+    )
+
+
+class DocumentJobStatus(str, Enum):
+    queued: str = "queued"
+    running: str = "running"
+    completed: str = "completed"
+    failed: str = "failed"
+
+
+# in the order they run. A job records the last one it finished, and resumes after it
+class DocumentJobStage(str, Enum):
+    created: str = "created"
+    split: str = "split"
+    embed: str = "embed"
+    summarize: str = "summarize"
+    insert: str = "insert"
+
+
+class DocumentJob(BaseModel):
+    id: uuid.UUID
+    clone_id: uuid.UUID
+    user_id: uuid.UUID
+    document_id: uuid.UUID
+    index_type: IndexType
+    status: DocumentJobStatus = DocumentJobStatus.queued
+    stage: DocumentJobStage = Field(
+        default=DocumentJobStage.created, description="The last completed stage"
+    )
+    num_nodes: int | None = None
+    num_embedded: int = 0
+    attempts: int = 0
+    error: str | None = None
+    created_at: datetime.datetime = Field(default_factory=get_current_datetime)
+    updated_at: datetime.datetime = Field(default_factory=get_current_datetime)
+
+
 class DocumentSuggestion(BaseModel):
     title: str = Field(
         description="The title of the found page. Often will be the character name."
@@ -34,6 +34,13 @@ class Settings(BaseSettings):
     # Network
     EMBEDDINGS_GRPC_HOST: str
     EMBEDDINGS_GRPC_PORT: int
+    # e.g. ipv4:10.0.0.1:50051,10.0.0.2:50051. Defaults to dns:///host:port
+    EMBEDDINGS_GRPC_TARGET: str | None = None
+    EMBEDDING_TIMEOUT_SECONDS: float = 10
+    EMBEDDING_PASSAGE_TIMEOUT_SECONDS: float = 120
+    EMBEDDING_KEEPALIVE_SECONDS: int = 30
+    # float32 | float16, wire format of the packed Encode*Packed RPCs
+    EMBEDDING_PACKED_DTYPE: str = "float32"
     OTEL_EXPORTER_OTLP_ENDPOINT: str
 
     # Backend
@@ -46,9 +53,50 @@ class Settings(BaseSettings):
     USE_ALEMBIC: bool = False
     BACKEND_APP_NAME: str = "clonr.server"
 
+    # Vector search
+    EMBEDDING_DIMENSION: int = 384  # intfloat/e5-small-v2
+    HNSW_M: int = 16
+    HNSW_EF_CONSTRUCTION: int = 64
+    HNSW_EF_SEARCH: int = 40
+    # relaxed_order | strict_order | None. Only applied on pgvector>=0.8, which keeps
+    # scanning the index until filtered searches (by clone) have enough rows. Older
+    # versions retry a short filtered search with an exact scan instead.
+    HNSW_ITERATIVE_SCAN: str | None = "strict_order"
+
+    # Embedding cache
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_SIZE: int = 4096
+    EMBEDDING_CACHE_TTL_SECONDS: int = 60 * 60
+
+    # Rendered and tokenized clone preambles (the static parts of message prompts)
+    PREAMBLE_CACHE_ENABLED: bool = True
+    PREAMBLE_CACHE_SIZE: int = 1024
+    PREAMBLE_CACHE_TTL_SECONDS: int = 60 * 60
+
+    # Retrieval stages during message generation, skipped if they run over
+    RETRIEVAL_MONOLOGUES_TIMEOUT_SECONDS: float = 3
+    RETRIEVAL_FACTS_TIMEOUT_SECONDS: float = 2
+    RETRIEVAL_MEMORIES_TIMEOUT_SECONDS: float = 2
+
+    # Conversation hot state cache (recent messages and summaries)
+    CONVERSATION_CACHE_NUM_MESSAGES: int = 64
+    CONVERSATION_CACHE_TTL_SECONDS: int = 60 * 60
+
+    # Document ingestion jobs, run by the worker (python -m app.worker)
+    INGESTION_WORKER_CONCURRENCY: int = 4
+    INGESTION_MAX_JOBS_PER_CLONE: int = 2
+    INGESTION_MAX_ATTEMPTS: int = 3
+    INGESTION_EMBED_BATCH_TOKENS: int = 8192
+    INGESTION_LEASE_SECONDS: int = 60
+    INGESTION_POLL_SECONDS: float = 5
+    INGESTION_JOB_TTL_SECONDS: int = 60 * 60 * 24 * 7
+
     # LLMs
     OPENAI_API_KEY: str
     LLM: str
+    LLM_HTTP_POOL_SIZE: int = 100
+    LLM_HTTP_POOL_SIZE_PER_HOST: int = 32
+    LLM_HTTP_KEEPALIVE_SECONDS: int = 60
 
     # Misc
     DEV: bool
@@ -0,0 +1,89 @@
+"""Document ingestion worker. Runs the jobs queued by the /clones/{clone_id}/documents/jobs
+endpoint, see app.clone.ingestion.
+
+    python -m app.worker
+"""
+import asyncio
+import signal
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas
+from app.clone.ingestion import IngestionPipeline, IngestionQueue, IngestionWorker
+from app.clone.shared import SHARED_DYNAMIC_SPLITTER, SHARED_TOKENIZER
+from app.db import wait_for_db, wait_for_redis
+from app.db.cache import redis_connection
+from app.deps.llm import _get_llm, close_llm_session, open_llm_session
+from app.embedding import (
+    EmbeddingClient,
+    close_embedding_channel,
+    get_embedding_channel,
+    open_embedding_channel,
+    wait_for_embedding,
+)
+from app.settings import settings
+from clonr.llms import LLM
+from clonr.llms.callbacks import (
+    AddToPostgresCallback,
+    LoggingCallback,
+    OTLPMetricsCallback,
+)
+
+
+def create_llm(db: AsyncSession, job: schemas.DocumentJob) -> LLM:
+    callbacks = [
+        LoggingCallback(),
+        AddToPostgresCallback(
+            db=db, clone_id=job.clone_id, user_id=job.user_id, conversation_id=None
+        ),
+        OTLPMetricsCallback(
+            clone_id=job.clone_id, user_id=job.user_id, conversation_id=None
+        ),
+    ]
+    return _get_llm(
+        model_name=settings.LLM, tokenizer=SHARED_TOKENIZER, callbacks=callbacks
+    )
+
+
+async def main():
+    logger.info("Waiting for db...")
+    await wait_for_db()
+    logger.info("Waiting for redis...")
+    await wait_for_redis()
+    logger.info("Waiting for Embedding gRPC server...")
+    await open_embedding_channel()
+    await wait_for_embedding()
+    await open_llm_session()
+
+    conn = redis_connection()
+    try:
+        async with EmbeddingClient(
+            cache=conn, channel=get_embedding_channel()
+        ) as embedding_client:
+            pipeline = IngestionPipeline(
+                queue=IngestionQueue(conn=conn),
+                tokenizer=SHARED_TOKENIZER,
+                splitter=SHARED_DYNAMIC_SPLITTER,
+                embedding_client=embedding_client,
+                llm_factory=create_llm,
+            )
+            worker = IngestionWorker(
+                pipeline=pipeline, concurrency=settings.INGESTION_WORKER_CONCURRENCY
+            )
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                # jobs in flight finish, anything cut short is resumed by the next worker
+                loop.add_signal_handler(sig, worker.stop)
+            logger.info(
+                f"Ingestion worker running {settings.INGESTION_WORKER_CONCURRENCY} jobs at a time"
+            )
+            await worker.run()
+    finally:
+        await conn.close()
+        await close_llm_session()
+        await close_embedding_channel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""Time to insert a large document through the ORM versus COPY.
+
+Run from the backend directory against a database with at least one clone:
+
+    python -m benchmarks.bulk_insert --num-nodes 10000 --repeats 3
+
+Each run inserts a synthetic tree document (leaves with one summary parent per
+`--group-size` leaves) and is rolled back afterwards, so nothing is left behind.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.clone.db import _insert_document, count_tokens
+from app.db.db import async_session_maker
+from app.settings import settings
+from clonr.data_structures import Document, Node
+from clonr.tokenizer import Tokenizer
+
+
+def make_document(num_nodes: int, group_size: int) -> tuple[Document, list[Node]]:
+    doc = Document(
+        content="benchmark",
+        name="bulk insert benchmark",
+        index_type="tree",
+        embedding=[0.0] * settings.EMBEDDING_DIMENSION,
+        embedding_model="benchmark",
+    )
+    embs = np.random.normal(size=(num_nodes, settings.EMBEDDING_DIMENSION))
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+    num_parents = num_nodes // (group_size + 1)
+    nodes: list[Node] = []
+    for i in range(num_parents):
+        nodes.append(
+            Node(
+                index=i,
+                content=f"summary {i} " + "lorem ipsum " * 20,
+                is_leaf=False,
+                depth=1,
+                document_id=doc.id,
+            )
+        )
+    for i in range(num_nodes - num_parents):
+        parent = nodes[i % num_parents] if num_parents else None
+        nodes.append(
+            Node(
+                index=i,
+                content=f"chunk {i} " + "lorem ipsum " * 60,
+                is_leaf=True,
+                depth=0,
+                parent_id=parent.id if parent else None,
+                document_id=doc.id,
+            )
+        )
+    for node, emb in zip(nodes, embs):
+        node.embedding = emb.tolist()
+        node.embedding_model = "benchmark"
+    return doc, nodes
+
+
+async def insert_orm(
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID,
+    doc: Document,
+    nodes: list[Node],
+):
+    # what CreatorCloneDB.add_document used to do
+    doc_model = models.Document(
+        id=doc.id,
+        content=doc.content,
+        hash=doc.hash,
+        name=doc.name,
+        index_type=doc.index_type,
+        embedding=doc.embedding,
+        embedding_model=doc.embedding_model,
+        clone_id=clone_id,
+    )
+    num_tokens = count_tokens(tokenizer, [x.content.strip() for x in nodes])
+    node_models = {
+        node.id: models.Node(
+            id=node.id,
+            index=node.index,
+            content=node.content.strip(),
+            embedding=node.embedding,
+            embedding_model=node.embedding_model,
+            num_tokens=n_tokens,
+            tokenizer_name=tokenizer.name,
+            is_leaf=node.is_leaf,
+            depth=node.depth,
+            document_id=node.document_id,
+            clone_id=clone_id,
+        )
+        for node, n_tokens in zip(nodes, num_tokens)
+    }
+    for node in nodes:
+        if node.parent_id and (parent := node_models.get(node.parent_id)):
+            node_models[node.id].parent = parent
+    db.add(doc_model)
+    db.add_all(node_models.values())
+    await db.flush()
+
+
+async def insert_copy(
+    db: AsyncSession,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID,
+    doc: Document,
+    nodes: list[Node],
+):
+    await _insert_document(
+        db=db, tokenizer=tokenizer, clone_id=clone_id, doc=doc, nodes=nodes
+    )
+
+
+METHODS = {"orm": insert_orm, "copy": insert_copy}
+
+
+async def main(args: argparse.Namespace):
+    tokenizer = Tokenizer.from_openai("gpt-3.5-turbo")
+    async with async_session_maker() as db:
+        if args.clone_id:
+            clone_id = uuid.UUID(args.clone_id)
+        elif (clone_id := await db.scalar(sa.select(models.Clone.id).limit(1))) is None:
+            raise ValueError("No clones found, run populate_db.py first.")
+    print(f"nodes={args.num_nodes} group_size={args.group_size} clone_id={clone_id}")
+
+    for name, fn in METHODS.items():
+        timings: list[float] = []
+        for _ in range(args.repeats):
+            doc, nodes = make_document(
+                num_nodes=args.num_nodes, group_size=args.group_size
+            )
+            async with async_session_maker() as db:
+                start = time.perf_counter()
+                await fn(
+                    db=db, tokenizer=tokenizer, clone_id=clone_id, doc=doc, nodes=nodes
+                )
+                timings.append(time.perf_counter() - start)
+                await db.rollback()
+        print(
+            f"{name:<6} best={min(timings):7.3f}s  mean={np.mean(timings):7.3f}s  "
+            f"rows/s={args.num_nodes / min(timings):9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clone-id", default=None)
+    parser.add_argument("--num-nodes", type=int, default=10_000)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,160 @@
+"""Time to turn each chat template into LLM messages.
+
+Run from the backend directory, no services needed:
+
+    python -m benchmarks.prompt_render --num-items 40 --repeats 200
+
+Compares three ways of getting the messages for one call: rendering the prompt and
+parsing it with the old pyparsing grammar, rendering it and parsing it with
+clonr._grammar.parse_prompt (the fallback for string prompts), and
+Template.render_messages, which skips the parse.
+`--num-items` scales the memories, facts and messages, so the long term memory
+prompt ends up at roughly 4k tokens with the default.
+"""
+import argparse
+import time
+from typing import Any, Callable
+
+import pyparsing as pp
+
+from clonr import templates
+from clonr._grammar import parse_prompt
+from clonr.data_structures import Memory, Message, Monologue
+from clonr.llms import OpenAI
+from clonr.templates.base import prompt_to_messages
+
+# the grammar parse_prompt used to be
+_start = pp.Literal("<|im_start|>").suppress()
+_end = pp.Literal("<|im_end|>").suppress()
+_role = (pp.Keyword("user") | pp.Keyword("assistant") | pp.Keyword("system"))("role")
+_content = pp.SkipTo(_end | pp.stringEnd())("content")
+_message = _start + _role + _content + _end
+_message.setParseAction(lambda x: dict(role=x.role, content=x.content.strip()))
+_pyparsing_prompt = pp.OneOrMore(_message)
+
+
+def pyparsing_parse_prompt(prompt: str) -> list[dict]:
+    return _pyparsing_prompt.parse_string(prompt, parse_all=True).as_list()
+
+
+class ChatML(OpenAI):
+    # just the role markers, without the tokenizer (which needs a download)
+    def __init__(self):
+        self.model = "gpt-3.5-turbo"
+
+
+def make_cases(num_items: int) -> dict[str, tuple[type[templates.Template], dict]]:
+    sentence = "The quick brown fox jumps over the lazy dog near the river bank. "
+    memories = [
+        Memory(content=f"memory {i}. " + sentence * 2, importance=i % 10)
+        for i in range(num_items)
+    ]
+    messages = [
+        Message(
+            sender_name="Bob" if i % 2 else "Al",
+            content=f"message {i}. " + sentence * 2,
+            is_clone=bool(i % 2),
+            parent_id=None,
+        )
+        for i in range(num_items)
+    ]
+    facts = [f"fact {i}. " + sentence for i in range(num_items)]
+    long_description = sentence * 30
+    return {
+        "ZeroMemoryMessageV2": (
+            templates.ZeroMemoryMessageV2,
+            dict(
+                char="Bob",
+                user="Al",
+                short_description=sentence,
+                long_description=long_description,
+                messages=messages,
+                example_dialogues=sentence * 10,
+                facts=facts,
+            ),
+        ),
+        "LongTermMemoryMessage": (
+            templates.LongTermMemoryMessage,
+            dict(
+                char="Bob",
+                user_name="Al",
+                short_description=sentence,
+                long_description=long_description,
+                messages=messages,
+                memories=memories,
+                monologues=[Monologue(content=x, source="x") for x in facts[:10]],
+                facts=facts,
+                agent_summary=sentence * 5,
+                entity_context_summary=sentence * 5,
+            ),
+        ),
+        "MessageQuery": (
+            templates.MessageQuery,
+            dict(
+                char="Bob",
+                short_description=sentence,
+                entity_name="Al",
+                messages=messages,
+            ),
+        ),
+        "AgentSummary": (
+            templates.AgentSummary,
+            dict(char="Bob", memories=memories, questions=["What now?"] * 3),
+        ),
+        "ReflectionQuestions": (
+            templates.ReflectionQuestions,
+            dict(memories=memories, num_questions=3),
+        ),
+        "MemoryRating": (templates.MemoryRating, dict(memory=sentence)),
+        "Summarize": (templates.Summarize, dict(passage=sentence * num_items)),
+    }
+
+
+def best_of(fn: Callable[[], Any], repeats: int) -> float:
+    timings: list[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(args: argparse.Namespace):
+    llm = ChatML()
+    print(f"num_items={args.num_items} repeats={args.repeats} (best time per call)")
+    print(
+        f"{'template':<24}{'chars':>8}{'pyparsing':>12}{'linear':>12}"
+        f"{'messages':>12}{'speedup':>10}"
+    )
+    prompts: dict[str, str] = {}
+    for name, (template, kwargs) in make_cases(args.num_items).items():
+        prompt = prompts[name] = template.render(llm=llm, **kwargs)
+        methods = {
+            "pyparsing": lambda: pyparsing_parse_prompt(
+                template.render(llm=llm, **kwargs)
+            ),
+            "linear": lambda: prompt_to_messages(template.render(llm=llm, **kwargs)),
+            "messages": lambda: template.render_messages(llm=llm, **kwargs),
+        }
+        res = {k: best_of(fn, args.repeats) for k, fn in methods.items()}
+        print(
+            f"{name:<24}{len(prompt):>8}"
+            + "".join(f"{res[k] * 1e3:>10.3f}ms" for k in methods)
+            + f"{res['pyparsing'] / res['messages']:>9.1f}x"
+        )
+
+    print("\nparsing only")
+    for name, prompt in prompts.items():
+        old = best_of(lambda: pyparsing_parse_prompt(prompt), args.repeats)
+        new = best_of(lambda: parse_prompt(prompt), args.repeats)
+        print(
+            f"{name:<24}{len(prompt):>8}{old * 1e3:>10.3f}ms{new * 1e3:>10.3f}ms"
+            f"{old / new:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--num-items", type=int, default=40)
+    parser.add_argument("--repeats", type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,172 @@
+"""Recall and latency of HNSW vector search against exact search.
+
+Run from the backend directory against a populated database (see populate_db.py):
+
+    python -m benchmarks.vector_search --table nodes --k 10 --ef-search 20 40 80 160
+
+Queries are stored embeddings with a bit of gaussian noise added, so the embedding
+server isn't needed. Recall@k is measured against `VectorSearchParams(exact=True)`.
+
+Searches in the app are always filtered to one clone, which is where HNSW loses rows
+(it filters its candidates after the fact). Check that case with a clone filter:
+
+    python -m benchmarks.vector_search --table memories --k 10 --clone-id auto
+
+`auto` picks the clone with the median number of rows. `short` is the fraction of
+queries that came back with fewer than k rows when the exact search had k.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import numpy as np
+import sqlalchemy as sa
+
+from app import models
+from app.clone.retrieval import vector_search_by_embedding
+from app.clone.types import MetricType, VectorSearchParams
+from app.db.db import async_session_maker
+from clonr.tokenizer import Tokenizer
+
+TABLES = {
+    "nodes": models.Node,
+    "monologues": models.Monologue,
+    "memories": models.Memory,
+    "clones": models.Clone,
+}
+
+
+async def median_clone_id(model) -> uuid.UUID:
+    counts = (
+        sa.select(model.clone_id, sa.func.count().label("n"))
+        .where(model.embedding.is_not(None))
+        .group_by(model.clone_id)
+        .subquery()
+    )
+    stmt = sa.select(counts.c.clone_id, counts.c.n).order_by(counts.c.n)
+    async with async_session_maker() as db:
+        rows = (await db.execute(stmt)).all()
+    if not rows:
+        raise ValueError(f"No embeddings found in {model.__tablename__}.")
+    clone_id, n = rows[len(rows) // 2]
+    print(f"clone {clone_id} has {n} rows, median of {len(rows)} clones")
+    return clone_id
+
+
+async def sample_queries(
+    model, num_queries: int, noise: float, clone_id: uuid.UUID | None
+) -> list[list[float]]:
+    stmt = sa.select(model.embedding).where(model.embedding.is_not(None))
+    if clone_id is not None:
+        stmt = stmt.where(model.clone_id == clone_id)
+    stmt = stmt.order_by(sa.func.random()).limit(num_queries)
+    async with async_session_maker() as db:
+        rows = (await db.scalars(stmt)).all()
+    if not rows:
+        raise ValueError(f"No embeddings found in {model.__tablename__}.")
+    arr = np.array([np.asarray(r) for r in rows], dtype=np.float32)
+    arr += np.random.normal(scale=noise, size=arr.shape).astype(np.float32)
+    arr /= np.linalg.norm(arr, axis=1, keepdims=True)
+    return arr.tolist()
+
+
+async def run_search(
+    model,
+    queries: list[list[float]],
+    params: VectorSearchParams,
+    tokenizer: Tokenizer,
+    clone_id: uuid.UUID | None,
+) -> tuple[list[set[uuid.UUID]], list[float]]:
+    filters = [model.clone_id == clone_id] if clone_id is not None else None
+    ids: list[set[uuid.UUID]] = []
+    latencies: list[float] = []
+    async with async_session_maker() as db:
+        for q in queries:
+            start = time.perf_counter()
+            r = await vector_search_by_embedding(
+                embedding=q,
+                model=model,
+                params=params,
+                db=db,
+                tokenizer=tokenizer,
+                filters=filters,
+            )
+            latencies.append(1000 * (time.perf_counter() - start))
+            ids.append({x.model.id for x in r})
+    return ids, latencies
+
+
+def report(
+    name: str,
+    latencies: list[float],
+    recall: float | None = None,
+    short: float | None = None,
+):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    line = f"{name:<16} p50={p50:7.2f}ms  p95={p95:7.2f}ms  p99={p99:7.2f}ms"
+    if recall is not None:
+        line += f"  recall@k={recall:.4f}"
+    if short is not None:
+        line += f"  short={short:.4f}"
+    print(line)
+
+
+async def main(args: argparse.Namespace):
+    model = TABLES[args.table]
+    clone_id = None
+    if args.clone_id == "auto":
+        clone_id = await median_clone_id(model)
+    elif args.clone_id:
+        clone_id = uuid.UUID(args.clone_id)
+    # max_tokens is left unbounded, so the tokenizer is never actually called.
+    tokenizer = Tokenizer.from_openai("gpt-3.5-turbo")
+    queries = await sample_queries(
+        model=model, num_queries=args.num_queries, noise=args.noise, clone_id=clone_id
+    )
+    print(f"table={args.table} k={args.k} queries={len(queries)} clone_id={clone_id}")
+
+    exact_params = VectorSearchParams(
+        max_items=args.k, metric=MetricType.inner_product, exact=True
+    )
+    exact_ids, exact_latencies = await run_search(
+        model=model,
+        queries=queries,
+        params=exact_params,
+        tokenizer=tokenizer,
+        clone_id=clone_id,
+    )
+    report("exact", exact_latencies)
+
+    for ef_search in args.ef_search:
+        params = VectorSearchParams(
+            max_items=args.k, metric=MetricType.inner_product, ef_search=ef_search
+        )
+        ann_ids, ann_latencies = await run_search(
+            model=model,
+            queries=queries,
+            params=params,
+            tokenizer=tokenizer,
+            clone_id=clone_id,
+        )
+        recall = np.mean(
+            [len(a & e) / max(len(e), 1) for a, e in zip(ann_ids, exact_ids)]
+        )
+        short = np.mean([len(a) < len(e) for a, e in zip(ann_ids, exact_ids)])
+        report(f"hnsw ef={ef_search}", ann_latencies, recall=recall, short=short)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--table", choices=list(TABLES), default="nodes")
+    parser.add_argument(
+        "--clone-id", default=None, help="uuid, or auto for the median sized clone"
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 80, 160])
+    args = parser.parse_args()
+    if args.clone_id and not hasattr(TABLES[args.table], "clone_id"):
+        parser.error(f"--clone-id can't filter {args.table}, it has no clone_id")
+    asyncio.run(main(args))
@@ -1,3 +1,4 @@
+import re
 from typing import TypedDict
 
 import pyparsing as pp
@@ -39,19 +40,35 @@ def parse_dialogue_chunk(dialogue_chunk: str) -> list[MessageDict]:
     return _dialogue_chunk_parser.parse_string(dialogue_chunk).as_list()
 
 
-# LLM prompt grammar
-_llm_message_start = pp.Literal("<|im_start|>").suppress()
-_llm_message_end = pp.Literal("<|im_end|>").suppress()
-_llm_role = (
-    pp.Keyword(LLM_USER_ROLE)
-    | pp.Keyword(LLM_ASSISTANT_ROLE)  # noqa
-    | pp.Keyword(LLM_SYSTEM_ROLE)  # noqa
-)("role")
-_llm_content = pp.SkipTo(_llm_message_end | pp.stringEnd())("content")
-_llm_message = _llm_message_start + _llm_role + _llm_content + _llm_message_end
-_llm_message.setParseAction(lambda x: dict(role=x.role, content=x.content.strip()))
-_llm_prompt_parser = pp.OneOrMore(_llm_message)
+# LLM prompts
+# These are parsed by hand rather than with a grammar. A SkipTo for every message's
+# content makes pyparsing noticeably slow on full length prompts, while a single pass
+# with str.find is linear in the prompt length.
+_LLM_MESSAGE_START = "<|im_start|>"
+_LLM_MESSAGE_END = "<|im_end|>"
+# roles are whole words, like pp.Keyword, and whitespace between messages is skipped
+_llm_message_head = re.compile(
+    r"[ \t\r\n]*"
+    + re.escape(_LLM_MESSAGE_START)
+    + rf"[ \t\r\n]*({LLM_USER_ROLE}|{LLM_ASSISTANT_ROLE}|{LLM_SYSTEM_ROLE})"
+    + r"(?![A-Za-z0-9_$])"
+)
+_llm_prompt_tail = re.compile(r"[ \t\r\n]*\Z")
 
 
 def parse_prompt(prompt: str) -> list[MessageDict]:
-    return _llm_prompt_parser.parse_string(prompt, parse_all=True).as_list()
+    messages: list[MessageDict] = []
+    pos = 0
+    while (m := _llm_message_head.match(prompt, pos)) is not None:
+        end = prompt.find(_LLM_MESSAGE_END, m.end())
+        if end < 0:
+            raise ValueError(
+                f"Prompt message starting at {m.start()} is missing {_LLM_MESSAGE_END}"
+            )
+        messages.append(
+            MessageDict(role=m.group(1), content=prompt[m.end() : end].strip())
+        )
+        pos = end + len(_LLM_MESSAGE_END)
+    if not messages or not _llm_prompt_tail.match(prompt, pos):
+        raise ValueError(f"Prompt is not a list of messages, stopped at {pos}")
+    return messages
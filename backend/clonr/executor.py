@@ -0,0 +1,149 @@
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class TokenRateLimiter:
+    """Token bucket over LLM tokens. A call reserves its (estimated) prompt plus
+    completion tokens up front and waits until the bucket has refilled enough.
+    A call bigger than the whole bucket waits for a full bucket instead of forever."""
+
+    def __init__(self, tokens_per_minute: int):
+        if tokens_per_minute <= 0:
+            raise ValueError("tokens_per_minute must be positive.")
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self._available = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock: asyncio.Lock | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(
+            self.capacity, self._available + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.capacity)
+        # the sync Index.build methods can run on different loops, and asyncio
+        # primitives are bound to the first one they are used on
+        if self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._lock = asyncio.Lock()
+        assert self._lock is not None
+        # the lock keeps reservations FIFO, so big calls don't starve behind small ones
+        async with self._lock:
+            self._refill()
+            if self._available < tokens:
+                await asyncio.sleep((tokens - self._available) / self.rate)
+                self._refill()
+            self._available -= tokens
+
+
+class ConcurrentExecutor(Generic[T, R]):
+    """Runs an async LLM call over a list of items with at most `max_concurrency`
+    calls in flight and, optionally, at most `tokens_per_minute` tokens sent.
+
+    Results come back in input order. A failed item is retried on its own with
+    exponential backoff, the rest of the batch keeps going, and only after
+    `max_retries` extra attempts does the error propagate.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        tokens_per_minute: int | None = None,
+        max_retries: int = 2,
+        retry_wait: float = 1.0,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._limiter = (
+            TokenRateLimiter(tokens_per_minute) if tokens_per_minute else None
+        )
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # see TokenRateLimiter.acquire
+        if self._semaphore is None or self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def submit(
+        self, fn: Callable[[T], Awaitable[R]], item: T, num_tokens: int = 0
+    ) -> R:
+        for attempt in range(self.max_retries + 1):
+            if self._limiter is not None:
+                await self._limiter.acquire(num_tokens)
+            try:
+                async with self._get_semaphore():
+                    return await fn(item)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = self.retry_wait * 2**attempt
+                logger.warning(
+                    f"Executor call failed (attempt {attempt + 1}/{self.max_retries + 1}), "
+                    f"retrying in {wait:.1f}s: {e!r}"
+                )
+                await asyncio.sleep(wait)
+        raise AssertionError("unreachable")
+
+    async def map(
+        self,
+        fn: Callable[[T], Awaitable[R]],
+        items: list[T],
+        num_tokens: Callable[[T], int] | None = None,
+        desc: str = "",
+    ) -> list[R]:
+        done = 0
+        st = time.perf_counter()
+
+        async def run(item: T) -> R:
+            nonlocal done
+            r = await self.submit(
+                fn, item, num_tokens=num_tokens(item) if num_tokens else 0
+            )
+            done += 1
+            logger.info(
+                f"{desc or 'Executor'}: {done}/{len(items)} done "
+                f"({time.perf_counter() - st:.1f}s elapsed)"
+            )
+            return r
+
+        return list(await asyncio.gather(*(run(x) for x in items)))
+
+    def estimate_seconds(
+        self, call_tokens: list[int], seconds_per_call: float, sequential: bool = False
+    ) -> float:
+        """Wall-clock estimate for calls of the given token sizes: the slower of the
+        concurrency bound and the token-rate bound. `sequential` is for calls that
+        depend on each other and go through `submit` one at a time."""
+        if not call_tokens:
+            return 0.0
+        rounds = (
+            len(call_tokens)
+            if sequential
+            else math.ceil(len(call_tokens) / self.max_concurrency)
+        )
+        concurrency_bound = rounds * seconds_per_call
+        if not self.tokens_per_minute:
+            return concurrency_bound
+        # the first bucketful goes out immediately
+        excess = max(0, sum(call_tokens) - self.tokens_per_minute)
+        rate_bound = 60.0 * excess / self.tokens_per_minute + seconds_per_call
+        return max(concurrency_bound, rate_bound)
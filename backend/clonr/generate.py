@@ -1,5 +1,6 @@
 import json
 import re
+from typing import AsyncGenerator
 
 from loguru import logger
 from opentelemetry import metrics, trace
@@ -17,6 +18,7 @@ from clonr.data_structures import (
     Node,
 )
 from clonr.llms import LLM, GenerationParams, LLMResponse, MockLLM
+from clonr.llms import Message as LLMMessage
 from clonr.templates.memory import MemoryExample
 from clonr.templates.qa import Excerpt
 from clonr.text_splitters import TokenSplitter
@@ -167,7 +169,7 @@ async def agent_summary(
     **kwargs,
 ) -> str:
     if llm.is_chat_model:
-        prompt = templates.AgentSummary.render(
+        prompt = templates.AgentSummary.render_messages(
             llm=llm,
             char=char,
             memories=memories,
@@ -244,7 +246,7 @@ async def entity_context_create(
     **kwargs,
 ) -> str:
     if llm.is_chat_model:
-        prompt = templates.EntityContextCreate.render(
+        prompt = templates.EntityContextCreate.render_messages(
             llm=llm,
             char=char,
             entity=entity,
@@ -287,7 +289,7 @@ async def rate_memory(
 ) -> int:
     """Returns score on scale of 1-10."""
     if llm.is_chat_model:
-        prompt = templates.MemoryRating.render(
+        prompt = templates.MemoryRating.render_messages(
             llm=llm,
             memory=memory,
             examples=examples,
@@ -339,7 +341,7 @@ async def message_queries_create(
 ) -> list[str]:
     """Returns score on scale of 1-10."""
     if llm.is_chat_model:
-        prompt = templates.MessageQuery.render(
+        prompt = templates.MessageQuery.render_messages(
             llm=llm,
             char=char,
             short_description=short_description,
@@ -431,7 +433,7 @@ async def question_and_answer(
     **kwargs,
 ) -> str:
     if llm.is_chat_model:
-        prompt = templates.QuestionAndAnswer.render(
+        prompt = templates.QuestionAndAnswer.render_messages(
             llm=llm,
             question=question,
             excerpts=excerpts,
@@ -465,7 +467,7 @@ async def reflection_queries_create(
 ) -> list[str]:
     """Returns a set of questions to be used for querying memories used in reflection."""
     if llm.is_chat_model:
-        prompt = templates.ReflectionQuestions.render(
+        prompt = templates.ReflectionQuestions.render_messages(
             llm=llm,
             memories=memories,
             num_questions=num_questions,
@@ -531,7 +533,7 @@ async def reflections_create(
 ) -> list[MemoryWithoutRating]:
     """WARNING: This will produce memories that have not been rated for importance!"""
     if llm.is_chat_model:
-        prompt = templates.ReflectionInsights.render(
+        prompt = templates.ReflectionInsights.render_messages(
             llm=llm,
             statements=memories,
             system_prompt=system_prompt,
@@ -623,7 +625,7 @@ async def summarize(
     **kwargs,
 ) -> str:
     if llm.is_chat_model:
-        prompt = templates.Summarize.render(
+        prompt = templates.Summarize.render_messages(
             llm=llm,
             passage=passage,
             system_prompt=system_prompt,
@@ -655,7 +657,7 @@ async def summarize_with_context(
     **kwargs,
 ) -> str:
     if llm.is_chat_model:
-        prompt = templates.SummarizeWithContext.render(
+        prompt = templates.SummarizeWithContext.render_messages(
             llm=llm,
             passage=passage,
             prev_summary=prev_summary,
@@ -699,7 +701,7 @@ async def online_summarize(
     for i, node in enumerate(nodes):
         kwargs["group"] = f"{i + 1}/{len(nodes)}"
         if llm.is_chat_model:
-            prompt = templates.OnlineSummarize.render(
+            prompt = templates.OnlineSummarize.render_messages(
                 llm=llm,
                 passage=node.content,
                 prev_summary=prev_summary,
@@ -730,11 +732,12 @@ async def generate_zero_memory_message(
     example_dialogues: str | None = None,
     sys_prompt_header: str | None = None,
     facts: list[str] | None = None,
+    preamble: templates.Preamble | None = None,
     **kwargs,
 ) -> str:
     if not llm.is_chat_model:
         raise NotImplementedError("Instruct for message gen not supported yet.")
-    prompt = templates.ZeroMemoryMessageV2.render(
+    prompt = templates.ZeroMemoryMessageV2.render_messages(
         char=char,
         user=user_name,
         short_description=short_description,
@@ -745,6 +748,7 @@ async def generate_zero_memory_message(
         example_dialogues=example_dialogues,
         sys_prompt_header=sys_prompt_header,
         facts=facts,
+        preamble=preamble,
     )
     kwargs["template"] = templates.ZeroMemoryMessageV2.__name__
     kwargs["subroutine"] = generate_long_term_memory_message.__name__
@@ -770,11 +774,12 @@ async def generate_long_term_memory_message(
     agent_summary: str | None = None,
     entity_context_summary: str | None = None,
     use_timestamps: bool = False,
+    preamble: templates.Preamble | None = None,
     **kwargs,
 ) -> str:
     if not llm.is_chat_model:
         raise NotImplementedError("Instruct for message gen not supported yet.")
-    prompt = templates.LongTermMemoryMessage.render(
+    prompt = templates.LongTermMemoryMessage.render_messages(
         llm=llm,
         char=char,
         user_name=user_name,
@@ -787,6 +792,7 @@ async def generate_long_term_memory_message(
         agent_summary=agent_summary,
         entity_context_summary=entity_context_summary,
         use_timestamps=use_timestamps,
+        preamble=preamble,
     )
     kwargs["template"] = templates.LongTermMemoryMessage.__name__
     kwargs["subroutine"] = generate_long_term_memory_message.__name__
@@ -796,3 +802,100 @@ async def generate_long_term_memory_message(
         **kwargs,
     )
     return r.content.strip()
+
+
+async def _stream_content(
+    llm: LLM, prompt: str | list[LLMMessage], params: GenerationParams, **kwargs
+) -> AsyncGenerator[str, None]:
+    # leading whitespace is dropped to match the .strip() on the non-streaming path
+    started = False
+    async for delta in llm.astream(prompt_or_messages=prompt, params=params, **kwargs):
+        if not (content := delta.choices[0].delta.content):
+            continue
+        if not started:
+            content = content.lstrip()
+            if not content:
+                continue
+            started = True
+        yield content
+
+
+def stream_zero_memory_message(
+    llm: LLM,
+    char: str,
+    user_name: str,
+    short_description: str,
+    long_description: str,
+    messages: list[Message],
+    scenario: str | None = None,
+    example_dialogues: str | None = None,
+    sys_prompt_header: str | None = None,
+    facts: list[str] | None = None,
+    preamble: templates.Preamble | None = None,
+    **kwargs,
+) -> AsyncGenerator[str, None]:
+    """Same as generate_zero_memory_message, but yields the content as it arrives."""
+    if not llm.is_chat_model:
+        raise NotImplementedError("Instruct for message gen not supported yet.")
+    prompt = templates.ZeroMemoryMessageV2.render_messages(
+        char=char,
+        user=user_name,
+        short_description=short_description,
+        long_description=long_description,
+        llm=llm,
+        messages=messages,
+        scenario=scenario,
+        example_dialogues=example_dialogues,
+        sys_prompt_header=sys_prompt_header,
+        facts=facts,
+        preamble=preamble,
+    )
+    kwargs["template"] = templates.ZeroMemoryMessageV2.__name__
+    kwargs["subroutine"] = stream_zero_memory_message.__name__
+    return _stream_content(
+        llm=llm, prompt=prompt, params=Params.generate_zero_memory_message, **kwargs
+    )
+
+
+def stream_long_term_memory_message(
+    llm: LLM,
+    char: str,
+    user_name: str,
+    short_description: str,
+    long_description: str,
+    messages: list[Message],
+    monologues: list[Monologue] | None = None,
+    facts: list[str] | None = None,
+    memories: list[Memory] | None = None,
+    agent_summary: str | None = None,
+    entity_context_summary: str | None = None,
+    use_timestamps: bool = False,
+    preamble: templates.Preamble | None = None,
+    **kwargs,
+) -> AsyncGenerator[str, None]:
+    """Same as generate_long_term_memory_message, but yields the content as it arrives."""
+    if not llm.is_chat_model:
+        raise NotImplementedError("Instruct for message gen not supported yet.")
+    prompt = templates.LongTermMemoryMessage.render_messages(
+        llm=llm,
+        char=char,
+        user_name=user_name,
+        short_description=short_description,
+        long_description=long_description,
+        messages=messages,
+        monologues=monologues,
+        facts=facts,
+        memories=memories,
+        agent_summary=agent_summary,
+        entity_context_summary=entity_context_summary,
+        use_timestamps=use_timestamps,
+        preamble=preamble,
+    )
+    kwargs["template"] = templates.LongTermMemoryMessage.__name__
+    kwargs["subroutine"] = stream_long_term_memory_message.__name__
+    return _stream_content(
+        llm=llm,
+        prompt=prompt,
+        params=Params.generate_long_term_memory_message,
+        **kwargs,
+    )
@@ -8,7 +8,9 @@ from pydantic import BaseModel, validator
 
 from clonr import templates
 from clonr.data_structures import Document, IndexType, Node
+from clonr.executor import ConcurrentExecutor
 from clonr.generate import (
+    Params,
     auto_chunk_size_summarize,
     online_summarize,
     summarize,
@@ -21,6 +23,9 @@ from clonr.utils import aggregate_by_length
 
 tracer = trace.get_tracer(__name__)
 
+# rough latency of one summarize call (~512 output tokens), for wall-clock estimates
+SECONDS_PER_SUMMARIZE_CALL = 12.0
+
 
 class TokenEstimate(BaseModel):
     doc_tokens: int
@@ -28,6 +33,7 @@ class TokenEstimate(BaseModel):
     max_depth: int | None = None
     multiplier: int | None = None
     metadata: dict | None = None
+    wall_clock_seconds: float | None = None
 
     @validator("multiplier", always=True)
     def set_multiplier(cls, v, values):
@@ -232,9 +238,15 @@ class TreeIndex(Index):
     summary size. In this case, you might encounter a situation where
     aggregate(nodes) = nodes, which means that the number of nodes would
     never reduce (group_size = n_nodes).
+
+    Groups within a level don't depend on each other, so each level is
+    summarized concurrently through `executor`, which bounds the number of
+    calls in flight and the token rate.
     """
 
     type = IndexType.tree
+    # whether each summary in a level depends on the previous one
+    sequential_levels = False
 
     def __init__(
         self,
@@ -243,6 +255,7 @@ class TreeIndex(Index):
         llm: LLM,
         max_group_size: int | str = "auto",
         max_depth: int | None = None,
+        executor: ConcurrentExecutor | None = None,
     ):
         self.tokenizer = tokenizer
         self.splitter = splitter
@@ -250,6 +263,7 @@ class TreeIndex(Index):
         self._index: dict[str, Node] = {}
         self._tokens_processed = 0
         self.max_depth = max_depth
+        self.executor = executor or ConcurrentExecutor()
 
         prompt = templates.Summarize.render(passage="", llm=MockLLM(""))
         self._prompt_len = self.tokenizer.length(prompt)
@@ -267,7 +281,12 @@ class TreeIndex(Index):
     def tokens_processed(self):
         return self._tokens_processed
 
-    def estimate_llm_tokens(self, doc: Document, max_tokens: int = 512):
+    def estimate_llm_tokens(
+        self,
+        doc: Document,
+        max_tokens: int = 512,
+        seconds_per_call: float = SECONDS_PER_SUMMARIZE_CALL,
+    ):
         # the entire document is ultimately processed
         assert max_tokens < 2 * self.max_group_size
         llm_call_tokens = 0
@@ -280,16 +299,26 @@ class TreeIndex(Index):
         metadata: list[dict[str, int]] = [{"depth": depth, "nodes": len(chunks)}]
         depth += 1
         prev_len = len(chunks)
+        wall_clock_seconds = 0.0
         for _ in range(self.max_depth or len(nodes)):
             if len(chunks) <= 1:
                 break
-            group_chunks = aggregate_by_length(
-                chunks, max_size=self.max_group_size, length_fn=self.tokenizer.length
+            lengths = self.tokenizer.length_batch(chunks)
+            group_ids = aggregate_by_length(
+                list(range(len(chunks))),
+                max_size=self.max_group_size,
+                length_fn=lambda i: lengths[i],
+            )
+            groups = ["".join(chunks[i] for i in g) for g in group_ids]
+            call_tokens = [
+                n + sum_size + prompt_size for n in self.tokenizer.length_batch(groups)
+            ]
+            groups = ["x " * (sum_size - 1) for _ in groups]
+            llm_call_tokens += sum(call_tokens)
+            # levels run one after the other, the groups within one concurrently
+            wall_clock_seconds += self.executor.estimate_seconds(
+                call_tokens, seconds_per_call, sequential=self.sequential_levels
             )
-            groups = ["".join(x) for x in group_chunks]
-            for i, g in enumerate(groups):
-                llm_call_tokens += self.tokenizer.length(g) + sum_size + prompt_size
-                groups[i] = "x " * (sum_size - 1)
             chunks = groups
             metadata.append({"depth": depth, "nodes": len(chunks)})
             depth += 1
@@ -300,25 +329,33 @@ class TreeIndex(Index):
             llm_call_tokens=llm_call_tokens,
             max_depth=depth,
             metadata={"layers": metadata},
+            wall_clock_seconds=round(wall_clock_seconds, 1),
         )
 
-    @tracer.start_as_current_span("_process_level")
-    async def _process_level(
-        self, nodes: list[Node], depth: int, doc: Document, **kwargs
-    ) -> list[Node]:
-        def length_fn(node: Node):
-            return self.tokenizer.length(node.content)
-
+    def _group_level(self, nodes: list[Node]) -> tuple[list[list[Node]], list[int]]:
+        lengths = dict(
+            zip(
+                [nd.id for nd in nodes],
+                self.tokenizer.length_batch([nd.content for nd in nodes]),
+            )
+        )
         groups: list[list[Node]] = aggregate_by_length(
-            nodes, max_size=self.max_group_size, length_fn=length_fn
+            nodes, max_size=self.max_group_size, length_fn=lambda nd: lengths[nd.id]
         )
+        # prompt + passage + summary, what the rate limiter has to budget for a call
+        call_tokens = [
+            self._prompt_len
+            + sum(lengths[nd.id] for nd in g)
+            + (Params.summarize.max_tokens or 0)
+            for g in groups
+        ]
+        return groups, call_tokens
+
+    def _link_level(
+        self, groups: list[list[Node]], summaries: list[str], depth: int, doc: Document
+    ) -> list[Node]:
         return_nodes: list[Node] = []
-        for i, g in enumerate(groups):
-            content = "".join(x.content for x in g)
-            kwargs["depth"] = depth
-            kwargs["subroutine"] = self.__class__.__name__
-            kwargs["group"] = f"{i+1}/{len(groups)}"
-            content = await summarize(passage=content, llm=self.llm, **kwargs)
+        for i, (g, content) in enumerate(zip(groups, summaries)):
             node = Node(
                 content=content,
                 document_id=doc.id,
@@ -337,15 +374,40 @@ class TreeIndex(Index):
             self._index[str(node.id)] = node
         return return_nodes
 
-    @tracer.start_as_current_span("TreeIndex_abuild")
-    async def abuild(self, doc: Document, **kwargs) -> list[Node]:
-        logger.info(f"Building {self.__class__.__name__} on doc_id: {str(doc.id)}.")
-        nodes = create_leaf_nodes(doc=doc, splitter=self.splitter)
-        if not nodes:
-            return []
+    @tracer.start_as_current_span("_process_level")
+    async def _process_level(
+        self, nodes: list[Node], depth: int, doc: Document, **kwargs
+    ) -> list[Node]:
+        groups, call_tokens = self._group_level(nodes)
+        kwargs["depth"] = depth
+        kwargs["subroutine"] = self.__class__.__name__
+
+        async def summarize_group(i: int) -> str:
+            content = "".join(x.content for x in groups[i])
+            return await summarize(
+                passage=content,
+                llm=self.llm,
+                **dict(kwargs, group=f"{i+1}/{len(groups)}"),
+            )
+
+        summaries = await self.executor.map(
+            summarize_group,
+            list(range(len(groups))),
+            num_tokens=lambda i: call_tokens[i],
+            desc=f"{self.__class__.__name__} doc_id: {doc.id} depth {depth}",
+        )
+        return self._link_level(groups, summaries, depth=depth, doc=doc)
+
+    async def asummarize(
+        self, doc: Document, nodes: list[Node], **kwargs
+    ) -> list[Node]:
+        """Builds the summary levels on top of already split leaf nodes. Returns the
+        leaves and every summary node, linked through parent_id and child_ids."""
         depth = 1
         max_iter = self.max_depth or len(nodes)
         prev_size = len(nodes)
+        for node in nodes:
+            self._index[str(node.id)] = node
         while len(nodes) > 1 and max_iter > 0:
             with tracer.start_as_current_span(f"process_nodes_depth_{depth}"):
                 for node in nodes:
@@ -363,12 +425,21 @@ class TreeIndex(Index):
                 prev_size == len(nodes)
         if not nodes:
             raise ValueError("Somehow we reduced past a single node!")
+        r = list(self._index.values())
+        self._index = {}  # TODO (Jonny): trying to make this stateless!
+        return r
+
+    @tracer.start_as_current_span("TreeIndex_abuild")
+    async def abuild(self, doc: Document, **kwargs) -> list[Node]:
+        logger.info(f"Building {self.__class__.__name__} on doc_id: {str(doc.id)}.")
+        nodes = create_leaf_nodes(doc=doc, splitter=self.splitter)
+        if not nodes:
+            return []
+        r = await self.asummarize(doc=doc, nodes=nodes, **kwargs)
         doc.index_type = self.type
         doc.text_splitter = self.splitter.name
         doc.max_chunk_size = self.splitter.max_chunk_size
         doc.chunk_overlap = self.splitter.chunk_overlap
-        r = list(self._index.values())
-        self._index = {}  # TODO (Jonny): trying to make this stateless!
         return r
 
     def build(self, doc: Document, **kwargs) -> list[Node]:
@@ -378,7 +449,12 @@ class TreeIndex(Index):
 
 
 class TreeIndexWithContext(TreeIndex):
+    """TreeIndex where each summary also sees the previous summary in its level.
+    That makes the groups of a level a chain, so they go through the executor one
+    at a time; the executor still rate limits and retries each call."""
+
     type = IndexType.tree
+    sequential_levels = True
 
     def __init__(
         self,
@@ -387,6 +463,7 @@ class TreeIndexWithContext(TreeIndex):
         llm: LLM,
         max_group_size: int | str = "auto",
         max_depth: int | None = None,
+        executor: ConcurrentExecutor | None = None,
     ):
         self.tokenizer = tokenizer
         self.splitter = splitter
@@ -394,6 +471,7 @@ class TreeIndexWithContext(TreeIndex):
         self._index: dict[str, Node] = {}
         self._tokens_processed = 0
         self.max_depth = max_depth
+        self.executor = executor or ConcurrentExecutor()
 
         prompt = templates.Summarize.render(passage="", llm=MockLLM(""))
         self._prompt_len = self.tokenizer.length(prompt)
@@ -412,9 +490,14 @@ class TreeIndexWithContext(TreeIndex):
         return self._tokens_processed
 
     def estimate_llm_tokens(
-        self, doc: Document, max_tokens: int = 512
+        self,
+        doc: Document,
+        max_tokens: int = 512,
+        seconds_per_call: float = SECONDS_PER_SUMMARIZE_CALL,
     ) -> TokenEstimate:
-        estimate = super().estimate_llm_tokens(doc=doc, max_tokens=max_tokens)
+        estimate = super().estimate_llm_tokens(
+            doc=doc, max_tokens=max_tokens, seconds_per_call=seconds_per_call
+        )
         # add the additional prompt input for the context
         llm_call_tokens = estimate.llm_call_tokens
         for row in estimate.metadata["layers"]:
@@ -425,46 +508,41 @@ class TreeIndexWithContext(TreeIndex):
             llm_call_tokens=llm_call_tokens,
             max_depth=estimate.max_depth,
             metadata=estimate.metadata,
+            wall_clock_seconds=estimate.wall_clock_seconds,
         )
 
     @tracer.start_as_current_span("_process_level")
     async def _process_level(
         self, nodes: list[Node], depth: int, doc: Document, **kwargs
     ) -> list[Node]:
-        def length_fn(node: Node):
-            return self.tokenizer.length(node.content)
-
-        groups: list[list[Node]] = aggregate_by_length(
-            nodes, max_size=self.max_group_size, length_fn=length_fn
-        )
-        return_nodes: list[Node] = []
+        groups, call_tokens = self._group_level(nodes)
+        summaries: list[str] = []
         prev_summary: str | None = None
         for i, g in enumerate(groups):
             content = "".join(x.content for x in g)
             kwargs["depth"] = depth
             kwargs["subroutine"] = self.__class__.__name__
             kwargs["group"] = f"{i+1}/{len(groups)}"
-            content = await summarize_with_context(
-                passage=content, llm=self.llm, prev_summary=prev_summary, **kwargs
+
+            async def summarize_group(prev_summary: str | None) -> str:
+                return await summarize_with_context(
+                    passage=content, llm=self.llm, prev_summary=prev_summary, **kwargs
+                )
+
+            # call_tokens already covers this summary, the prompt also carries the
+            # previous one
+            context_tokens = self.tokenizer.length(prev_summary) if prev_summary else 0
+            prev_summary = await self.executor.submit(
+                summarize_group,
+                prev_summary,
+                num_tokens=call_tokens[i] + context_tokens,
             )
-            node = Node(
-                content=content,
-                document_id=doc.id,
-                index=i,
-                is_leaf=False,
-                depth=depth,
-                child_ids=[],
+            summaries.append(prev_summary)
+            logger.info(
+                f"{self.__class__.__name__} doc_id: {doc.id} depth {depth}: "
+                f"{i+1}/{len(groups)} done"
             )
-            for nd in g:
-                if node.child_ids is None:
-                    node.child_ids = [nd.id]
-                else:
-                    node.child_ids.append(nd.id)
-                nd.parent_id = node.id
-            return_nodes.append(node)
-            self._index[str(node.id)] = node
-            prev_summary = content
-        return return_nodes
+        return self._link_level(groups, summaries, depth=depth, doc=doc)
 
     @tracer.start_as_current_span("TreeIndexWithContext_abuild")
     async def abuild(self, doc: Document, **kwargs) -> list[Node]:
@@ -472,32 +550,11 @@ class TreeIndexWithContext(TreeIndex):
         nodes = create_leaf_nodes(doc=doc, splitter=self.splitter)
         if not nodes:
             return []
-        depth = 1
-        max_iter = self.max_depth or len(nodes)
-        prev_size = len(nodes)
-        while len(nodes) > 1 and max_iter > 0:
-            with tracer.start_as_current_span(f"process_nodes_depth_{depth}"):
-                for node in nodes:
-                    self._index[str(node.id)] = node
-                nodes = await self._process_level(
-                    nodes=nodes, depth=depth, doc=doc, **kwargs
-                )
-                depth += 1
-                max_iter -= 1
-                if len(nodes) >= prev_size:
-                    logger.error(
-                        "Failed to reduce nodes size ({prev_size} -> {prev_size})"
-                    )
-                    break
-                prev_size == len(nodes)
-        if not nodes:
-            raise ValueError("Somehow we reduced past a single node!")
+        r = await self.asummarize(doc=doc, nodes=nodes, **kwargs)
         doc.index_type = self.type
         doc.text_splitter = self.splitter.name
         doc.max_chunk_size = self.splitter.max_chunk_size
         doc.chunk_overlap = self.splitter.chunk_overlap
-        r = list(self._index.values())
-        self._index = {}  # TODO (Jonny): trying to make this stateless!
         return r
 
     def build(self, doc: Document, **kwargs) -> list[Node]:
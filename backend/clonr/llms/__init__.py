@@ -1,7 +1,7 @@
 from .base import LLM
 from .llama_cpp import LlamaCpp
 from .mock import MockLLM
-from .openai import OpenAI
+from .openai import OpenAI, create_pooled_session
 from .schemas import (
     GenerationParams,
     LLMResponse,
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod, abstractproperty
+from typing import AsyncGenerator
 
-from .schemas import GenerationParams, LLMResponse, Message
+from .schemas import GenerationParams, LLMResponse, Message, OpenAIStreamResponse
 
 
 class LLM(ABC):
@@ -49,6 +50,15 @@ class LLM(ABC):
     ) -> LLMResponse:
         pass
 
+    @abstractmethod
+    def astream(
+        self,
+        prompt_or_messages: str | list[Message],
+        params: GenerationParams | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[OpenAIStreamResponse, None]:
+        pass
+
     @abstractmethod
     def num_tokens(self, inp: list[Message] | str) -> int:
         pass
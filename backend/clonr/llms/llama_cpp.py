@@ -1,8 +1,37 @@
+import aiohttp
+
 from clonr.tokenizer import Tokenizer
+from clonr.utils import fsm
 
 from .callbacks import LLMCallback
 from .openai import OpenAI
 
+# the llama_cpp_server queues requests by priority: chat > memory > summarize.
+# anything that isn't listed here is treated as summarization.
+CHAT_SUBROUTINES = {
+    "generate_zero_memory_message",
+    "generate_long_term_memory_message",
+    "stream_zero_memory_message",
+    "stream_long_term_memory_message",
+    "message_queries_create",
+    "question_and_answer",
+}
+MEMORY_SUBROUTINES = {
+    "rate_memory",
+    "reflection_queries_create",
+    "reflections_create",
+    "agent_summary",
+    "entity_context_create",
+}
+# the server constrains these to a regex (see clonr.utils.fsm), so that what comes back
+# always parses instead of failing and being retried.
+GUIDED_SUBROUTINES = {
+    "rate_memory": fsm.RATING_REGEX,
+    "message_queries_create": fsm.QUERY_LIST_REGEX,
+    "reflection_queries_create": fsm.QUERY_LIST_REGEX,
+    "reflections_create": fsm.REFLECTIONS_REGEX,
+}
+
 
 class LlamaCpp(OpenAI):
     model_type = "llama-cpp"
@@ -16,6 +45,7 @@ class LlamaCpp(OpenAI):
         chat_mode: bool = True,
         tokenizer: Tokenizer | None = None,
         callbacks: list[LLMCallback] | None = None,
+        session: aiohttp.ClientSession | None = None,
     ):
         self.model = model
         self.api_key = api_key
@@ -26,6 +56,7 @@ class LlamaCpp(OpenAI):
             "TheBloke/Llama-2-13B-chat-GPTQ"
         )
         self.callbacks = callbacks or []
+        self.session = session
 
     @property
     def default_system_prompt(self):
@@ -34,3 +65,16 @@ class LlamaCpp(OpenAI):
     @property
     def context_length(self) -> int:
         return 4096  # llama2 context window
+
+    def _extra_request_params(self, **kwargs) -> dict:
+        subroutine = kwargs.get("subroutine")
+        if subroutine in CHAT_SUBROUTINES:
+            priority = "chat"
+        elif subroutine in MEMORY_SUBROUTINES:
+            priority = "memory"
+        else:
+            priority = "summarize"
+        params = dict(priority=priority)
+        if (regex := GUIDED_SUBROUTINES.get(subroutine)) is not None:
+            params["regex"] = regex
+        return params
@@ -2,8 +2,10 @@ import asyncio
 import textwrap
 import time
 import uuid
+import weakref
+from contextlib import asynccontextmanager
 from functools import wraps
-from typing import AsyncGenerator, Callable, Generator
+from typing import AsyncGenerator, AsyncIterator, Callable, Generator, Iterable
 
 import aiohttp
 import openai
@@ -11,6 +13,7 @@ from fastapi import status
 from fastapi.exceptions import HTTPException
 from loguru import logger
 from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
 from tenacity import (
     RetryError,
     retry,
@@ -48,6 +51,57 @@ reqs_in_progress_meter = meter.create_up_down_counter(
     description="OpenAI or other LLM requests currently in progress",
 )
 
+# sessions created by create_pooled_session, tracked for the pool metrics below
+_pooled_sessions: weakref.WeakSet[aiohttp.ClientSession] = weakref.WeakSet()
+
+
+def _pool_connections(options: CallbackOptions) -> Iterable[Observation]:
+    for sess in _pooled_sessions:
+        conn = sess.connector
+        if sess.closed or conn is None:
+            continue
+        # aiohttp doesn't expose these publicly, so reach into the connector
+        acquired = len(getattr(conn, "_acquired", ()))
+        idle = sum(len(x) for x in getattr(conn, "_conns", {}).values())
+        yield Observation(acquired, dict(state="acquired"))
+        yield Observation(idle, dict(state="idle"))
+
+
+def _pool_limit(options: CallbackOptions) -> Iterable[Observation]:
+    for sess in _pooled_sessions:
+        if not sess.closed and sess.connector is not None:
+            yield Observation(sess.connector.limit)
+
+
+meter.create_observable_gauge(
+    name="llm_http_pool_connections",
+    callbacks=[_pool_connections],
+    description="Connections in the shared LLM HTTP pool, by state (acquired or idle)",
+)
+meter.create_observable_gauge(
+    name="llm_http_pool_limit",
+    callbacks=[_pool_limit],
+    description="Max number of connections in the shared LLM HTTP pool",
+)
+
+
+def create_pooled_session(
+    limit: int = 100, limit_per_host: int = 32, keepalive_timeout: float = 60
+) -> aiohttp.ClientSession:
+    """Creates a keep-alive session that LLMs can share across calls, to skip the
+    TCP/TLS handshake on every request. Must be called from inside an event loop,
+    and the caller is responsible for closing it.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=300,
+    )
+    sess = aiohttp.ClientSession(connector=connector)
+    _pooled_sessions.add(sess)
+    return sess
+
 
 def retry_decorator(fn: Callable):
     @retry(
@@ -120,12 +174,14 @@ class OpenAI(LLM):
         api_base: str | None = None,
         tokenizer: Tokenizer | None = None,
         callbacks: list[LLMCallback] | None = None,
+        session: aiohttp.ClientSession | None = None,
     ):
         self.model = model
         self.api_key = api_key
         self.api_base = api_base
         self.tokenizer = tokenizer or Tokenizer.from_openai(model)
         self.callbacks = callbacks or []
+        self.session = session
 
     @property
     def user_start(self):
@@ -175,10 +231,8 @@ class OpenAI(LLM):
         if self.model.startswith("gpt-3.5"):
             # every message follows <|start|>{role/name}\n{content}<|end|>\n
             tokens_per_message = 4
-            tokens_per_name = -1  # if there's a name, the role is omitted
         elif self.model.startswith("gpt-4"):
             tokens_per_message = 3
-            tokens_per_name = 1
         else:
             raise NotImplementedError(
                 "num_tokens_from_messages() is not implemented for "
@@ -186,18 +240,16 @@ class OpenAI(LLM):
                 "https://github.com/openai/openai-python/blob/main/chatml.md"
                 " for information on how messages are converted to tokens."
             )
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.model_dump().items():
-                num_tokens += len(self.tokenizer.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
+        # our messages never carry a name, so it's just the role and content. Those
+        # are counted per message and cached, since the same history gets re-counted
+        # on every turn.
+        num_tokens = sum(self.tokenizer.chat_lengths(messages))
+        num_tokens += tokens_per_message * len(messages)
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
     def _num_tokens_from_string(self, value: str) -> int:
-        return len(self.tokenizer.encode(value))
+        return self.tokenizer.length(value)
 
     def num_tokens(self, inp: list[Message] | str) -> int:
         if isinstance(inp, str):
@@ -212,9 +264,25 @@ class OpenAI(LLM):
         ]
         return messages
 
-    @classmethod
-    def messages_to_prompt(cls, messages: list[Message]) -> str:
-        return "\n".join(m.to_prompt(cls) for m in messages)
+    def messages_to_prompt(self, messages: list[Message]) -> str:
+        # the role markers are properties, so this needs an instance rather than cls
+        return "\n".join(m.to_prompt(self) for m in messages)
+
+    def _extra_request_params(self, **kwargs) -> dict:
+        # hook for OpenAI-compatible servers that accept extra request fields
+        return {}
+
+    @asynccontextmanager
+    async def _aiosession(self) -> AsyncIterator[aiohttp.ClientSession]:
+        # openai picks up the session from a contextvar. A shared session is left open,
+        # otherwise we fall back to a throwaway session for just this call.
+        if self.session is not None and not self.session.closed:
+            openai.aiosession.set(self.session)
+            yield self.session
+        else:
+            async with aiohttp.ClientSession() as sess:
+                openai.aiosession.set(sess)
+                yield sess
 
     @retry_decorator
     async def agenerate(
@@ -248,16 +316,13 @@ class OpenAI(LLM):
         )
 
         start_time = time.time()
-        async with aiohttp.ClientSession() as sess:
-            openai.aiosession.set(sess)
-            try:
-                r = await openai.ChatCompletion.acreate(
-                    **request.model_dump(exclude_unset=True),
-                    api_key=self.api_key,
-                    api_base=self.api_base,
-                )
-            finally:
-                await openai.aiosession.get().close()  # type: ignore
+        async with self._aiosession():
+            r = await openai.ChatCompletion.acreate(
+                **request.model_dump(exclude_unset=True),
+                **self._extra_request_params(**kwargs),
+                api_key=self.api_key,
+                api_base=self.api_base,
+            )
         total_time = 1e-7 + time.time() - start_time
 
         out = OpenAIResponse(**r)
@@ -310,23 +375,20 @@ class OpenAI(LLM):
             stream=True,
             **params.model_dump(exclude_unset=True),
         )
-        async with aiohttp.ClientSession() as sess:
-            openai.aiosession.set(sess)
-            try:
-                chunks = await openai.ChatCompletion.acreate(
-                    **request.model_dump(exclude_unset=True),
-                    api_key=self.api_key,
-                    api_base=self.api_base,
-                )
-                async for chunk in chunks:
-                    delta = OpenAIStreamResponse(**chunk)
+        async with self._aiosession():
+            chunks = await openai.ChatCompletion.acreate(
+                **request.model_dump(exclude_unset=True),
+                **self._extra_request_params(**kwargs),
+                api_key=self.api_key,
+                api_base=self.api_base,
+            )
+            async for chunk in chunks:
+                delta = OpenAIStreamResponse(**chunk)
 
-                    for c in self.callbacks:
-                        await c.on_token_received(self, delta=delta, **kwargs)
+                for c in self.callbacks:
+                    await c.on_token_received(self, delta=delta, **kwargs)
 
-                    yield delta
-            finally:
-                await openai.aiosession.get().close()  # type: ignore
+                yield delta
 
         for c in self.callbacks:
             await c.on_stream_end(self, **kwargs)
@@ -1,5 +1,5 @@
 from .agent_summary import AgentSummary
-from .base import Template
+from .base import Preamble, Template
 from .entity_relationship import EntityContextCreate
 from .long_description import LongDescription
 from .memory import MemoryRating, MemoryRatingWithContext
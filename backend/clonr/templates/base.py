@@ -1,14 +1,117 @@
+import hashlib
 from abc import ABC
+from dataclasses import dataclass
+from typing import Any
 
 import jinja2
 
+from clonr._grammar import parse_prompt
+from clonr.llms import LLM, Message, RoleEnum
+
 env = jinja2.Environment(
     enable_async=False, autoescape=False, undefined=jinja2.StrictUndefined
 )
 
+# Templates rendered in pieces mark the cuts with this comment, which renders to
+# nothing, so the whole template renders exactly as it would without it.
+SEGMENT_BREAK = "{# segment #}"
+
+# Segments keep their trailing newlines, since most of them end mid-template.
+# The source's own trailing newline is dropped by hand, like env does.
+_segment_env = jinja2.Environment(
+    enable_async=False,
+    autoescape=False,
+    undefined=jinja2.StrictUndefined,
+    keep_trailing_newline=True,
+)
+
+
+def compile_segments(source: str) -> list[jinja2.Template]:
+    """Compiles each piece of `source` between SEGMENT_BREAKs. Whitespace control
+    never reaches across a break, so rendering the pieces with the same variables and
+    joining them gives the same string as rendering `source` with `env`."""
+    if source.endswith("\n"):
+        source = source[:-1]
+    return [_segment_env.from_string(x) for x in source.split(SEGMENT_BREAK)]
+
+
+def template_version(source: str) -> str:
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+@dataclass
+class Preamble:
+    """The parts of a message prompt that only change along with the clone, rendered
+    ahead of time. `head` goes before the retrieved context and `tail` after it."""
+
+    head: str
+    tail: str
+
+
+# Stand-ins for an LLM's role markers. A prompt rendered with them is cut into messages
+# with plain string splits instead of being parsed, and prompt text never contains
+# these control characters. If it somehow does, we fall back to parsing.
+_MSG_START = "\x02"
+_MSG_ROLE_END = "\x1f"
+_MSG_END = "\x03"
+
+
+class MessageMarkers:
+    """Stands in for `llm` while rendering, with the role markers swapped out so that
+    render_messages can split the result. Anything else is read off of `llm`."""
+
+    system_start = f"{_MSG_START}{RoleEnum.system.value}{_MSG_ROLE_END}"
+    user_start = f"{_MSG_START}{RoleEnum.user.value}{_MSG_ROLE_END}"
+    assistant_start = f"{_MSG_START}{RoleEnum.assistant.value}{_MSG_ROLE_END}"
+    system_end = user_end = assistant_end = _MSG_END
+
+    def __init__(self, llm: LLM):
+        self.llm = llm
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.llm, name)
+
+
+def split_messages(marked: str) -> list[Message] | None:
+    """The messages of a prompt rendered with MessageMarkers, or None if there is
+    anything other than whitespace outside of them."""
+    outside, *chunks = marked.split(_MSG_START)
+    if outside.strip():
+        return None
+    messages: list[Message] = []
+    for chunk in chunks:
+        role, sep, rest = chunk.partition(_MSG_ROLE_END)
+        content, end, outside = rest.partition(_MSG_END)
+        if not sep or not end or outside.strip():
+            return None
+        messages.append(Message(role=role, content=content.strip()))
+    return messages
+
+
+def system_message(llm: LLM, prompt: str) -> Message | None:
+    """The message of a prompt rendered for `llm` that is a single system message,
+    or None if it isn't one."""
+    prompt = prompt.strip()
+    start, end = llm.system_start.strip(), llm.system_end.strip()
+    if not (start and end and prompt.startswith(start) and prompt.endswith(end)):
+        return None
+    content = prompt[len(start) : len(prompt) - len(end)]
+    return Message(role=RoleEnum.system, content=content.strip())
+
+
+def prompt_to_messages(prompt: str) -> list[Message]:
+    return [Message(role=x["role"], content=x["content"]) for x in parse_prompt(prompt)]
+
 
 class Template(ABC):
-    pass
-    # @abstractclassmethod
-    # def render(cls, *args: Any, **kwargs: Any) -> str:
-    #     raise NotImplementedError()
+    @classmethod
+    def render(cls, *args: Any, **kwargs: Any) -> str:
+        raise NotImplementedError()
+
+    @classmethod
+    def render_messages(cls, *args: Any, llm: LLM, **kwargs: Any) -> list[Message]:
+        """Same as render, but as chat messages for the LLM instead of a prompt string."""
+        marked = cls.render(*args, llm=MessageMarkers(llm), **kwargs)
+        if (messages := split_messages(marked)) is not None:
+            return messages
+        return prompt_to_messages(cls.render(*args, llm=llm, **kwargs))
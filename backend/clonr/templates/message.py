@@ -2,7 +2,19 @@ from clonr.data_structures import Memory
 from clonr.data_structures import Message as MessageStruct
 from clonr.data_structures import Monologue
 from clonr.llms import LLM
-from clonr.templates.base import Template, env
+from clonr.llms import Message as LLMMessage
+from clonr.templates.base import (
+    SEGMENT_BREAK,
+    MessageMarkers,
+    Preamble,
+    Template,
+    compile_segments,
+    env,
+    prompt_to_messages,
+    split_messages,
+    system_message,
+    template_version,
+)
 from clonr.utils import get_current_datetime
 from clonr.utils.formatting import DateFormat
 
@@ -288,7 +300,8 @@ Respond only as {{char}} and do not break character.
 
 
 class LongTermMemoryMessage(Template):
-    chat_template = env.from_string(
+    # head, retrieved context, tail, messages. See Preamble
+    source = (
         """\
 {{ llm.system_start -}}
 You are {{char}}, chatting with a user named {{user_name}}. \
@@ -297,7 +310,9 @@ Each section of your profile will begin with ###.
 
 ### Core characteristics
 {{short_description}}
-{{long_description}}
+{{long_description}}"""
+        + SEGMENT_BREAK
+        + """
 
 
 {%- if (monologues) %}
@@ -345,7 +360,9 @@ The following is a list of relevant memories that you've recalled.
 {%- if not loop.last %}
 {% endif %}
 {%- endfor %} 
-{%- endif %}
+{%- endif %}"""
+        + SEGMENT_BREAK
+        + """
 
 
 {%- if (true) %}
@@ -357,6 +374,9 @@ Respond only as {{char}} and do not break character.
 {%- endif -%}
 {{- llm.system_end }}
 
+"""
+        + SEGMENT_BREAK
+        + """\
 {% for msg in messages -%}
 {%- if (msg.is_clone) -%}
 {{ llm.assistant_start -}}
@@ -375,6 +395,51 @@ Respond only as {{char}} and do not break character.
 {{- llm.assistant_end -}}
 """
     )
+    chat_template = env.from_string(source)
+    segments = compile_segments(source)
+    version = template_version(source)
+
+    @classmethod
+    def render_preamble(
+        cls,
+        char: str,
+        user_name: str,
+        short_description: str,
+        long_description: str,
+        llm: LLM,
+    ) -> Preamble:
+        variables = dict(
+            char=char,
+            user_name=user_name,
+            short_description=short_description,
+            long_description=long_description,
+            llm=llm,
+        )
+        head, _, tail, _ = cls.segments
+        return Preamble(head=head.render(variables), tail=tail.render(variables))
+
+    @classmethod
+    def render_context(
+        cls,
+        char: str,
+        user_name: str,
+        memories: list[Memory] | None = None,
+        monologues: list[Monologue] | None = None,
+        facts: list[str] | None = None,
+        agent_summary: str | None = None,
+        entity_context_summary: str | None = None,
+        use_timestamps: bool = False,
+    ) -> str:
+        return cls.segments[1].render(
+            char=char,
+            user_name=user_name,
+            memories=memories,
+            monologues=monologues,
+            facts=facts,
+            agent_summary=agent_summary,
+            entity_context_summary=entity_context_summary,
+            use_timestamps=use_timestamps,
+        )
 
     @classmethod
     def render(
@@ -391,25 +456,99 @@ Respond only as {{char}} and do not break character.
         agent_summary: str | None = None,
         entity_context_summary: str | None = None,
         use_timestamps: bool = False,
+        preamble: Preamble | None = None,
     ):
         cur_time = DateFormat.human_readable(
             get_current_datetime(), use_today_and_yesterday=True
         )
-        return cls.chat_template.render(
+        if preamble is None:
+            preamble = cls.render_preamble(
+                char=char,
+                user_name=user_name,
+                short_description=short_description,
+                long_description=long_description,
+                llm=llm,
+            )
+        context = cls.render_context(
             char=char,
             user_name=user_name,
-            short_description=short_description,
-            long_description=long_description,
+            memories=memories,
+            monologues=monologues,
+            facts=facts,
+            agent_summary=agent_summary,
+            entity_context_summary=entity_context_summary,
+            use_timestamps=use_timestamps,
+        )
+        messages_str = cls.segments[3].render(
             llm=llm,
             messages=messages,
+            cur_time=cur_time,
+            use_timestamps=use_timestamps,
+        )
+        return preamble.head + context + preamble.tail + messages_str
+
+    @classmethod
+    def render_messages(
+        cls,
+        char: str,
+        user_name: str,
+        short_description: str,
+        long_description: str,
+        llm: LLM,
+        messages: list[MessageStruct],
+        memories: list[Memory] | None = None,
+        monologues: list[Monologue] | None = None,
+        facts: list[str] | None = None,
+        agent_summary: str | None = None,
+        entity_context_summary: str | None = None,
+        use_timestamps: bool = False,
+        preamble: Preamble | None = None,
+    ) -> list[LLMMessage]:
+        # everything up to the messages is the system message, so that is cut out of
+        # the (maybe cached) preamble directly, and only the messages need markers
+        cur_time = DateFormat.human_readable(
+            get_current_datetime(), use_today_and_yesterday=True
+        )
+        if preamble is None:
+            preamble = cls.render_preamble(
+                char=char,
+                user_name=user_name,
+                short_description=short_description,
+                long_description=long_description,
+                llm=llm,
+            )
+        context = cls.render_context(
+            char=char,
+            user_name=user_name,
             memories=memories,
             monologues=monologues,
             facts=facts,
             agent_summary=agent_summary,
             entity_context_summary=entity_context_summary,
-            cur_time=cur_time,
             use_timestamps=use_timestamps,
         )
+        system = system_message(llm, preamble.head + context + preamble.tail)
+        chat = split_messages(
+            cls.segments[3].render(
+                llm=MessageMarkers(llm),
+                messages=messages,
+                cur_time=cur_time,
+                use_timestamps=use_timestamps,
+            )
+        )
+        if system is not None and chat is not None:
+            return [system, *chat]
+        return prompt_to_messages(
+            preamble.head
+            + context
+            + preamble.tail
+            + cls.segments[3].render(
+                llm=llm,
+                messages=messages,
+                cur_time=cur_time,
+                use_timestamps=use_timestamps,
+            )
+        )
 
 
 DEFAULT_SYS_PROMPT_HEADER = """\
@@ -437,7 +576,8 @@ Respond concisely, using no more than 3 sentences per response, and do not be he
 
 
 class ZeroMemoryMessageV2(Template):
-    chat_template = env.from_string(
+    # head, retrieved context, tail, messages. See Preamble
+    source = (
         """\
 {{ llm.system_start -}}
 {{sys_prompt_header}}
@@ -450,6 +590,9 @@ denote a person that {{char}} is talking to.
 {{example_dialogues}}
 {%- endif %}
 
+"""
+        + SEGMENT_BREAK
+        + """\
 {% if (facts) %}
 Relevant information about {{char}}:
 {% for f in facts -%}
@@ -459,11 +602,17 @@ Relevant information about {{char}}:
 {% endfor -%}
 {% endif %}
 
+"""
+        + SEGMENT_BREAK
+        + """\
 {% if (scenario) %}
 {{scenario}}
 {%- endif %}
 {{- llm.system_end }}
 
+"""
+        + SEGMENT_BREAK
+        + """\
 {% for msg in messages -%}
 {%- if (msg.is_clone) -%}{{- llm.assistant_start -}}{% else %}{{- llm.user_start -}}{%- endif -%}
 {{msg.content}}
@@ -473,21 +622,22 @@ Relevant information about {{char}}:
 {%- endfor %} 
 """
     )
+    chat_template = env.from_string(source)
+    segments = compile_segments(source)
+    version = template_version(source)
 
     @classmethod
-    def render(
+    def render_preamble(
         cls,
         char: str,
         user: str,
         short_description: str,
         long_description: str,
         llm: LLM,
-        messages: list[MessageStruct],
         scenario: str | None = None,
         example_dialogues: str | None = None,
         sys_prompt_header: str | None = None,
-        facts: list[str] | None = None,
-    ):
+    ) -> Preamble:
         if sys_prompt_header is None:
             sys_prompt_header = DEFAULT_SYS_PROMPT_HEADER
         if scenario is None:
@@ -502,17 +652,92 @@ Relevant information about {{char}}:
             r"{{char}}", char
         )
         scenario = scenario.replace(r"{{user}}", user).replace(r"{{char}}", char)
-        return cls.chat_template.render(
+        variables = dict(
             char=char,
             user=user,
             short_description=short_description,
             long_description=long_description,
             llm=llm,
-            messages=messages,
             example_dialogues=example_dialogues,
             sys_prompt_header=sys_prompt_header,
             scenario=scenario,
-            facts=facts,
+        )
+        head, _, tail, _ = cls.segments
+        return Preamble(head=head.render(variables), tail=tail.render(variables))
+
+    @classmethod
+    def render_context(cls, char: str, facts: list[str] | None = None) -> str:
+        return cls.segments[1].render(char=char, facts=facts)
+
+    @classmethod
+    def render(
+        cls,
+        char: str,
+        user: str,
+        short_description: str,
+        long_description: str,
+        llm: LLM,
+        messages: list[MessageStruct],
+        scenario: str | None = None,
+        example_dialogues: str | None = None,
+        sys_prompt_header: str | None = None,
+        facts: list[str] | None = None,
+        preamble: Preamble | None = None,
+    ):
+        if preamble is None:
+            preamble = cls.render_preamble(
+                char=char,
+                user=user,
+                short_description=short_description,
+                long_description=long_description,
+                llm=llm,
+                scenario=scenario,
+                example_dialogues=example_dialogues,
+                sys_prompt_header=sys_prompt_header,
+            )
+        context = cls.render_context(char=char, facts=facts)
+        messages_str = cls.segments[3].render(llm=llm, messages=messages)
+        return preamble.head + context + preamble.tail + messages_str
+
+    @classmethod
+    def render_messages(
+        cls,
+        char: str,
+        user: str,
+        short_description: str,
+        long_description: str,
+        llm: LLM,
+        messages: list[MessageStruct],
+        scenario: str | None = None,
+        example_dialogues: str | None = None,
+        sys_prompt_header: str | None = None,
+        facts: list[str] | None = None,
+        preamble: Preamble | None = None,
+    ) -> list[LLMMessage]:
+        # same as LongTermMemoryMessage.render_messages
+        if preamble is None:
+            preamble = cls.render_preamble(
+                char=char,
+                user=user,
+                short_description=short_description,
+                long_description=long_description,
+                llm=llm,
+                scenario=scenario,
+                example_dialogues=example_dialogues,
+                sys_prompt_header=sys_prompt_header,
+            )
+        context = cls.render_context(char=char, facts=facts)
+        system = system_message(llm, preamble.head + context + preamble.tail)
+        chat = split_messages(
+            cls.segments[3].render(llm=MessageMarkers(llm), messages=messages)
+        )
+        if system is not None and chat is not None:
+            return [system, *chat]
+        return prompt_to_messages(
+            preamble.head
+            + context
+            + preamble.tail
+            + cls.segments[3].render(llm=llm, messages=messages)
         )
 
     @classmethod
@@ -1,7 +1,12 @@
+import hashlib
+import os
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from enum import Enum
 from functools import lru_cache
 from pathlib import Path
+from typing import Protocol, Sequence
 
 import tiktoken
 
@@ -71,6 +76,54 @@ def _get_hf_tokenizer(model_name_or_path: str, use_fast: bool):
     return AutoTokenizer.from_pretrained(model_name_or_path, use_fast=use_fast)
 
 
+LENGTH_CACHE_SIZE = 65_536
+TOKENIZER_NUM_THREADS = min(8, os.cpu_count() or 1)
+
+
+class _LengthCache:
+    """Bounded LRU of token counts, keyed by tokenizer name and a digest of the text
+    so that long passages aren't kept alive by the cache."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        # tokenizers are shared across threads, e.g. by Index.build in an executor
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: tuple[str, bytes]) -> int | None:
+        with self._lock:
+            if (n := self._data.get(key)) is not None:
+                self._data.move_to_end(key)
+            return n
+
+    def set(self, key: tuple[str, bytes], n: int):
+        with self._lock:
+            self._data[key] = n
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Shared by every tokenizer in the process, they are cheap to create and often are.
+length_cache = _LengthCache(max_size=LENGTH_CACHE_SIZE)
+
+
+def _length_key(name: str, text: str) -> tuple[str, bytes]:
+    return name, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class ChatMessage(Protocol):
+    role: str
+    content: str
+
+
 class Tokenizer(ABC):
     @abstractmethod
     def encode(self, text: str) -> list[int]:
@@ -88,6 +141,13 @@ class Tokenizer(ABC):
     def decode_batch(self, ids: list[list[int]]) -> list[str]:
         pass
 
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        """Identifies the vocabulary, so that stored token counts can be checked
+        against the tokenizer that is currently in use."""
+        pass
+
     @classmethod
     def from_openai(cls, model: str | OpenAIModelEnum) -> "OpenAITokenizer":
         return OpenAITokenizer(model=model)
@@ -100,8 +160,45 @@ class Tokenizer(ABC):
     def from_llama_cpp(cls, *args, **kwargs):
         raise NotImplementedError("Sorry, not gonna implement this one")
 
+    def _length_batch(self, texts: list[str]) -> list[int]:
+        return [len(x) for x in self.encode_batch(texts)]
+
     def length(self, text: str) -> int:
-        return len(self.encode(text))
+        return self.length_batch([text])[0]
+
+    def length_batch(self, texts: Sequence[str]) -> list[int]:
+        """Token counts for many texts at once. Counts come from the shared LRU where
+        possible, and everything else goes through a single batched encode."""
+        keys = [_length_key(self.name, t) for t in texts]
+        lengths = [length_cache.get(k) for k in keys]
+        missing: dict[tuple[str, bytes], str] = {}
+        for k, t, n in zip(keys, texts, lengths):
+            if n is None:
+                missing[k] = t
+        if missing:
+            computed = dict(zip(missing, self._length_batch(list(missing.values()))))
+            for k, n in computed.items():
+                length_cache.set(k, n)
+            lengths = [computed[k] if n is None else n for k, n in zip(keys, lengths)]
+        return lengths  # type: ignore
+
+    def chat_lengths(self, messages: Sequence[ChatMessage]) -> list[int]:
+        """Tokens in the role plus the content of each chat message, without the
+        per-message formatting overhead, which depends on the model. Cached per message,
+        so a growing conversation only tokenizes its new messages."""
+        fields = [
+            (m.role.value if isinstance(m.role, Enum) else m.role, m.content)
+            for m in messages
+        ]
+        name = f"{self.name}::chat"
+        keys = [_length_key(name, f"{role}\x00{content}") for role, content in fields]
+        lengths = [length_cache.get(k) for k in keys]
+        if missing := [i for i, n in enumerate(lengths) if n is None]:
+            counts = self.length_batch([x for i in missing for x in fields[i]])
+            for j, i in enumerate(missing):
+                lengths[i] = counts[2 * j] + counts[2 * j + 1]
+                length_cache.set(keys[i], lengths[i])  # type: ignore
+        return lengths  # type: ignore
 
 
 class OpenAITokenizer(Tokenizer):
@@ -118,12 +215,27 @@ class OpenAITokenizer(Tokenizer):
     def encode_batch(self, text: list[str]) -> list[list[int]]:
         return self.tokenizer.encode_batch(text)
 
+    def _length_batch(self, texts: list[str]) -> list[int]:
+        # tiktoken only spreads a batch over its thread pool for the ordinary encode.
+        # Counts only differ for text containing special tokens, which encode rejects.
+        if len(texts) == 1:
+            return [len(self.tokenizer.encode_ordinary(texts[0]))]
+        ids = self.tokenizer.encode_ordinary_batch(
+            texts, num_threads=TOKENIZER_NUM_THREADS
+        )
+        return [len(x) for x in ids]
+
     def decode(self, ids: list[int]) -> str:
         return self.tokenizer.decode(ids)
 
     def decode_batch(self, ids: list[list[int]]) -> list[str]:
         return self.tokenizer.decode_batch(ids)
 
+    @property
+    def name(self) -> str:
+        # gpt-3.5 and gpt-4 share an encoding, so this is the encoding not the model
+        return self.tokenizer.name
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(model={self.model})"
 
@@ -141,6 +253,16 @@ class HuggingFaceTokenizer(Tokenizer):
     def encode_batch(self, text: list[str]) -> list[list[int]]:
         return self.tokenizer(text, add_special_tokens=False)["input_ids"]
 
+    def _length_batch(self, texts: list[str]) -> list[int]:
+        # fast tokenizers encode a list in parallel on the rust side
+        ids = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )["input_ids"]
+        return [len(x) for x in ids]
+
     def decode(self, ids: list[int]) -> str:
         return self.tokenizer.decode(ids)
 
@@ -149,5 +271,9 @@ class HuggingFaceTokenizer(Tokenizer):
         # homie says they can't go faster. sounds like a load of shit but whatever.
         return [self.tokenizer.decode(x) for x in ids]
 
+    @property
+    def name(self) -> str:
+        return self.model
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(model={self.model})"
@@ -0,0 +1,447 @@
+"""Regex constraints compiled down to per token masks, for guided decoding.
+
+A pattern is compiled into a DFA over characters, and then run over every token of a
+vocab (walking a Trie, so a prefix that the DFA rejects is only ever looked at once)
+to get a table of state x token -> next state. At generation time the allowed tokens
+for the current state are a single row lookup, and advancing the state after a token
+is sampled is another. Building the table is the slow part, so it's cached to disk,
+keyed on the pattern and the vocab.
+
+Only the regular subset of the regex syntax is supported: literals and escapes, the
+\\d \\w \\s classes (ascii only) and their negations, [...] classes with ranges and ^,
+the dot (anything but a newline), groups, alternation, and the * + ? {m} {m,} {m,n}
+quantifiers. The pattern has to match the whole output, like re.fullmatch.
+"""
+import hashlib
+import json
+import string
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import numpy.typing as npt
+from loguru import logger
+
+from .trie import Trie
+
+# bump this when the table layout or the regex semantics change, to orphan old caches
+FORMAT_VERSION = 1
+
+_CLASS_ESCAPES = {
+    "d": string.digits,
+    "w": string.ascii_letters + string.digits + "_",
+    "s": " \t\n\r\f\v",
+}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+_SPECIAL = set("()[]{}|*+?.\\^$")
+
+
+@dataclass(frozen=True)
+class CharSet:
+    chars: frozenset[str]
+    negated: bool = False
+
+    def __contains__(self, ch: str) -> bool:
+        return (ch in self.chars) != self.negated
+
+
+# AST nodes are plain tuples: ("set", CharSet), ("cat", [nodes]), ("alt", [nodes]),
+# ("rep", node, min, max | None)
+Node = tuple
+
+
+class _Parser:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def error(self, msg: str) -> ValueError:
+        return ValueError(f"{msg} at position {self.pos} of regex {self.pattern!r}")
+
+    def peek(self) -> str | None:
+        if self.pos < len(self.pattern):
+            return self.pattern[self.pos]
+        return None
+
+    def next(self) -> str:
+        if (ch := self.peek()) is None:
+            raise self.error("Unexpected end")
+        self.pos += 1
+        return ch
+
+    def parse(self) -> Node:
+        node = self.alternation()
+        if self.pos != len(self.pattern):
+            raise self.error("Unbalanced parenthesis")
+        return node
+
+    def alternation(self) -> Node:
+        options = [self.concatenation()]
+        while self.peek() == "|":
+            self.pos += 1
+            options.append(self.concatenation())
+        return options[0] if len(options) == 1 else ("alt", options)
+
+    def concatenation(self) -> Node:
+        items: list[Node] = []
+        while (ch := self.peek()) is not None and ch not in "|)":
+            items.append(self.repetition())
+        return ("cat", items)
+
+    def repetition(self) -> Node:
+        node = self.atom()
+        while (ch := self.peek()) is not None:
+            if ch == "*":
+                bounds: tuple[int, int | None] = (0, None)
+            elif ch == "+":
+                bounds = (1, None)
+            elif ch == "?":
+                bounds = (0, 1)
+            elif ch == "{" and (braces := self.braces()) is not None:
+                bounds = braces
+            else:
+                break
+            self.pos += 1
+            # lazy quantifiers match the same language, which is all that matters here
+            if self.peek() == "?":
+                self.pos += 1
+            node = ("rep", node, *bounds)
+        return node
+
+    def braces(self) -> tuple[int, int | None] | None:
+        # leaves pos on the closing brace. Like re, anything that isn't a valid
+        # {m}, {m,}, {,n} or {m,n} is just a literal brace.
+        end = self.pattern.find("}", self.pos)
+        if end == -1:
+            return None
+        lo, comma, hi = self.pattern[self.pos + 1 : end].partition(",")
+        if not (lo.isdigit() or (comma and hi)) or (hi and not hi.isdigit()):
+            return None
+        bounds = (int(lo or 0), int(hi) if hi else (None if comma else int(lo)))
+        if bounds[1] is not None and bounds[1] < bounds[0]:
+            raise self.error("Bad repeat interval")
+        self.pos = end
+        return bounds
+
+    def atom(self) -> Node:
+        ch = self.next()
+        if ch == "(":
+            if self.peek() == "?":
+                if self.pattern[self.pos : self.pos + 2] != "?:":
+                    raise self.error("Unsupported group")
+                self.pos += 2
+            node = self.alternation()
+            if self.next() != ")":
+                raise self.error("Missing )")
+            return node
+        if ch == "[":
+            return ("set", self.char_class())
+        if ch == ".":
+            return ("set", CharSet(frozenset("\n"), negated=True))
+        if ch == "\\":
+            return ("set", self.escape())
+        if ch in "*+?":
+            raise self.error("Nothing to repeat")
+        if ch in "^$":
+            raise self.error("Anchors are not supported, patterns always match fully")
+        if ch == ")":
+            raise self.error("Unbalanced parenthesis")
+        return ("set", CharSet(frozenset(ch)))
+
+    def escape(self) -> CharSet:
+        ch = self.next()
+        if ch in _CLASS_ESCAPES:
+            return CharSet(frozenset(_CLASS_ESCAPES[ch]))
+        if ch.lower() in _CLASS_ESCAPES:
+            return CharSet(frozenset(_CLASS_ESCAPES[ch.lower()]), negated=True)
+        if ch in _CHAR_ESCAPES:
+            return CharSet(frozenset(_CHAR_ESCAPES[ch]))
+        if ch in _SPECIAL or not ch.isalnum():
+            return CharSet(frozenset(ch))
+        raise self.error(f"Unsupported escape \\{ch}")
+
+    def char_class(self) -> CharSet:
+        negated = self.peek() == "^"
+        if negated:
+            self.pos += 1
+        chars: set[str] = set()
+        first = True
+        while (ch := self.next()) != "]" or first:
+            first = False
+            if ch == "\\":
+                escaped = self.escape()
+                if escaped.negated:
+                    raise self.error("Negated classes inside [] are not supported")
+                if len(escaped.chars) > 1:
+                    chars |= escaped.chars
+                    continue
+                (ch,) = escaped.chars
+            is_range = self.peek() == "-" and self.pos + 1 < len(self.pattern)
+            if is_range and self.pattern[self.pos + 1] != "]":
+                self.pos += 1
+                hi = self.next()
+                if hi == "\\":
+                    hi_set = self.escape()
+                    if len(hi_set.chars) != 1 or hi_set.negated:
+                        raise self.error("Bad character range")
+                    (hi,) = hi_set.chars
+                if ord(hi) < ord(ch):
+                    raise self.error("Bad character range")
+                chars.update(chr(i) for i in range(ord(ch), ord(hi) + 1))
+            else:
+                chars.add(ch)
+        return CharSet(frozenset(chars), negated=negated)
+
+
+class _NFA:
+    """Thompson construction. Edges are (charset index, target), plus epsilons."""
+
+    def __init__(self):
+        self.charsets: list[CharSet] = []
+        self.edges: list[list[tuple[int, int]]] = []
+        self.eps: list[list[int]] = []
+
+    def state(self) -> int:
+        self.edges.append([])
+        self.eps.append([])
+        return len(self.edges) - 1
+
+    def build(self, node: Node) -> tuple[int, int]:
+        kind = node[0]
+        if kind == "set":
+            start, end = self.state(), self.state()
+            self.charsets.append(node[1])
+            self.edges[start].append((len(self.charsets) - 1, end))
+            return start, end
+        if kind == "cat":
+            start = end = self.state()
+            for child in node[1]:
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                end = e
+            return start, end
+        if kind == "alt":
+            start, end = self.state(), self.state()
+            for child in node[1]:
+                s, e = self.build(child)
+                self.eps[start].append(s)
+                self.eps[e].append(end)
+            return start, end
+        if kind == "rep":
+            _, child, lo, hi = node
+            start = end = self.state()
+            for _ in range(lo):
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                end = e
+            if hi is None:
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                self.eps[e].append(s)
+                last = self.state()
+                self.eps[end].append(last)
+                self.eps[e].append(last)
+                return start, last
+            last = self.state()
+            for _ in range(hi - lo):
+                self.eps[end].append(last)
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                end = e
+            self.eps[end].append(last)
+            return start, last
+        raise ValueError(f"Unknown node {kind}")
+
+    def closure(self, states: Iterable[int]) -> frozenset[int]:
+        seen = set(states)
+        stack = list(seen)
+        while stack:
+            for t in self.eps[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+
+@dataclass
+class DFA:
+    """A DFA over the characters of a given alphabet. Characters with the same
+    behaviour everywhere in the pattern share a class, so the table is
+    state x class rather than state x char. Missing transitions are -1 and state 0
+    is the start."""
+
+    class_of: dict[str, int]
+    table: list[list[int]]
+    accepting: list[bool]
+
+    def step(self, state: int, ch: str) -> int | None:
+        if (k := self.class_of.get(ch)) is None:
+            return None
+        nxt = self.table[state][k]
+        return nxt if nxt >= 0 else None
+
+    def fullmatch(self, text: str) -> bool:
+        state: int | None = 0
+        for ch in text:
+            if (state := self.step(state, ch)) is None:
+                return False
+        return self.accepting[state]
+
+
+def compile_regex(pattern: str, alphabet: Iterable[str]) -> DFA:
+    nfa = _NFA()
+    start, final = nfa.build(_Parser(pattern).parse())
+
+    # characters that no charset contains can never be emitted, so they get no class
+    class_of: dict[str, int] = {}
+    signatures: dict[tuple[bool, ...], int] = {}
+    for ch in set(alphabet):
+        sig = tuple(ch in cs for cs in nfa.charsets)
+        if any(sig):
+            class_of[ch] = signatures.setdefault(sig, len(signatures))
+    class_sigs = sorted(signatures, key=signatures.__getitem__)
+
+    initial = nfa.closure([start])
+    ids = {initial: 0}
+    queue = [initial]
+    table: list[list[int]] = []
+    accepting: list[bool] = []
+    while len(table) < len(queue):
+        states = queue[len(table)]
+        row = []
+        for sig in class_sigs:
+            targets = nfa.closure(
+                t for s in states for cs, t in nfa.edges[s] if sig[cs]
+            )
+            if not targets:
+                row.append(-1)
+                continue
+            if targets not in ids:
+                ids[targets] = len(queue)
+                queue.append(targets)
+            row.append(ids[targets])
+        table.append(row)
+        accepting.append(final in states)
+    return DFA(class_of=class_of, table=table, accepting=accepting)
+
+
+class TokenIndex:
+    """Every token's effect on a regex DFA, for one vocab.
+
+    transitions[state, token] is the state after emitting the token, or -1 if the
+    token isn't allowed there. masks[state] is the same as a bool row, with the eos
+    token allowed exactly in accepting states (or in states that the vocab can't get
+    out of, so that generation can always end).
+    """
+
+    start_state = 0
+
+    def __init__(
+        self,
+        transitions: npt.NDArray[np.int32],
+        accepting: npt.NDArray[np.bool_],
+        eos_token_id: int | None = None,
+    ):
+        self.transitions = transitions
+        self.accepting = accepting
+        self.eos_token_id = eos_token_id
+        self.masks = transitions >= 0
+        if eos_token_id is not None:
+            self.masks[:, eos_token_id] = accepting | ~self.masks.any(axis=1)
+        self.masks.flags.writeable = False
+        self.transitions.flags.writeable = False
+
+    @property
+    def num_states(self) -> int:
+        return self.transitions.shape[0]
+
+    def allowed(self, state: int) -> npt.NDArray[np.bool_]:
+        return self.masks[state]
+
+    def next_state(self, state: int, token_id: int) -> int:
+        return int(self.transitions[state, token_id])
+
+    def is_accepting(self, state: int) -> bool:
+        return bool(self.accepting[state])
+
+    @classmethod
+    def build(
+        cls, pattern: str, vocab: list[str], eos_token_id: int | None = None
+    ) -> "TokenIndex":
+        """vocab[i] is the text of token i. Empty strings (special tokens, or bytes
+        that don't decode on their own) are never allowed."""
+        dfa = compile_regex(pattern, "".join(vocab))
+
+        # the trie stores one index per string, and several tokens can share one
+        trie = Trie()
+        ids_by_text: dict[str, list[int]] = {}
+        for i, text in enumerate(vocab):
+            if text and i != eos_token_id:
+                ids_by_text.setdefault(text, []).append(i)
+        texts = list(ids_by_text)
+        for i, text in enumerate(texts):
+            trie.add(text, i)
+
+        transitions = np.full((len(dfa.table), len(vocab)), -1, dtype=np.int32)
+        for state in range(len(dfa.table)):
+            for i, end_state in trie.walk(state, dfa.step):
+                transitions[state, ids_by_text[texts[i]]] = end_state
+        accepting = np.array(dfa.accepting, dtype=np.bool_)
+        return cls(transitions, accepting, eos_token_id=eos_token_id)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        pattern: str,
+        vocab: list[str],
+        eos_token_id: int | None = None,
+        cache_dir: str | Path | None = None,
+    ) -> "TokenIndex":
+        if cache_dir is None:
+            return cls.build(pattern, vocab, eos_token_id=eos_token_id)
+        path = Path(cache_dir) / f"{cache_key(pattern, vocab)}.npz"
+        if path.exists():
+            try:
+                with np.load(path) as f:
+                    return cls(
+                        f["transitions"], f["accepting"], eos_token_id=eos_token_id
+                    )
+            except (OSError, ValueError, KeyError):
+                logger.warning(f"Rebuilding unreadable token index {path}")
+        res = cls.build(pattern, vocab, eos_token_id=eos_token_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, so a concurrent reader never sees half a file
+        tmp = path.with_suffix(".tmp.npz")
+        np.savez(tmp, transitions=res.transitions, accepting=res.accepting)
+        tmp.replace(path)
+        return res
+
+
+def cache_key(pattern: str, vocab: list[str]) -> str:
+    h = hashlib.sha256(f"{FORMAT_VERSION}\0{pattern}\0".encode())
+    h.update(json.dumps(vocab).encode())
+    return h.hexdigest()[:32]
+
+
+# The outputs that clonr parses as json or as a number, from the point where the
+# prompt stops prefilling them (see clonr.generate).
+JSON_STRING = r'"(?:[^"\\\n]|\\["\\/bfnrtu])*"'
+JSON_INT = r"(?:0|[1-9]\d{0,5})"
+
+RATING_REGEX = r" ?\d"
+# message_queries_create and reflection_queries_create prefill '["'
+QUERY_LIST_REGEX = r'(?:[^"\\\n]|\\["\\/bfnrtu])*"(?: ?, ?' + JSON_STRING + r")* ?\]"
+_REFLECTION_BODY = (
+    r" ?"
+    + JSON_STRING
+    + r' ?, ?"memories" ?: ?\[ ?'
+    + JSON_INT
+    + r"(?: ?, ?"
+    + JSON_INT
+    + r")* ?\] ?\}"
+)
+# reflections_create prefills '[{"insight":'
+REFLECTIONS_REGEX = (
+    _REFLECTION_BODY + r'(?: ?, ?\{ ?"insight" ?:' + _REFLECTION_BODY + r")* ?\]"
+)
@@ -1,7 +1,11 @@
+from typing import Callable, TypeVar
+
 import regex
 
 # import tiktoken
 
+S = TypeVar("S")
+
 
 class Trie:
     """Useful for determing allowed tokens when trying to guide
@@ -71,6 +75,25 @@ class Trie:
                         q.append((v, cur))
         return res
 
+    def walk(self, start: S, step: Callable[[S, str], S | None]) -> list[tuple[int, S]]:
+        """Runs every token through `step` one character at a time, starting from
+        `start`, and returns (index, end state) for the tokens that make it to the end.
+        A whole subtree is skipped as soon as step returns None, so with a state
+        machine that rejects most characters, most of the trie is never visited. See
+        clonr.utils.fsm.
+        """
+        res: list[tuple[int, S]] = []
+        q = [(self._d, start)]
+        while q:
+            d, state = q.pop()
+            for k, v in d.items():
+                if k is None:
+                    if d is not self._d:
+                        res.append((v, state))
+                elif (nxt := step(state, k)) is not None:
+                    q.append((v, nxt))
+        return res
+
     def candidates(self, pattern: str) -> list[dict[str, int]]:
         d = self._d
         res: list[dict[str, int]] = []
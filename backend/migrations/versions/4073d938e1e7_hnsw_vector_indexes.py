@@ -0,0 +1,81 @@
+"""hnsw vector indexes
+
+Revision ID: 4073d938e1e7
+Revises: e9eb5c6aa0dc
+Create Date: 2023-10-02 10:12:41.517203
+
+"""
+from alembic import op
+
+from app.settings import settings
+
+# revision identifiers, used by Alembic.
+revision = "4073d938e1e7"
+down_revision = "e9eb5c6aa0dc"
+branch_labels = None
+depends_on = None
+
+# Most of these tables were created through init_db and never made it into
+# the init migration, hence all of the IF EXISTS guards.
+EMBEDDING_TABLES = [
+    "clones",
+    "messages",
+    "documents",
+    "nodes",
+    "example_dialogues",
+    "example_dialogue_messages",
+    "monologues",
+    "memories",
+]
+
+HNSW_INDEXES = {
+    "ix_clones_embedding_hnsw": "clones",
+    "ix_nodes_embedding_hnsw": "nodes",
+    "ix_monologues_embedding_hnsw": "monologues",
+    "ix_memories_embedding_hnsw": "memories",
+}
+
+BTREE_INDEXES = {
+    "ix_nodes_clone_id": ("nodes", "clone_id"),
+    "ix_monologues_clone_id": ("monologues", "clone_id"),
+    "ix_memories_clone_id_conversation_id": ("memories", "clone_id, conversation_id"),
+}
+
+
+def upgrade() -> None:
+    dim = settings.EMBEDDING_DIMENSION
+    m = settings.HNSW_M
+    ef_construction = settings.HNSW_EF_CONSTRUCTION
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector")
+
+    # HNSW can only index columns with a fixed dimension.
+    for table in EMBEDDING_TABLES:
+        op.execute(
+            f"ALTER TABLE IF EXISTS {table} "
+            f"ALTER COLUMN embedding TYPE vector({dim}) USING embedding::vector({dim})"
+        )
+
+    for name, (table, columns) in BTREE_INDEXES.items():
+        op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+    for name, table in HNSW_INDEXES.items():
+        op.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+            f"USING hnsw (embedding vector_ip_ops) "
+            f"WITH (m = {m}, ef_construction = {ef_construction})"
+        )
+
+
+def downgrade() -> None:
+    for name in HNSW_INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+
+    for name in BTREE_INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+
+    for table in EMBEDDING_TABLES:
+        op.execute(
+            f"ALTER TABLE IF EXISTS {table} "
+            "ALTER COLUMN embedding TYPE vector USING embedding::vector"
+        )
@@ -0,0 +1,44 @@
+"""node weighted embeddings
+
+Revision ID: ceeec9afd42f
+Revises: deb5e6f7e540
+Create Date: 2023-10-16 11:02:38.614920
+
+"""
+from alembic import op
+
+from app.settings import settings
+
+# revision identifiers, used by Alembic.
+revision = "ceeec9afd42f"
+down_revision = "deb5e6f7e540"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    dim = settings.EMBEDDING_DIMENSION
+    m = settings.HNSW_M
+    ef_construction = settings.HNSW_EF_CONSTRUCTION
+
+    op.execute(
+        "ALTER TABLE IF EXISTS nodes "
+        f"ADD COLUMN IF NOT EXISTS weighted_embedding vector({dim})"
+    )
+    # Hierarchical weighting was never actually applied to existing tree documents
+    # (it was passed a single node), so their raw embeddings are what retrieval used.
+    # Re-adding a document computes the weighted ones.
+    op.execute(
+        "UPDATE nodes SET weighted_embedding = embedding "
+        "WHERE weighted_embedding IS NULL"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_nodes_weighted_embedding_hnsw ON nodes "
+        "USING hnsw (weighted_embedding vector_ip_ops) "
+        f"WITH (m = {m}, ef_construction = {ef_construction})"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_nodes_weighted_embedding_hnsw")
+    op.execute("ALTER TABLE IF EXISTS nodes DROP COLUMN IF EXISTS weighted_embedding")
@@ -0,0 +1,82 @@
+"""token counts
+
+Revision ID: deb5e6f7e540
+Revises: 4073d938e1e7
+Create Date: 2023-10-09 14:31:07.228614
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+from app.clone.shared import SHARED_TOKENIZER
+
+# revision identifiers, used by Alembic.
+revision = "deb5e6f7e540"
+down_revision = "4073d938e1e7"
+branch_labels = None
+depends_on = None
+
+# Retrieval enforces token budgets with a running SUM over these columns.
+TOKEN_COUNT_TABLES = ["messages", "nodes", "monologues", "memories"]
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _backfill(table: str):
+    """Counts with whatever tokenizer the app is configured for. Rows counted with a
+    different one are still correct, retrieval just tokenizes them on the fly."""
+    conn = op.get_bind()
+    t = sa.table(
+        table,
+        sa.column("id", sa.Uuid),
+        sa.column("content", sa.String),
+        sa.column("num_tokens", sa.Integer),
+        sa.column("tokenizer_name", sa.String),
+    )
+    update = (
+        sa.update(t)
+        .where(t.c.id == sa.bindparam("row_id"))
+        .values(num_tokens=sa.bindparam("n"), tokenizer_name=SHARED_TOKENIZER.name)
+    )
+    last_id = None
+    while True:
+        q = (
+            sa.select(t.c.id, t.c.content)
+            .where(t.c.num_tokens.is_(None))
+            .order_by(t.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        )
+        if last_id is not None:
+            q = q.where(t.c.id > last_id)
+        rows = conn.execute(q).all()
+        if not rows:
+            break
+        # same code path as counts at insert time, which also doesn't choke on text
+        # that looks like a special token
+        lengths = SHARED_TOKENIZER.length_batch([content for _, content in rows])
+        conn.execute(
+            update,
+            [dict(row_id=id, n=n) for (id, _), n in zip(rows, lengths)],
+        )
+        last_id = rows[-1][0]
+
+
+def upgrade() -> None:
+    for table in TOKEN_COUNT_TABLES:
+        op.execute(
+            f"ALTER TABLE IF EXISTS {table} "
+            "ADD COLUMN IF NOT EXISTS num_tokens INTEGER, "
+            "ADD COLUMN IF NOT EXISTS tokenizer_name VARCHAR"
+        )
+    inspector = sa.inspect(op.get_bind())
+    for table in TOKEN_COUNT_TABLES:
+        if inspector.has_table(table):
+            _backfill(table)
+
+
+def downgrade() -> None:
+    for table in TOKEN_COUNT_TABLES:
+        op.execute(
+            f"ALTER TABLE IF EXISTS {table} "
+            "DROP COLUMN IF EXISTS num_tokens, "
+            "DROP COLUMN IF EXISTS tokenizer_name"
+        )
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from clonr.executor import ConcurrentExecutor
+
+
+@pytest.mark.asyncio
+async def test_map_keeps_order_and_bounds_concurrency():
+    executor = ConcurrentExecutor(max_concurrency=3)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fn(x: int) -> int:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        # later items finish first
+        await asyncio.sleep(0.01 * (10 - x))
+        in_flight -= 1
+        return 2 * x
+
+    assert await executor.map(fn, list(range(10))) == [2 * x for x in range(10)]
+    assert max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_map_retries_failed_items_individually():
+    executor = ConcurrentExecutor(max_retries=2, retry_wait=0)
+    calls: dict[int, int] = {}
+
+    async def fn(x: int) -> int:
+        calls[x] = calls.get(x, 0) + 1
+        if x == 1 and calls[x] < 3:
+            raise RuntimeError("flaky")
+        return x
+
+    assert await executor.map(fn, [0, 1, 2]) == [0, 1, 2]
+    assert calls == {0: 1, 1: 3, 2: 1}
+
+    async def always_fails(x: int) -> int:
+        raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        await executor.map(always_fails, [0])
+
+
+def test_estimate_seconds():
+    executor = ConcurrentExecutor(max_concurrency=4)
+    assert executor.estimate_seconds([100] * 10, seconds_per_call=2) == 6
+    assert executor.estimate_seconds([100] * 10, 2, sequential=True) == 20
+    # 6000 tokens at 3000/min: the second half has to wait a minute
+    limited = ConcurrentExecutor(max_concurrency=4, tokens_per_minute=3000)
+    assert limited.estimate_seconds([600] * 10, seconds_per_call=2) == 62
@@ -0,0 +1,90 @@
+import json
+import random
+import re
+
+import numpy as np
+import pytest
+
+from clonr.utils.fsm import (
+    QUERY_LIST_REGEX,
+    RATING_REGEX,
+    REFLECTIONS_REGEX,
+    TokenIndex,
+    compile_regex,
+)
+
+ALPHABET = 'abcxz019 .@-]\n"\\[{}:,/'
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        r"a|b*c",
+        r"(?:ab){2,3}x?",
+        r"[^a-c\d]+\.",
+        r"a{,2}b{",
+        r"[]a]+",
+        r"\w+@\w+\.(com|org)",
+        r"(a|)+b",
+        r"\W\S?",
+        QUERY_LIST_REGEX,
+        REFLECTIONS_REGEX,
+    ],
+)
+def test_compile_regex_matches_re(pattern):
+    dfa = compile_regex(pattern, ALPHABET + "morg")
+    expected = re.compile(pattern)
+    rng = random.Random(0)
+    for _ in range(2000):
+        s = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 8)))
+        assert dfa.fullmatch(s) == bool(expected.fullmatch(s)), s
+
+
+@pytest.mark.parametrize("pattern", [r"^a", r"a(?=b)", r"(a", r"*a", r"\1", r"[b-a]"])
+def test_compile_regex_unsupported(pattern):
+    with pytest.raises(ValueError):
+        compile_regex(pattern, "ab")
+
+
+def test_outputs_parse():
+    for prefill, pattern, output in [
+        ("RATING:", RATING_REGEX, " 7"),
+        ('["', QUERY_LIST_REGEX, 'what is \\"it\\"?", "why" ]'),
+        (
+            '[{"insight":',
+            REFLECTIONS_REGEX,
+            ' "a", "memories": [0, 12]}, {"insight": "b", "memories":[3]}]',
+        ),
+    ]:
+        assert compile_regex(pattern, output).fullmatch(output)
+        if prefill.startswith("["):
+            json.loads(prefill + output)
+
+
+vocab = ["", "<eos>", "a", '"', "]", '",', ' "', "ab", 'b"]', "\n", ", ", "ab"]
+
+
+def test_token_index():
+    index = TokenIndex.build(QUERY_LIST_REGEX, vocab, eos_token_id=1)
+    allowed = {vocab[i] for i in np.flatnonzero(index.allowed(index.start_state))}
+    assert allowed == {"a", '"', "]", '",', ' "', "ab", 'b"]', ", "}
+
+    state = index.start_state
+    for token in ["ab", '",', ' "', "a", 'b"]']:
+        state = index.next_state(state, vocab.index(token))
+        assert state >= 0
+    assert index.is_accepting(state)
+    # once the list is closed, the only way out is eos
+    assert np.flatnonzero(index.allowed(state)).tolist() == [1]
+    # duplicate token texts are both allowed
+    assert index.allowed(index.start_state)[[7, 11]].all()
+
+
+def test_token_index_disk_cache(tmp_path):
+    index = TokenIndex.load_or_build(QUERY_LIST_REGEX, vocab, 1, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    loaded = TokenIndex.load_or_build(QUERY_LIST_REGEX, vocab, 1, cache_dir=tmp_path)
+    assert (loaded.masks == index.masks).all()
+    assert (loaded.transitions == index.transitions).all()
+    TokenIndex.load_or_build(RATING_REGEX, vocab, 1, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.npz"))) == 2
@@ -0,0 +1,158 @@
+import types
+
+import pytest
+
+from clonr._grammar import parse_prompt
+from clonr.data_structures import Memory, Message, Monologue
+from clonr.templates import LongTermMemoryMessage, Summarize, ZeroMemoryMessageV2
+from clonr.templates.base import env, prompt_to_messages
+
+llm = types.SimpleNamespace(
+    system_start="<s>",
+    system_end="</s>",
+    user_start="<u>",
+    user_end="</u>",
+    assistant_start="<a>",
+    assistant_end="</a>",
+)
+
+messages = [
+    Message(sender_name="Al", content="hi there", is_clone=False, parent_id=None),
+    Message(sender_name="Bob", content="hey", is_clone=True, parent_id=None),
+]
+
+
+@pytest.mark.parametrize("msgs", [[], messages])
+@pytest.mark.parametrize("facts", [None, [], ["one fact", "another fact"]])
+@pytest.mark.parametrize("example_dialogues", [None, "{{char}}: hello"])
+def test_zero_memory_segments_match_whole_template(msgs, facts, example_dialogues):
+    kwargs = dict(
+        char="Bob",
+        user="Al",
+        short_description="short",
+        long_description="long",
+        llm=llm,
+        messages=msgs,
+        scenario="scenario",
+        example_dialogues=example_dialogues,
+        sys_prompt_header="header",
+        facts=facts,
+    )
+    whole = env.from_string(ZeroMemoryMessageV2.source).render(**kwargs)
+    assert len(ZeroMemoryMessageV2.segments) == 4
+    assert ZeroMemoryMessageV2.render(**kwargs) == whole
+
+    preamble = ZeroMemoryMessageV2.render_preamble(
+        char="Bob",
+        user="Al",
+        short_description="short",
+        long_description="long",
+        llm=llm,
+        scenario="scenario",
+        example_dialogues=example_dialogues,
+        sys_prompt_header="header",
+    )
+    assert ZeroMemoryMessageV2.render(**kwargs, preamble=preamble) == whole
+
+
+@pytest.mark.parametrize("msgs", [[], messages])
+@pytest.mark.parametrize("memories", [None, [Memory(content="mem", importance=3)]])
+@pytest.mark.parametrize("monologues", [None, [Monologue(content="q", source="s")]])
+@pytest.mark.parametrize("summary", [None, "a summary"])
+def test_long_term_memory_segments_match_whole_template(
+    msgs, memories, monologues, summary
+):
+    kwargs = dict(
+        char="Bob",
+        user_name="Al",
+        short_description="short",
+        long_description="long",
+        llm=llm,
+        messages=msgs,
+        memories=memories,
+        monologues=monologues,
+        facts=["a fact"],
+        agent_summary=summary,
+        entity_context_summary=summary,
+    )
+    rendered = LongTermMemoryMessage.render(**kwargs)
+    # cur_time is only used for timestamps, which are off here
+    whole = env.from_string(LongTermMemoryMessage.source).render(
+        **kwargs, cur_time="", use_timestamps=False
+    )
+    assert rendered == whole
+
+    preamble = LongTermMemoryMessage.render_preamble(
+        char="Bob",
+        user_name="Al",
+        short_description="short",
+        long_description="long",
+        llm=llm,
+    )
+    assert LongTermMemoryMessage.render(**kwargs, preamble=preamble) == whole
+
+
+chatml = types.SimpleNamespace(
+    system_start="<|im_start|>system\n",
+    system_end="<|im_end|>",
+    user_start="<|im_start|>user\n",
+    user_end="<|im_end|>",
+    assistant_start="<|im_start|>assistant\n",
+    assistant_end="<|im_end|>",
+    default_system_prompt="You are a helpful assistant.",
+)
+
+
+def test_parse_prompt():
+    prompt = "<|im_start|>system\n sys <|im_end|>\n\n<|im_start|>user hi<|im_end|>\n"
+    assert parse_prompt(prompt) == [
+        dict(role="system", content="sys"),
+        dict(role="user", content="hi"),
+    ]
+    with pytest.raises(ValueError):
+        parse_prompt("<|im_start|>user\nno end")
+    with pytest.raises(ValueError):
+        parse_prompt("<|im_start|>users\nhi<|im_end|>")
+    with pytest.raises(ValueError):
+        parse_prompt("<|im_start|>user\nhi<|im_end|> trailing")
+
+
+@pytest.mark.parametrize("msgs", [[], messages])
+def test_render_messages_match_parsed_prompt(msgs):
+    cases = [
+        (
+            ZeroMemoryMessageV2,
+            dict(
+                char="Bob",
+                user="Al",
+                short_description="short",
+                long_description="long",
+                messages=msgs,
+                facts=["a fact"],
+            ),
+        ),
+        (
+            LongTermMemoryMessage,
+            dict(
+                char="Bob",
+                user_name="Al",
+                short_description="short",
+                long_description="long",
+                messages=msgs,
+                memories=[Memory(content="mem", importance=3)],
+            ),
+        ),
+        (Summarize, dict(passage="a passage")),
+    ]
+    for template, kwargs in cases:
+        expected = prompt_to_messages(template.render(llm=chatml, **kwargs))
+        assert template.render_messages(llm=chatml, **kwargs) == expected
+
+
+def test_render_messages_keep_markers_in_content():
+    # the string prompt can't be parsed back, the messages come out whole
+    system, user = Summarize.render_messages(
+        llm=chatml, passage="look <|im_end|> here"
+    )[:2]
+    assert system.role == "system"
+    assert "look <|im_end|> here" in user.content
@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+import uuid
+
+import pytest
+
+from app import models
+from app.clone.cache import CloneCache, _dump_model, _load_model
+from app.clone.db import CloneDB
+from app.settings import settings
+
+WINDOW = 3
+
+
+class FakeRedis:
+    """The list commands the conversation window uses, on plain python lists."""
+
+    def __init__(self):
+        self.data: dict[str, list[bytes]] = {}
+
+    async def lrange(self, key, start, end):
+        items = self.data.get(key, [])
+        return items[start : None if end == -1 else end + 1]
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, conn: FakeRedis):
+        self.conn = conn
+        self.commands: list = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    async def execute(self):
+        data = self.conn.data
+        for name, (key, *args) in self.commands:
+            match name:
+                case "delete":
+                    data.pop(key, None)
+                case "rpush":
+                    data.setdefault(key, []).extend(args)
+                case "lpushx":
+                    if key in data:
+                        data[key].insert(0, args[0])
+                case "lpop":
+                    if data.get(key):
+                        data[key].pop(0)
+                case "ltrim":
+                    data[key] = data.get(key, [])[args[0] : args[1] + 1]
+                    if not data[key]:
+                        del data[key]
+                case "expire":
+                    pass
+                case _:
+                    raise NotImplementedError(name)
+        self.commands.clear()
+
+
+def make_message(content: str, conversation_id: uuid.UUID) -> models.Message:
+    return models.Message(
+        id=uuid.uuid4(),
+        content=content,
+        sender_name="foo",
+        is_clone=False,
+        is_main=True,
+        is_active=True,
+        timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+        parent_id=None,
+        clone_id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        conversation_id=conversation_id,
+    )
+
+
+@pytest.fixture(autouse=True)
+def window_size(monkeypatch):
+    monkeypatch.setattr(settings, "CONVERSATION_CACHE_NUM_MESSAGES", WINDOW)
+
+
+def contents(messages) -> list[str]:
+    return [m.content for m in messages]
+
+
+def test_cached_message_round_trip():
+    msg = models.Message(
+        id=uuid.uuid4(),
+        content="foo bar baz",
+        sender_name="foo",
+        is_clone=True,
+        is_main=True,
+        is_active=True,
+        timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+        embedding=[0.0] * 384,
+        parent_id=None,
+        clone_id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        conversation_id=uuid.uuid4(),
+        num_tokens=3,
+        tokenizer_name="cl100k_base",
+    )
+    cached = _load_model(models.Message, _dump_model(msg))
+    assert cached.id == msg.id
+    assert cached.timestamp == msg.timestamp
+    assert cached.time_str == msg.time_str
+    assert cached.parent_id is None
+    assert (cached.num_tokens, cached.tokenizer_name) == (3, "cl100k_base")
+    # embeddings are left out of the cache
+    assert cached.embedding is None
+
+
+def test_cached_summary_round_trip():
+    summary = models.AgentSummary(
+        id=uuid.uuid4(),
+        content="foo",
+        timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+        clone_id=uuid.uuid4(),
+        conversation_id=uuid.uuid4(),
+    )
+    cached = _load_model(models.AgentSummary, _dump_model(summary))
+    assert (cached.id, cached.content) == (summary.id, summary.content)
+    assert cached.timestamp == summary.timestamp
+
+
+def test_push_message_needs_a_cached_window():
+    cache = CloneCache(FakeRedis())
+    convo_id = uuid.uuid4()
+    asyncio.run(cache.push_message(convo_id, make_message("a", convo_id)))
+    assert asyncio.run(cache.get_recent_messages(convo_id)) is None
+
+
+def test_push_message_trims_and_replaces():
+    cache = CloneCache(FakeRedis())
+    convo_id = uuid.uuid4()
+    msgs = [make_message(x, convo_id) for x in "cba"]
+    asyncio.run(cache.set_recent_messages(convo_id, msgs))
+
+    asyncio.run(cache.push_message(convo_id, make_message("d", convo_id)))
+    window = asyncio.run(cache.get_recent_messages(convo_id))
+    assert contents(window) == ["d", "c", "b"]
+
+    revision = make_message("d2", convo_id)
+    asyncio.run(cache.push_message(convo_id, revision, replaces_last=True))
+    window = asyncio.run(cache.get_recent_messages(convo_id))
+    assert contents(window) == ["d2", "c", "b"]
+    assert window[0].id == revision.id
+
+
+class FakeCloneDB(CloneDB):
+    """Postgres is a list of messages, newest first."""
+
+    def __init__(self, cache: CloneCache, messages: list[models.Message]):
+        self.cache = cache
+        self.conversation_id = messages[0].conversation_id
+        self.messages = messages
+        self.queries: list[int] = []
+
+    async def _query_messages(self, num_messages, num_tokens):
+        self.queries.append(num_messages)
+        return self.messages[:num_messages]
+
+
+def test_get_messages_fills_the_window():
+    convo_id = uuid.uuid4()
+    clonedb = FakeCloneDB(
+        CloneCache(FakeRedis()), [make_message(x, convo_id) for x in "edcba"]
+    )
+    assert contents(asyncio.run(clonedb.get_messages(num_messages=2))) == ["e", "d"]
+    assert clonedb.queries == [WINDOW]
+    # served from the cached window now
+    assert contents(asyncio.run(clonedb.get_messages(num_messages=1))) == ["e"]
+    assert clonedb.queries == [WINDOW]
+
+
+def test_get_messages_past_a_full_window_goes_to_postgres():
+    convo_id = uuid.uuid4()
+    clonedb = FakeCloneDB(
+        CloneCache(FakeRedis()), [make_message(x, convo_id) for x in "edcba"]
+    )
+    assert contents(asyncio.run(clonedb.get_messages(num_messages=4))) == list("edcb")
+    assert clonedb.queries == [WINDOW, 4]
+
+
+def test_get_messages_short_window_is_the_whole_conversation():
+    convo_id = uuid.uuid4()
+    clonedb = FakeCloneDB(
+        CloneCache(FakeRedis()), [make_message(x, convo_id) for x in "ba"]
+    )
+    assert contents(asyncio.run(clonedb.get_messages())) == ["b", "a"]
+    assert contents(asyncio.run(clonedb.get_messages(num_messages=10))) == ["b", "a"]
+    assert clonedb.queries == [WINDOW]
@@ -0,0 +1,61 @@
+import uuid
+
+import numpy as np
+
+from app.clone.db import hierarchical_embeddings
+from clonr.data_structures import Node
+
+
+def make_tree(depths: list[int], dim: int = 8) -> list[Node]:
+    """Every node below the top level gets a parent one level up, two children each."""
+    rng = np.random.default_rng(0)
+    doc_id = uuid.uuid4()
+    nodes: list[Node] = []
+    for depth, count in enumerate(depths):
+        parents = [nd for nd in nodes if nd.depth == depth - 1]
+        for i in range(count):
+            emb = rng.normal(size=dim)
+            nodes.append(
+                Node(
+                    index=i,
+                    content=f"{depth}-{i}",
+                    embedding=(emb / np.linalg.norm(emb)).tolist(),
+                    is_leaf=depth == len(depths) - 1,
+                    depth=depth,
+                    parent_id=parents[i // 2].id if parents else None,
+                    document_id=doc_id,
+                )
+            )
+    return nodes
+
+
+def reference(nodes: list[Node], gamma: float) -> np.ndarray:
+    by_id = {nd.id: nd for nd in nodes}
+    out = []
+    for nd in nodes:
+        emb = np.array(nd.embedding)
+        if nd.parent_id:
+            cur, g = nd, gamma
+            while cur.parent_id:
+                cur = by_id[cur.parent_id]
+                emb = emb + g * np.array(cur.embedding)
+                g *= gamma
+            emb /= np.linalg.norm(emb)
+        out.append(emb)
+    return np.array(out)
+
+
+def test_hierarchical_embeddings_match_parent_chains():
+    # shuffled, so children can come before their parents
+    nodes = make_tree([2, 4, 8])
+    nodes = [nodes[i] for i in np.random.default_rng(1).permutation(len(nodes))]
+    weighted = hierarchical_embeddings(nodes, weight_decay_factor=0.5)
+    assert weighted.dtype == np.float32
+    assert weighted.shape == (len(nodes), 8)
+    np.testing.assert_allclose(weighted, reference(nodes, 0.5), atol=1e-6)
+
+
+def test_hierarchical_embeddings_without_decay_are_raw():
+    nodes = make_tree([2, 4])
+    weighted = hierarchical_embeddings(nodes, weight_decay_factor=0)
+    np.testing.assert_allclose(weighted, [nd.embedding for nd in nodes], atol=1e-7)
@@ -1,7 +1,7 @@
 import numpy as np
 import pytest
 
-from app.embedding import EmbeddingClient
+from app.embedding import EmbeddingCache, EmbeddingClient, embedding_cache_key
 
 
 @pytest.mark.asyncio
@@ -39,3 +39,26 @@ async def test_encoding_and_ranking():
         # test that foo is closest to foo
         scrs = np.array(await client.rerank_score(query, passages))
         assert scrs[1] > scrs[0] and scrs[1] > scrs[2], scrs
+
+
+def test_embedding_cache():
+    cache = EmbeddingCache(max_size=2, ttl_seconds=60)
+    a, b, c = (np.full(4, i, dtype=np.float32) for i in range(3))
+    cache.set("a", a)
+    cache.set("b", b)
+    assert cache.get("a") is a  # a is now most recently used
+    cache.set("c", c)
+    assert cache.get("b") is None, "Least recently used entry should be evicted"
+    assert cache.get("a") is a and cache.get("c") is c
+    assert len(cache) == 2
+
+    expired = EmbeddingCache(max_size=2, ttl_seconds=-1)
+    expired.set("a", a)
+    assert expired.get("a") is None
+    assert len(expired) == 0
+
+    # whitespace is normalized, but mode and encoder are part of the key
+    key = embedding_cache_key("e5", "query", "hello  world ")
+    assert key == embedding_cache_key("e5", "query", "hello world")
+    assert key != embedding_cache_key("e5", "passage", "hello world")
+    assert key != embedding_cache_key("e6", "query", "hello world")
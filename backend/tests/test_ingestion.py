@@ -0,0 +1,60 @@
+import uuid
+
+from app import schemas
+from app.clone.ingestion import STAGES, Checkpoint, embedding_batches
+from clonr.data_structures import Document, Node
+
+
+class WordTokenizer:
+    def length_batch(self, texts: list[str]) -> list[int]:
+        return [len(x.split()) for x in texts]
+
+
+def make_nodes(doc: Document, lengths: list[int]) -> list[Node]:
+    return [
+        Node(
+            content=" ".join(["foo"] * n),
+            index=i,
+            document_id=doc.id,
+            is_leaf=True,
+            depth=0,
+        )
+        for i, n in enumerate(lengths)
+    ]
+
+
+def test_checkpoint_round_trip():
+    doc = Document(content="foo bar baz", name="foo")
+    nodes = make_nodes(doc, [2, 3])
+    nodes[0].embedding = [0.5] * 4
+    nodes[0].embedding_model = "foo"
+    checkpoint = Checkpoint.model_validate_json(Checkpoint(doc=doc, nodes=nodes).dump())
+    assert checkpoint.doc.id == doc.id and checkpoint.doc.hash == doc.hash
+    assert [x.id for x in checkpoint.nodes] == [x.id for x in nodes]
+    assert checkpoint.nodes[0].embedding == [0.5] * 4
+    # not embedded yet, so the embed stage picks it up on resume
+    assert checkpoint.nodes[1].embedding is None
+
+
+def test_embedding_batches_respect_token_budget():
+    doc = Document(content="foo", name="foo")
+    nodes = make_nodes(doc, [3, 3, 3, 10, 1, 1])
+    batches = embedding_batches(nodes, WordTokenizer(), max_tokens=6)  # type: ignore
+    assert [[x.index for x in b] for b in batches] == [[0, 1], [2], [3], [4, 5]]
+
+
+def test_job_resumes_after_last_completed_stage():
+    job = schemas.DocumentJob(
+        id=uuid.uuid4(),
+        clone_id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        document_id=uuid.uuid4(),
+        index_type="list",
+        stage=schemas.DocumentJobStage.embed,
+    )
+    job = schemas.DocumentJob.model_validate_json(job.model_dump_json())
+    remaining = STAGES[STAGES.index(job.stage) + 1 :]
+    assert remaining == [
+        schemas.DocumentJobStage.summarize,
+        schemas.DocumentJobStage.insert,
+    ]
@@ -0,0 +1,61 @@
+import datetime
+import types
+import uuid
+
+import pytest
+
+from app import models
+from app.clone import preamble
+
+llm = types.SimpleNamespace(
+    system_start="<s>",
+    system_end="</s>",
+    user_start="<u>",
+    user_end="</u>",
+    assistant_start="<a>",
+    assistant_end="</a>",
+    num_tokens=lambda text: len(text.split()),
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    preamble.preamble_cache.clear()
+    yield
+    preamble.preamble_cache.clear()
+
+
+def make_clone() -> models.Clone:
+    return models.Clone(
+        id=uuid.uuid4(),
+        name="Bob",
+        short_description="short",
+        long_description="long",
+        scenario="scenario",
+        fixed_dialogues="{{char}}: hello",
+        sys_prompt_header="header",
+        num_messages=0,
+        updated_at=datetime.datetime(2023, 1, 1),
+    )
+
+
+def test_new_message_keeps_the_entry():
+    clone = make_clone()
+    first = preamble.zero_memory_preamble(clone, user_name="Al", llm=llm)
+    # what the message counters do to the row after every insert
+    clone.num_messages += 1
+    clone.updated_at += datetime.timedelta(seconds=1)
+    assert preamble.zero_memory_preamble(clone, user_name="Al", llm=llm) is first
+    assert len(preamble.preamble_cache) == 1
+
+
+def test_edited_clone_misses():
+    clone = make_clone()
+    first = preamble.zero_memory_preamble(clone, user_name="Al", llm=llm)
+    clone.long_description = "longer"
+    second = preamble.zero_memory_preamble(clone, user_name="Al", llm=llm)
+    assert second is not first
+    assert "longer" in second.preamble.head + second.preamble.tail
+
+    preamble.preamble_cache.invalidate(clone.id)
+    assert len(preamble.preamble_cache) == 0
@@ -0,0 +1,95 @@
+import asyncio
+import types
+import uuid
+
+import pytest
+
+from app import models
+from app.clone import retrieval
+from app.clone.types import VectorSearchParams
+
+INF = retrieval.INF
+
+
+class FakeSession:
+    """Answers the pgvector version lookup, and hands out canned rows for searches."""
+
+    def __init__(self, version: str, results: list[list]):
+        self.version = version
+        self.results = results
+        self.statements: list[str] = []
+
+    async def scalar(self, stmt):
+        return self.version
+
+    async def execute(self, stmt):
+        sql = str(stmt)
+        self.statements.append(sql)
+        rows = [] if "set_config" in sql else self.results.pop(0)
+        return types.SimpleNamespace(all=lambda: rows)
+
+
+def rows(n: int) -> list:
+    return [(models.Memory(id=uuid.uuid4(), content="x"), 0.1) for _ in range(n)]
+
+
+@pytest.fixture(autouse=True)
+def reset_pgvector_version(monkeypatch):
+    monkeypatch.setattr(retrieval, "_pgvector_version", None)
+
+
+def search(db: FakeSession, filtered: bool = True) -> list:
+    return asyncio.run(
+        retrieval.vector_search_by_embedding(
+            embedding=[0.0] * models.EMBEDDING_DIMENSION,
+            model=models.Memory,
+            params=VectorSearchParams(max_items=3),
+            db=db,  # type: ignore
+            tokenizer=None,  # type: ignore
+            filters=[models.Memory.clone_id == uuid.uuid4()] if filtered else None,
+        )
+    )
+
+
+def test_short_filtered_search_is_retried_exactly():
+    db = FakeSession("0.7.4", [rows(1), rows(3)])
+    assert len(search(db)) == 3
+    assert [x.count("set_config(") for x in db.statements if "set_config" in x] == [1]
+    searches = [x for x in db.statements if "set_config" not in x]
+    assert len(searches) == 2
+    # the retry orders by the shifted distance, which can't use the index
+    assert "1 + (memories.embedding <#>" in searches[1].split("ORDER BY")[-1]
+
+
+def test_iterative_scan_skips_the_retry():
+    db = FakeSession("0.8.0", [rows(1)])
+    assert len(search(db)) == 1
+    # ef_search and iterative_scan
+    assert [x.count("set_config(") for x in db.statements if "set_config" in x] == [2]
+
+
+def test_unfiltered_search_is_not_retried():
+    db = FakeSession("0.7.4", [rows(1)])
+    assert len(search(db, filtered=False)) == 1
+
+
+@pytest.mark.parametrize(
+    "lengths,max_items,max_tokens,expected",
+    [
+        ([10, 10, 10], 3, INF, False),
+        ([10], 3, INF, True),
+        ([], 3, INF, True),
+        ([10], INF, INF, False),
+        # the budget cut it off, another row that size wouldn't have fit
+        ([40, 50], 3, 100, False),
+        ([10, 10], 3, 100, True),
+    ],
+)
+def test_is_short(lengths, max_items, max_tokens, expected):
+    params = VectorSearchParams(max_items=max_items, max_tokens=max_tokens)
+    assert retrieval.is_short(lengths, params) == expected
+
+
+def test_parse_version():
+    assert retrieval.parse_version("0.8.0") == (0, 8, 0)
+    assert retrieval.parse_version("0.5.1") < retrieval.ITERATIVE_SCAN_MIN_PGVECTOR
@@ -1,8 +1,15 @@
-from clonr.tokenizer import HuggingFaceTokenizer, OpenAITokenizer, Tokenizer
+from clonr.llms.schemas import Message
+from clonr.tokenizer import (
+    HuggingFaceTokenizer,
+    OpenAITokenizer,
+    Tokenizer,
+    length_cache,
+)
 
 
 def test_openai_tokenizer():
     tok = OpenAITokenizer("gpt-3.5-turbo")
+    assert tok.name == OpenAITokenizer("gpt-4").name == "cl100k_base"
     assert len(tok.encode("foo bar baz foo bar baz")) > 2
     assert len(tok.encode_batch(4 * ["foo bar baz foo bar baz"])) == 4
     assert type(tok.decode(tok.encode("foo bar baz foo bar baz"))) == str
@@ -11,6 +18,7 @@ def test_openai_tokenizer():
 
 def test_huggingface_tokenizer():
     tok = HuggingFaceTokenizer(model="hf-internal-testing/llama-tokenizer")
+    assert tok.name == "hf-internal-testing/llama-tokenizer"
     assert len(tok.encode("foo bar baz foo bar baz")) > 2
     assert len(tok.encode_batch(4 * ["foo bar baz foo bar baz"])) == 4
     assert type(tok.decode(tok.encode("foo bar baz foo bar baz"))) == str
@@ -21,3 +29,52 @@ def test_instantiations():
     name = "hf-internal-testing/llama-tokenizer"
     assert isinstance(Tokenizer.from_openai("gpt-3.5-turbo"), OpenAITokenizer)
     assert isinstance(Tokenizer.from_huggingface(name), HuggingFaceTokenizer)
+
+
+class WhitespaceTokenizer(Tokenizer):
+    def __init__(self):
+        self.calls: list[list[str]] = []
+
+    def encode(self, text: str) -> list[int]:
+        return self.encode_batch([text])[0]
+
+    def encode_batch(self, text: list[str]) -> list[list[int]]:
+        self.calls.append(text)
+        return [list(range(len(x.split()))) for x in text]
+
+    def decode(self, ids: list[int]) -> str:
+        raise NotImplementedError
+
+    def decode_batch(self, ids: list[list[int]]) -> list[str]:
+        raise NotImplementedError
+
+    @property
+    def name(self) -> str:
+        return "whitespace"
+
+
+def test_length_batch_is_cached():
+    length_cache.clear()
+    tok = WhitespaceTokenizer()
+    assert tok.length_batch(["a b", "c", "a b", "d e f"]) == [2, 1, 2, 3]
+    assert tok.calls == [["a b", "c", "d e f"]]
+    assert tok.length_batch(["c", "g h", "a b"]) == [1, 2, 2]
+    assert tok.calls[-1] == ["g h"]
+    assert tok.length("d e f") == 3
+    assert len(tok.calls) == 2
+
+
+def test_chat_lengths():
+    length_cache.clear()
+    tok = WhitespaceTokenizer()
+    msgs = [Message(role="system", content="a b c"), Message(role="user", content="d")]
+    assert tok.chat_lengths(msgs) == [4, 2]
+    n_calls = len(tok.calls)
+    assert tok.chat_lengths(msgs) == [4, 2]
+    assert len(tok.calls) == n_calls
+
+
+def test_openai_length_batch():
+    tok = OpenAITokenizer("gpt-3.5-turbo")
+    texts = ["foo bar baz", "hello world, how are you?", ""]
+    assert tok.length_batch(texts) == [len(tok.encode(x)) for x in texts]
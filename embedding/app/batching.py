@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+import numpy as np
+from opentelemetry import metrics
+
+APP_NAME = "embeddings.server"
+
+meter = metrics.get_meter(APP_NAME)
+
+batch_size_meter = meter.create_histogram(
+    name="embedding_microbatch_size",
+    description="Number of texts per coalesced inference call",
+)
+batch_requests_meter = meter.create_histogram(
+    name="embedding_microbatch_requests",
+    description="Number of RPCs coalesced into a single inference call",
+)
+batch_window_meter = meter.create_histogram(
+    name="embedding_microbatch_window_seconds",
+    description="Time between the first request of a micro-batch arriving and the batch being dispatched",
+    unit="s",
+)
+
+
+class MicroBatcher:
+    """Coalesces texts from concurrent requests into a single inference call.
+
+    The first request to arrive opens a window of `window_ms`. Everything submitted
+    before the window closes (or before `max_batch_size` texts have piled up) is run
+    as one batch through `run(fn, texts)`, and each caller gets back its rows of the
+    resulting array, in order. The encoder takes care of grouping the texts by length.
+
+    A window of 0 disables coalescing and every request runs on its own.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list[str]], np.ndarray],
+        run: Callable[
+            [Callable[[list[str]], np.ndarray], list[str]], Awaitable[np.ndarray]
+        ],
+        window_ms: float = 2.0,
+        max_batch_size: int = 32,
+        method: str = "",
+    ):
+        self.fn = fn
+        self.run = run
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.method = method
+        self._pending: list[tuple[list[str], asyncio.Future[np.ndarray]]] = []
+        self._num_pending_texts = 0
+        self._window_opened_at = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, texts: list[str]) -> np.ndarray:
+        if self.window_ms <= 0 or not texts:
+            return await self.run(self.fn, texts)
+
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future[np.ndarray] = loop.create_future()
+        self._pending.append((texts, fut))
+        self._num_pending_texts += len(texts)
+
+        if self._num_pending_texts >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._window_opened_at = time.perf_counter()
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        self._num_pending_texts = 0
+        if not batch:
+            return
+        attributes = dict(method=self.method, app_name=APP_NAME)
+        batch_window_meter.record(
+            amount=time.perf_counter() - self._window_opened_at, attributes=attributes
+        )
+        # hold a reference, otherwise the task can be garbage collected mid-flight
+        task = asyncio.create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(
+        self, batch: list[tuple[list[str], asyncio.Future[np.ndarray]]]
+    ):
+        # callers that gave up (e.g. a cancelled RPC) don't need to be computed
+        batch = [(texts, fut) for texts, fut in batch if not fut.done()]
+        if not batch:
+            return
+        texts = [t for x, _ in batch for t in x]
+        attributes = dict(method=self.method, app_name=APP_NAME)
+        batch_size_meter.record(amount=len(texts), attributes=attributes)
+        batch_requests_meter.record(amount=len(batch), attributes=attributes)
+
+        try:
+            results = await self.run(self.fn, texts)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        offset = 0
+        for x, fut in batch:
+            if not fut.done():
+                fut.set_result(results[offset : offset + len(x)])
+            offset += len(x)
@@ -1,4 +1,5 @@
 import numpy as np
+import onnxruntime as ort
 import transformers
 from loguru import logger
 from optimum.onnxruntime import (
@@ -11,10 +12,34 @@ from .types import CrossEncoderEnum, EmbeddingModelEnum, EmbeddingType
 from .utils import get_artifacts_dir, get_hf_tokenizer
 
 # On CPU, sequential execution is pretty fast so it quickly outweighs
-# The benefits of batching minus the downsides of padding. If using
-# sequences without padding though, use a larger batch size.
-# In the future we can also do this dynamically by scanning the stddev of lengths in a batch
-MAX_BATCH_SIZE: int = 4
+# The benefits of batching minus the downsides of padding. Inputs are sorted by
+# token length and then greedily grouped so that each batch holds at most
+# MAX_BATCH_TOKENS tokens including padding. Short inputs form large batches
+# and long inputs run close to one at a time.
+MAX_BATCH_SIZE: int = 32
+MAX_BATCH_TOKENS: int = 2048
+
+
+def token_budget_batches(
+    lengths: list[int], max_batch_tokens: int, max_batch_size: int
+) -> list[list[int]]:
+    """Groups indices of `lengths` into batches sorted by length, where each batch has
+    at most `max_batch_size` items and len(batch) * max(lengths in batch) stays under
+    `max_batch_tokens`. A single input longer than the budget gets its own batch."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches: list[list[int]] = []
+    cur: list[int] = []
+    for i in order:
+        # sorted ascending, so the newest element sets the padded length
+        if cur and (
+            len(cur) >= max_batch_size or (len(cur) + 1) * lengths[i] > max_batch_tokens
+        ):
+            batches.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
 
 
 def get_model_or_download(model_name: str, download_if_needed: bool = False):
@@ -49,6 +74,7 @@ class EmbeddingModel:
         tokenizer: transformers.PreTrainedTokenizerBase,
         normalized: bool = True,
         max_batch_size: int = MAX_BATCH_SIZE,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
     ):
         self.name = name
         self.model = model
@@ -57,6 +83,7 @@ class EmbeddingModel:
         self.dimension = self.model.config.hidden_size
         self.normalized = normalized
         self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
 
     @classmethod
     def default(cls):
@@ -69,6 +96,8 @@ class EmbeddingModel:
         normalized: bool = True,
         download_if_needed: bool = False,
         max_batch_size: int = MAX_BATCH_SIZE,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        session_options: ort.SessionOptions | None = None,
     ) -> Self:
         if not (
             path := (get_artifacts_dir() / "onnx" / model_name.split("/")[-1])
@@ -89,6 +118,7 @@ class EmbeddingModel:
         model = ORTModelForFeatureExtraction.from_pretrained(
             model_id=str(path.resolve()),
             local_files_only=True,
+            session_options=session_options,
         )
         tokenizer = get_hf_tokenizer(str(path.resolve()))
         obj = cls(
@@ -97,6 +127,7 @@ class EmbeddingModel:
             tokenizer=tokenizer,
             normalized=normalized,
             max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
         )
         return obj
 
@@ -107,26 +138,31 @@ class EmbeddingModel:
             emb = emb / np.linalg.norm(emb, axis=1, keepdims=True)
         return emb
 
-    def _encode(self, texts: list[str]) -> list[list[float]]:
+    def _encode(self, texts: list[str]) -> np.ndarray:
         if not isinstance(texts, list):
             logger.error(f"Type: {type(texts)}. Texts: {texts}")
             raise ValueError(
                 "Must pass list input. If just a string, make it a list of size 1."
             )
-        if len(texts) > self.max_batch_size:
-            ids = range(0, len(texts), bsz := self.max_batch_size)
-            return [x for i in ids for x in self._encode(texts[i : i + bsz])]
-        inp = self.tokenizer(
-            texts,
-            max_length=self.max_tokens,
-            padding=True,
-            truncation=True,
-            return_tensors="np",
-        )
-        out = self.model(**inp)
-        return self._mean_pool(out.last_hidden_state, inp["attention_mask"]).tolist()
+        res = np.empty((len(texts), self.dimension), dtype=np.float32)
+        if not texts:
+            return res
+        # tokenize everything once, then pad per batch
+        enc = self.tokenizer(texts, max_length=self.max_tokens, truncation=True)
+        lengths = [len(x) for x in enc["input_ids"]]
+        for batch in token_budget_batches(
+            lengths, self.max_batch_tokens, self.max_batch_size
+        ):
+            inp = self.tokenizer.pad(
+                {k: [v[i] for i in batch] for k, v in enc.items()},
+                padding=True,
+                return_tensors="np",
+            )
+            out = self.model(**inp)
+            res[batch] = self._mean_pool(out.last_hidden_state, inp["attention_mask"])
+        return res
 
-    def encode_query(self, text: list[str]) -> list[list[float]]:
+    def encode_query(self, text: list[str]) -> np.ndarray:
         # TODO: there is no real guardrail here for using a model that does not use this preprocessing
         # we can go back to separate classes, but there's only 2 models for now, and this seems ok.
         if isinstance(text, str):
@@ -136,7 +172,7 @@ class EmbeddingModel:
             text = [f"{EmbeddingType.query.value}: {x}" for x in text]
         return self._encode(text)
 
-    def encode_passage(self, text: list[str]) -> list[list[float]]:
+    def encode_passage(self, text: list[str]) -> np.ndarray:
         if isinstance(text, str):
             text = [text]
         assert all(isinstance(x, str) for x in text)
@@ -156,12 +192,14 @@ class CrossEncoder:
         model: transformers.PreTrainedModel,
         tokenizer: transformers.PreTrainedTokenizerBase,
         max_batch_size: int = MAX_BATCH_SIZE,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
     ):
         self.model = model
         self.tokenizer = tokenizer
         self.max_tokens = self.model.config.max_position_embeddings
         self.dimension = self.model.config.hidden_size
         self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
 
     @classmethod
     def default(cls):
@@ -172,6 +210,7 @@ class CrossEncoder:
         cls,
         model_name: CrossEncoderEnum = CrossEncoderEnum.mmarco_mMiniLMv2_L12_H384_v1,
         download_if_needed: bool = False,
+        session_options: ort.SessionOptions | None = None,
     ) -> Self:  # type: ignore
         if not (
             path := (get_artifacts_dir() / "onnx" / model_name.split("/")[-1])
@@ -192,6 +231,7 @@ class CrossEncoder:
         model = ORTModelForSequenceClassification.from_pretrained(
             model_id=str(path.resolve()),
             local_files_only=True,
+            session_options=session_options,
         )
         tokenizer = get_hf_tokenizer(str(path.resolve()))
         obj = cls(model=model, tokenizer=tokenizer)
@@ -203,15 +243,21 @@ class CrossEncoder:
         """Higher is better"""
         if isinstance(query, str):
             query = [query] * len(passages)
-        if len(passages) > self.max_batch_size:
-            res: list[float] = []
-            for i in range(0, len(passages), bsz := self.max_batch_size):
-                res.extend(
-                    self.similarity_score(query[i : i + bsz], passages[i : i + bsz])
-                )
-            return res
-        features = self.tokenizer(
-            query, passages, padding=True, truncation=True, return_tensors="np"
-        )
-        scores = self.model(**features).logits.squeeze()
-        return scores.tolist()
+        if not passages:
+            return []
+        features = self.tokenizer(query, passages, truncation=True)
+        lengths = [len(x) for x in features["input_ids"]]
+        res: list[float] = [0.0] * len(passages)
+        for batch in token_budget_batches(
+            lengths, self.max_batch_tokens, self.max_batch_size
+        ):
+            inp = self.tokenizer.pad(
+                {k: [v[i] for i in batch] for k, v in features.items()},
+                padding=True,
+                return_tensors="np",
+            )
+            # logits are (batch, 1), reshape so that a batch of one is still a list
+            scores = self.model(**inp).logits.reshape(-1)
+            for i, scr in zip(batch, scores.tolist()):
+                res[i] = scr
+        return res
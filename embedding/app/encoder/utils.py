@@ -1,6 +1,7 @@
 from functools import lru_cache
 import os
 from pathlib import Path
+import onnxruntime as ort
 from transformers import AutoTokenizer
 
 
@@ -35,3 +36,14 @@ def get_onnx_dir() -> Path:
 @lru_cache(maxsize=None)
 def get_hf_tokenizer(model_name_or_path: str):
     return AutoTokenizer.from_pretrained(model_name_or_path)
+
+
+def get_session_options(
+    intra_op_num_threads: int = 0, inter_op_num_threads: int = 0
+) -> ort.SessionOptions:
+    """Zero lets onnxruntime decide, which is one thread per physical core. When running
+    several inference workers side by side, split the cores between them instead."""
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = inter_op_num_threads
+    return options
@@ -2,18 +2,23 @@ import asyncio
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, TypeVar
 
 import grpc
+import numpy as np
 from grpc_reflection.v1alpha import reflection
 from loguru import logger
 from opentelemetry import metrics
 
+from app.batching import MicroBatcher
 from app.encoder import (
     CrossEncoder,
     EmbeddingModel,
     EmbeddingModelEnum,
     CrossEncoderEnum,
 )
+from app.encoder.utils import get_session_options
 from app.pb import embed_pb2, embed_pb2_grpc
 from app.tracing import setup_tracing
 
@@ -24,6 +29,17 @@ EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", "intfloat/e5-small
 CROSSENCODER_MODEL_NAME = os.environ.get(
     "CROSSENCODER_MODEL_NAME", "cross-encoder/ms-marco-MiniLM-L-6-v2"
 )
+# Inference runs on a thread pool so the event loop can keep accepting RPCs.
+# onnxruntime releases the GIL and sessions are safe to run concurrently. The models
+# aren't picklable, so a process pool is not an option here.
+NUM_INFERENCE_WORKERS = int(os.environ.get("NUM_INFERENCE_WORKERS", 2))
+MAX_INFERENCE_QUEUE_SIZE = int(os.environ.get("MAX_INFERENCE_QUEUE_SIZE", 256))
+ORT_INTRA_OP_NUM_THREADS = int(os.environ.get("ORT_INTRA_OP_NUM_THREADS", 0))
+ORT_INTER_OP_NUM_THREADS = int(os.environ.get("ORT_INTER_OP_NUM_THREADS", 0))
+# Query embeddings from concurrent RPCs are coalesced into one inference call.
+# A window of 0 turns this off.
+MICROBATCH_WINDOW_MS = float(os.environ.get("MICROBATCH_WINDOW_MS", 2))
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", 32))
 
 APP_NAME = "embeddings.server"
 
@@ -44,72 +60,202 @@ reqs_in_progress_meter = meter.create_up_down_counter(
     name="embedding_requests_in_progress",
     description="Gauge of requests by method currently being processed",
 )
+queue_wait_time_meter = meter.create_histogram(
+    name="embedding_queue_wait_seconds",
+    description="Time spent waiting for an inference worker (in seconds)",
+    unit="s",
+)
+
+T = TypeVar("T")
+
+
+class InferenceQueueFullError(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """Bounded thread pool for running model inference off of the event loop.
+    The queue depth is reported on reqs_in_progress_meter with state=queued, and
+    jobs running on a worker with state=running."""
+
+    def __init__(self, max_workers: int, max_queue_size: int):
+        self.max_queue_size = max_queue_size
+        self.num_pending = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="inference"
+        )
+
+    async def run(self, method: str, fn: Callable[..., T], *args, **kwargs) -> T:
+        if self.num_pending >= self.max_queue_size:
+            raise InferenceQueueFullError(
+                f"Inference queue is full ({self.num_pending} pending requests)."
+            )
+        self.num_pending += 1
+        attributes = dict(method=method, app_name=APP_NAME)
+        queued_at = time.perf_counter()
+        reqs_in_progress_meter.add(
+            amount=1, attributes=attributes | dict(state="queued")
+        )
+
+        def job() -> T:
+            wait = time.perf_counter() - queued_at
+            queue_wait_time_meter.record(amount=wait, attributes=attributes)
+            reqs_in_progress_meter.add(
+                amount=-1, attributes=attributes | dict(state="queued")
+            )
+            reqs_in_progress_meter.add(
+                amount=1, attributes=attributes | dict(state="running")
+            )
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                reqs_in_progress_meter.add(
+                    amount=-1, attributes=attributes | dict(state="running")
+                )
+
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, job)
+        finally:
+            self.num_pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+PACKED_DTYPES = {
+    embed_pb2.FLOAT32: np.dtype("<f4"),
+    embed_pb2.FLOAT16: np.dtype("<f2"),
+}
+
+
+def pack_embeddings(
+    encodings: np.ndarray, dtype: embed_pb2.Dtype
+) -> embed_pb2.PackedEmbeddingResponse:
+    """Row-major little-endian buffer of shape (n, dim), so clients can np.frombuffer it."""
+    data = np.ascontiguousarray(encodings, dtype=PACKED_DTYPES[dtype]).tobytes()
+    return embed_pb2.PackedEmbeddingResponse(
+        data=data, shape=list(encodings.shape), dtype=dtype
+    )
 
 
 class EmbedServicer(embed_pb2_grpc.EmbedServicer):
     """Provides methods that implement functionality of route guide server."""
 
     def __init__(self) -> None:
+        session_options = get_session_options(
+            intra_op_num_threads=ORT_INTRA_OP_NUM_THREADS,
+            inter_op_num_threads=ORT_INTER_OP_NUM_THREADS,
+        )
         logger.info(f"Loading Embedding Model: {EMBEDDING_MODEL_NAME}")
         self.encoder = EmbeddingModel.from_pretrained(
-            EmbeddingModelEnum(EMBEDDING_MODEL_NAME), download_if_needed=True
+            EmbeddingModelEnum(EMBEDDING_MODEL_NAME),
+            download_if_needed=True,
+            session_options=session_options,
         )
         logger.info(f"Loading CrossEncoder Model: {CROSSENCODER_MODEL_NAME}")
         self.cross_encoder = CrossEncoder.from_pretrained(
-            CrossEncoderEnum(CROSSENCODER_MODEL_NAME), download_if_needed=True
+            CrossEncoderEnum(CROSSENCODER_MODEL_NAME),
+            download_if_needed=True,
+            session_options=session_options,
+        )
+        logger.info(
+            f"Starting {NUM_INFERENCE_WORKERS} inference workers. Max queue size: {MAX_INFERENCE_QUEUE_SIZE}"
+        )
+        self.executor = InferenceExecutor(
+            max_workers=NUM_INFERENCE_WORKERS, max_queue_size=MAX_INFERENCE_QUEUE_SIZE
+        )
+        self.query_batcher = MicroBatcher(
+            fn=self.encoder.encode_query,
+            run=lambda fn, texts: self.executor.run("EncodeQueries", fn, texts),
+            window_ms=MICROBATCH_WINDOW_MS,
+            max_batch_size=MICROBATCH_MAX_SIZE,
+            method="EncodeQueries",
         )
         info_meter.add(amount=1, attributes=dict(app_name=APP_NAME))
 
-    async def EncodeQueries(
-        self, request: embed_pb2.EncodeQueryRequest, unused_context
-    ) -> embed_pb2.EmbeddingResponse:
-        bsz = len(request.text) or 1
-        chars = sum(len(x) for x in request.text)
-        logger.info(f"EncodeQueries request. Batch size: {bsz}. Chars: {chars}")
+    async def _run_inference(
+        self, context: grpc.aio.ServicerContext, method: str, job: Awaitable[T]
+    ) -> T:
+        try:
+            return await job
+        except InferenceQueueFullError as e:
+            logger.warning(f"{method} rejected. {e}")
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+            raise
+
+    async def _encode(
+        self,
+        method: str,
+        text: list[str],
+        context: grpc.aio.ServicerContext,
+        job: Callable[[list[str]], Awaitable[np.ndarray]],
+    ) -> np.ndarray:
+        bsz = len(text) or 1
+        chars = sum(len(x) for x in text)
+        logger.info(f"{method} request. Batch size: {bsz}. Chars: {chars}")
 
         st = time.perf_counter()
         attributes: dict[str, str | int] = dict(
-            method="EncodeQueries", batch_size=bsz, n_chars=chars, app_name=APP_NAME
+            method=method, batch_size=bsz, n_chars=chars, app_name=APP_NAME
         )
         req_meter.add(amount=1, attributes=attributes)
         reqs_in_progress_meter.add(amount=1, attributes=attributes)
 
-        encodings = self.encoder.encode_query([x for x in request.text])
-        embeddings = [embed_pb2.Embedding(embedding=x) for x in encodings]
-        res = embed_pb2.EmbeddingResponse(embeddings=embeddings)
+        try:
+            encodings = await self._run_inference(context, method, job(text))
+        finally:
+            reqs_in_progress_meter.add(amount=-1, attributes=attributes)
 
         duration = time.perf_counter() - st
         req_processing_time_meter.record(amount=duration, attributes=attributes)
-        reqs_in_progress_meter.add(amount=-1, attributes=attributes)
 
-        return res
+        return encodings
 
-    async def EncodePassages(
-        self, request: embed_pb2.EncodePassageRequest, unused_context
-    ) -> embed_pb2.EmbeddingResponse:
-        bsz = len(request.text)
-        chars = sum(len(x) for x in request.text)
-        logger.info(f"EncodePassages request. Batch size: {bsz}. Chars: {chars}")
+    def _encode_queries(self, text: list[str]) -> Awaitable[np.ndarray]:
+        return self.query_batcher.submit(text)
 
-        st = time.perf_counter()
-        attributes: dict[str, str | int] = dict(
-            method="EncodePassages", batch_size=bsz, n_chars=chars, app_name=APP_NAME
-        )
-        req_meter.add(amount=1, attributes=attributes)
-        reqs_in_progress_meter.add(amount=1, attributes=attributes)
+    def _encode_passages(self, text: list[str]) -> Awaitable[np.ndarray]:
+        return self.executor.run("EncodePassages", self.encoder.encode_passage, text)
 
-        encodings = self.encoder.encode_passage([x for x in request.text])
-        embeddings = [embed_pb2.Embedding(embedding=x) for x in encodings]
-        res = embed_pb2.EmbeddingResponse(embeddings=embeddings)
+    async def EncodeQueries(
+        self, request: embed_pb2.EncodeQueryRequest, context: grpc.aio.ServicerContext
+    ) -> embed_pb2.EmbeddingResponse:
+        encodings = await self._encode(
+            "EncodeQueries", list(request.text), context, self._encode_queries
+        )
+        embeddings = [embed_pb2.Embedding(embedding=x) for x in encodings.tolist()]
+        return embed_pb2.EmbeddingResponse(embeddings=embeddings)
 
-        duration = time.perf_counter() - st
-        req_processing_time_meter.record(amount=duration, attributes=attributes)
-        reqs_in_progress_meter.add(amount=-1, attributes=attributes)
+    async def EncodePassages(
+        self,
+        request: embed_pb2.EncodePassageRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> embed_pb2.EmbeddingResponse:
+        encodings = await self._encode(
+            "EncodePassages", list(request.text), context, self._encode_passages
+        )
+        embeddings = [embed_pb2.Embedding(embedding=x) for x in encodings.tolist()]
+        return embed_pb2.EmbeddingResponse(embeddings=embeddings)
+
+    async def EncodeQueriesPacked(
+        self, request: embed_pb2.PackedEncodeRequest, context: grpc.aio.ServicerContext
+    ) -> embed_pb2.PackedEmbeddingResponse:
+        encodings = await self._encode(
+            "EncodeQueriesPacked", list(request.text), context, self._encode_queries
+        )
+        return pack_embeddings(encodings, request.dtype)
 
-        return res
+    async def EncodePassagesPacked(
+        self, request: embed_pb2.PackedEncodeRequest, context: grpc.aio.ServicerContext
+    ) -> embed_pb2.PackedEmbeddingResponse:
+        encodings = await self._encode(
+            "EncodePassagesPacked", list(request.text), context, self._encode_passages
+        )
+        return pack_embeddings(encodings, request.dtype)
 
     async def GetRankingScores(
-        self, request: embed_pb2.RankingScoreRequest, unused_context
+        self, request: embed_pb2.RankingScoreRequest, context: grpc.aio.ServicerContext
     ) -> embed_pb2.RankingScoreResponse:
         bsz = len(request.passages)
         chars = sum(len(x) for x in request.passages)
@@ -127,14 +273,23 @@ class EmbedServicer(embed_pb2_grpc.EmbedServicer):
         req_meter.add(amount=1, attributes=attributes)
         reqs_in_progress_meter.add(amount=1, attributes=attributes)
 
-        scores = self.cross_encoder.similarity_score(
-            query=request.query, passages=[p for p in request.passages]
-        )
+        try:
+            scores = await self._run_inference(
+                context,
+                "GetRankingScores",
+                self.executor.run(
+                    "GetRankingScores",
+                    self.cross_encoder.similarity_score,
+                    query=request.query,
+                    passages=list(request.passages),
+                ),
+            )
+        finally:
+            reqs_in_progress_meter.add(amount=-1, attributes=attributes)
         res = embed_pb2.RankingScoreResponse(scores=scores)
 
         duration = time.perf_counter() - st
         req_processing_time_meter.record(amount=duration, attributes=attributes)
-        reqs_in_progress_meter.add(amount=-1, attributes=attributes)
 
         return res
 
@@ -145,13 +300,29 @@ class EmbedServicer(embed_pb2_grpc.EmbedServicer):
     async def GetEncoderName(self, *args, **kwargs) -> embed_pb2.EncoderNameResponse:
         return embed_pb2.EncoderNameResponse(name=self.encoder.name)
 
+    async def GetEncoderInfo(self, *args, **kwargs) -> embed_pb2.EncoderInfoResponse:
+        return embed_pb2.EncoderInfoResponse(
+            name=self.encoder.name,
+            dimension=self.encoder.dimension,
+            is_normalized=self.encoder.normalized,
+        )
+
 
 async def serve(port: int = 50051) -> None:
-    server = grpc.aio.server()
+    # backend channels are long-lived and send keepalive pings while idle, don't
+    # treat those as abuse (the default minimum ping interval is 5 minutes)
+    server_options = [
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_ping_interval_without_data_ms", 10_000),
+        ("grpc.http2.max_ping_strikes", 0),
+    ]
     local_url = f"[::]:{port}"
 
-    server = setup_tracing(server=server, otlp_endpoint=OTEL_EXPORTER_OTLP_ENDPOINT)
-    embed_pb2_grpc.add_EmbedServicer_to_server(EmbedServicer(), server)
+    server = setup_tracing(
+        otlp_endpoint=OTEL_EXPORTER_OTLP_ENDPOINT, server_options=server_options
+    )
+    servicer = EmbedServicer()
+    embed_pb2_grpc.add_EmbedServicer_to_server(servicer, server)
 
     SERVICE_NAMES = (
         embed_pb2.DESCRIPTOR.services_by_name["Embed"].full_name,
@@ -169,6 +340,8 @@ async def serve(port: int = 50051) -> None:
     except KeyboardInterrupt:
         logger.info("Signal received. Shutting down.")
         await server.stop(0)
+    finally:
+        servicer.executor.shutdown()
 
 
 if __name__ == "__main__":
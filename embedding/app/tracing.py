@@ -39,7 +39,9 @@ class ExceptionInterceptor(AsyncServerInterceptor):
             )
 
 
-def setup_tracing(server: Server, otlp_endpoint: str | None) -> Server:
+def setup_tracing(
+    otlp_endpoint: str | None, server_options: list[tuple[str, Any]] | None = None
+) -> Server:
     resource = Resource.create(attributes={SERVICE_NAME: "embedding.server"})
     trace_provider = TracerProvider(resource=resource)
     trace_exporter = OTLPSpanExporter(endpoint=otlp_endpoint, insecure=True)
@@ -54,6 +56,7 @@ def setup_tracing(server: Server, otlp_endpoint: str | None) -> Server:
     metrics.set_meter_provider(meter_provider)
 
     server = grpc.aio.server(
-        interceptors=[ExceptionInterceptor(), aio_server_interceptor()]
+        interceptors=[ExceptionInterceptor(), aio_server_interceptor()],
+        options=server_options,
     )
     return server
@@ -0,0 +1,158 @@
+"""Fixed-size in-order batching vs. length-sorted token-budget batching.
+
+Compares the old strategy (chunks of 4 in input order, each padded to its longest
+member) against `token_budget_batches` for passage encoding and reranking. Text
+lengths follow what the backend actually sends: monologues are single lines of
+speech, nodes come out of the text splitters at up to 160 (sentence) or 640 (token)
+tokens, and reranking scores a query against 20 mixed monologues or nodes.
+
+    python -m benchmarks.batching --repeats 20
+"""
+import argparse
+import random
+import time
+from typing import Callable
+
+import numpy as np
+
+from app.encoder import (
+    CrossEncoder,
+    CrossEncoderEnum,
+    EmbeddingModel,
+    EmbeddingModelEnum,
+)
+
+LEGACY_BATCH_SIZE = 4
+WORDS = (
+    "the of and to a in that is was he for it with as his on be at by i this had not "
+    "are but from or have an they which one you were her all she there would their we "
+    "him been has when who will more no if out so said what up its about into than them"
+).split()
+
+
+def random_text(rng: random.Random, mean_words: float, sigma: float, max_words: int):
+    n = min(max_words, int(rng.lognormvariate(np.log(mean_words), sigma)) + 1)
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def monologues(rng: random.Random, n: int) -> list[str]:
+    return [random_text(rng, 25, 0.7, 300) for _ in range(n)]
+
+
+def nodes(rng: random.Random, n: int) -> list[str]:
+    # mix of sentence splitter (<=160 tokens) and token splitter (<=640 tokens) chunks
+    return [
+        (
+            random_text(rng, 110, 0.3, 130)
+            if rng.random() < 0.5
+            else random_text(rng, 380, 0.4, 500)
+        )
+        for _ in range(n)
+    ]
+
+
+def legacy_encode(encoder: EmbeddingModel, texts: list[str]) -> list[list[float]]:
+    res: list[list[float]] = []
+    for i in range(0, len(texts), LEGACY_BATCH_SIZE):
+        inp = encoder.tokenizer(
+            texts[i : i + LEGACY_BATCH_SIZE],
+            max_length=encoder.max_tokens,
+            padding=True,
+            truncation=True,
+            return_tensors="np",
+        )
+        out = encoder.model(**inp)
+        res.extend(encoder._mean_pool(out.last_hidden_state, inp["attention_mask"]))
+    return res
+
+
+def legacy_rerank(
+    cross_encoder: CrossEncoder, query: str, passages: list[str]
+) -> list[float]:
+    res: list[float] = []
+    for i in range(0, len(passages), LEGACY_BATCH_SIZE):
+        chunk = passages[i : i + LEGACY_BATCH_SIZE]
+        features = cross_encoder.tokenizer(
+            [query] * len(chunk),
+            chunk,
+            padding=True,
+            truncation=True,
+            return_tensors="np",
+        )
+        res.extend(cross_encoder.model(**features).logits.reshape(-1).tolist())
+    return res
+
+
+def timeit(fn: Callable[[], object], repeats: int) -> list[float]:
+    fn()  # warmup
+    durations = []
+    for _ in range(repeats):
+        st = time.perf_counter()
+        fn()
+        durations.append(1000 * (time.perf_counter() - st))
+    return durations
+
+
+def compare(name: str, legacy: Callable, new: Callable, repeats: int):
+    a = np.array(legacy(), dtype=np.float32)
+    b = np.array(new(), dtype=np.float32)
+    assert np.allclose(
+        a, b, atol=1e-4
+    ), f"{name}: outputs differ, max {np.abs(a - b).max()}"
+    t_legacy = np.median(timeit(legacy, repeats))
+    t_new = np.median(timeit(new, repeats))
+    print(
+        f"{name:<22} fixed-4={t_legacy:8.1f}ms  token-budget={t_new:8.1f}ms  "
+        f"speedup={t_legacy / t_new:5.2f}x"
+    )
+
+
+def main(args: argparse.Namespace):
+    rng = random.Random(args.seed)
+    encoder = EmbeddingModel.from_pretrained(
+        EmbeddingModelEnum(args.model), download_if_needed=True
+    )
+    cross_encoder = CrossEncoder.from_pretrained(
+        CrossEncoderEnum(args.cross_encoder), download_if_needed=True
+    )
+    print(
+        f"model={args.model} cross_encoder={args.cross_encoder} "
+        f"max_batch_tokens={encoder.max_batch_tokens} max_batch_size={encoder.max_batch_size}"
+    )
+
+    for name, texts in [
+        ("encode monologues", monologues(rng, args.num_passages)),
+        ("encode nodes", nodes(rng, args.num_passages)),
+    ]:
+        compare(
+            name,
+            lambda: legacy_encode(encoder, texts),
+            lambda: encoder._encode(texts),
+            args.repeats,
+        )
+
+    query = random_text(rng, 12, 0.5, 40)
+    for name, passages in [
+        ("rerank monologues", monologues(rng, 20)),
+        ("rerank nodes", nodes(rng, 20)),
+        ("rerank mixed", monologues(rng, 10) + nodes(rng, 10)),
+    ]:
+        rng.shuffle(passages)
+        compare(
+            name,
+            lambda: legacy_rerank(cross_encoder, query, passages),
+            lambda: cross_encoder.similarity_score(query, passages),
+            args.repeats,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", default=EmbeddingModelEnum.e5_small_v2.value)
+    parser.add_argument(
+        "--cross-encoder", default=CrossEncoderEnum.ms_marco_MiniLM_L_6_v2.value
+    )
+    parser.add_argument("--num-passages", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,107 @@
+"""Throughput vs. tail latency of query micro-batching at different window sizes.
+
+Simulates `concurrency` backend workers that each send single-query EncodeQueries
+requests back to back, and runs them against the same executor + batcher setup as
+the server (without the gRPC layer). Run from the embedding directory:
+
+    python -m benchmarks.microbatching --windows 0 1 2 5 10 --concurrency 32
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import numpy as np
+
+from app.batching import MicroBatcher
+from app.encoder import EmbeddingModel, EmbeddingModelEnum
+from app.server import InferenceExecutor
+
+WORDS = (
+    "what do you think about the weather today did you ever go to tokyo "
+    "tell me more about your family and the places you grew up in"
+).split()
+
+
+def random_query(rng: random.Random) -> str:
+    # backend queries are short, typically a sentence or the last few messages
+    n = int(rng.lognormvariate(2.5, 0.6)) + 1
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+async def run_client(
+    batcher: MicroBatcher, rng: random.Random, deadline: float, latencies: list[float]
+):
+    while time.perf_counter() < deadline:
+        st = time.perf_counter()
+        await batcher.submit([random_query(rng)])
+        latencies.append(time.perf_counter() - st)
+
+
+async def run_window(
+    encoder: EmbeddingModel,
+    window_ms: float,
+    concurrency: int,
+    duration: float,
+    num_workers: int,
+    max_batch_size: int,
+    seed: int,
+):
+    executor = InferenceExecutor(max_workers=num_workers, max_queue_size=10_000)
+    batcher = MicroBatcher(
+        fn=encoder.encode_query,
+        run=lambda fn, texts: executor.run("EncodeQueries", fn, texts),
+        window_ms=window_ms,
+        max_batch_size=max_batch_size,
+        method="EncodeQueries",
+    )
+    # warmup
+    await batcher.submit(["warmup"])
+
+    latencies: list[float] = []
+    deadline = time.perf_counter() + duration
+    rngs = [random.Random(seed + i) for i in range(concurrency)]
+    st = time.perf_counter()
+    await asyncio.gather(
+        *[run_client(batcher, rng, deadline, latencies) for rng in rngs]
+    )
+    elapsed = time.perf_counter() - st
+    executor.shutdown()
+
+    p50, p99 = 1000 * np.percentile(latencies, [50, 99])
+    print(
+        f"window={window_ms:5.1f}ms  throughput={len(latencies) / elapsed:8.1f} q/s  "
+        f"p50={p50:7.2f}ms  p99={p99:7.2f}ms"
+    )
+
+
+async def main(args: argparse.Namespace):
+    encoder = EmbeddingModel.from_pretrained(
+        EmbeddingModelEnum(args.model), download_if_needed=True
+    )
+    print(
+        f"model={args.model} concurrency={args.concurrency} workers={args.num_workers} "
+        f"max_batch_size={args.max_batch_size} duration={args.duration}s"
+    )
+    for window_ms in args.windows:
+        await run_window(
+            encoder=encoder,
+            window_ms=window_ms,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            num_workers=args.num_workers,
+            max_batch_size=args.max_batch_size,
+            seed=args.seed,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", default=EmbeddingModelEnum.e5_small_v2.value)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5, 10])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,115 @@
+"""Guided decoding: only let the model sample tokens that keep its output matching a
+regex, so that the json the backend asks for always parses.
+
+The heavy lifting is the token index in the backend's clonr.utils.fsm, which needs
+the backend on the path (PYTHONPATH=../backend, see launch.sh). Without it, requests
+with a regex are served unconstrained, and the backend falls back to its retries.
+"""
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import llama_cpp
+import numpy as np
+import numpy.typing as npt
+from loguru import logger
+
+try:
+    from clonr.utils.fsm import TokenIndex
+except ImportError:
+    TokenIndex = None
+
+
+def llama_vocab(llama: llama_cpp.Llama) -> list[str]:
+    """The text of every token. Tokens that aren't valid utf-8 on their own (partial
+    characters from byte fallback) come out empty, which the index never allows."""
+    vocab: list[str] = []
+    for i in range(llama.n_vocab()):
+        try:
+            vocab.append(llama.detokenize([i]).decode("utf-8"))
+        except UnicodeDecodeError:
+            vocab.append("")
+    return vocab
+
+
+class GuidedLogitsProcessor:
+    """Masks out every token the index doesn't allow from the current state.
+
+    One per request, since it tracks the state. llama_cpp passes the prompt plus
+    everything generated so far, so the first call marks where the prompt ends and
+    every later call advances through the tokens sampled since.
+    """
+
+    def __init__(self, index: "TokenIndex"):
+        self.index = index
+        self.state = index.start_state
+        self._num_seen: Optional[int] = None
+
+    def __call__(
+        self, input_ids: list[int], scores: npt.NDArray[np.single]
+    ) -> npt.NDArray[np.single]:
+        if self._num_seen is None:
+            self._num_seen = len(input_ids)
+        for token in input_ids[self._num_seen :]:
+            # only off the index if something after us ignored the mask
+            if (state := self.index.next_state(self.state, token)) >= 0:
+                self.state = state
+        self._num_seen = len(input_ids)
+
+        if not (isinstance(scores, np.ndarray) and scores.flags.writeable):
+            scores = np.array(scores, dtype=np.single)
+        np.copyto(scores, -np.inf, where=~self.index.allowed(self.state))
+        return scores
+
+
+class TokenIndexCache:
+    """LRU of token indices by regex, backed by the on disk cache in cache_dir.
+
+    The first request for a new regex builds its index, which takes about a second
+    for a llama sized vocab, so call processor off of the event loop.
+    """
+
+    def __init__(self, max_size: int = 16, cache_dir: Optional[str] = None):
+        self.max_size = max_size
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._lock = threading.Lock()
+        self._data: OrderedDict[str, "TokenIndex"] = OrderedDict()
+        self._vocab: Optional[list[str]] = None
+        self._warned = False
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def available(self) -> bool:
+        if TokenIndex is None and not self._warned:
+            logger.warning(
+                "clonr.utils.fsm is not importable, ignoring regex constraints."
+            )
+            self._warned = True
+        return TokenIndex is not None
+
+    def index(self, llama: llama_cpp.Llama, regex: str) -> "TokenIndex":
+        with self._lock:
+            if (res := self._data.get(regex)) is not None:
+                self._data.move_to_end(regex)
+                return res
+            if self._vocab is None:
+                self._vocab = llama_vocab(llama)
+        # racing requests for a new regex both build it, same as the logit bias cache
+        res = TokenIndex.load_or_build(
+            regex,
+            self._vocab,
+            eos_token_id=llama.token_eos(),
+            cache_dir=self.cache_dir,
+        )
+        with self._lock:
+            self._data[regex] = res
+            self._data.move_to_end(regex)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return res
+
+    def processor(self, llama: llama_cpp.Llama, regex: str) -> GuidedLogitsProcessor:
+        return GuidedLogitsProcessor(self.index(llama, regex))
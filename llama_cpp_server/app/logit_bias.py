@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+from typing import Literal, Optional
+
+import llama_cpp
+import numpy as np
+import numpy.typing as npt
+
+LogitBiasType = Literal["input_ids", "tokens"]
+
+
+def _key(
+    logit_bias: dict[str, float], logit_bias_type: LogitBiasType, n_vocab: int
+) -> tuple:
+    return (n_vocab, logit_bias_type, tuple(sorted(logit_bias.items())))
+
+
+def dense_logit_bias(
+    llama: llama_cpp.Llama,
+    logit_bias: dict[str, float],
+    logit_bias_type: LogitBiasType,
+) -> npt.NDArray[np.single]:
+    """The bias for every token in the vocab, zero for any that aren't in logit_bias.
+    Ids outside of the vocab are dropped."""
+    to_bias: dict[int, float] = {}
+    if logit_bias_type == "input_ids":
+        for input_id, score in logit_bias.items():
+            to_bias[int(input_id)] = score
+    elif logit_bias_type == "tokens":
+        for token, score in logit_bias.items():
+            for input_id in llama.tokenize(token.encode("utf-8"), add_bos=False):
+                to_bias[input_id] = score
+
+    n_vocab = llama.n_vocab()
+    bias = np.zeros(n_vocab, dtype=np.single)
+    ids = [i for i in to_bias if 0 <= i < n_vocab]
+    bias[ids] = [to_bias[i] for i in ids]
+    # shared between requests (and replica threads), so nobody gets to change it
+    bias.flags.writeable = False
+    return bias
+
+
+class LogitBiasProcessor:
+    """Adds a precomputed bias to the logits of every sampled token.
+
+    llama_cpp hands over the logits as a numpy array, which is updated in place
+    instead of building a new list over the whole vocab for every token.
+    """
+
+    def __init__(self, bias: npt.NDArray[np.single]):
+        self.bias = bias
+
+    def __call__(
+        self, input_ids: list[int], scores: npt.NDArray[np.single]
+    ) -> npt.NDArray[np.single]:
+        if isinstance(scores, np.ndarray) and scores.flags.writeable:
+            scores += self.bias
+            return scores
+        return np.asarray(scores, dtype=np.single) + self.bias
+
+
+class LogitBiasCache:
+    """LRU of logit bias processors, so that requests with the same bias map (like
+    every memory rating) share one dense bias vector instead of each building one."""
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data: OrderedDict[tuple, LogitBiasProcessor] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def processor(
+        self,
+        llama: llama_cpp.Llama,
+        logit_bias: dict[str, float],
+        logit_bias_type: Optional[LogitBiasType] = None,
+    ) -> LogitBiasProcessor:
+        if logit_bias_type is None:
+            logit_bias_type = "input_ids"
+        key = _key(logit_bias, logit_bias_type, llama.n_vocab())
+        with self._lock:
+            if (res := self._data.get(key)) is not None:
+                self._data.move_to_end(key)
+                return res
+        # building it can tokenize, so do it outside of the lock. Two requests racing
+        # for the same key just build the same vector twice.
+        res = LogitBiasProcessor(dense_logit_bias(llama, logit_bias, logit_bias_type))
+        with self._lock:
+            self._data[key] = res
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return res
@@ -1,27 +1,44 @@
-import hashlib
+import asyncio
 import json
 import multiprocessing
-import threading
 from contextlib import asynccontextmanager
 from functools import partial
-from typing import Optional, Literal, Union, Iterator
+from typing import Optional, Union, Iterator
 
 import anyio
 import llama_cpp
-from anyio import Semaphore
 from anyio.streams.memory import MemoryObjectSendStream
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
-from fastapi.concurrency import iterate_in_threadpool
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 from sse_starlette import EventSourceResponse
-from starlette.concurrency import run_in_threadpool
 
 from app import schemas
+from app.guided import TokenIndexCache
+from app.logit_bias import LogitBiasCache
+from app.prefix_cache import PrefixCache
+from app.response_cache import (
+    CacheTier,
+    MemoryTier,
+    RedisTier,
+    ResponseCache,
+    ResponseCacheStats,
+    SqliteTier,
+    completion_chunks,
+    response_cache_key,
+)
+from app.scheduler import (
+    Job,
+    JobCancelledError,
+    Priority,
+    QueueFullError,
+    Scheduler,
+    SchedulerStats,
+)
 
 load_dotenv()
 
@@ -94,19 +111,6 @@ def msgs2prompt(messages: list[dict], spec: SpecialTokens):
     return prompt
 
 
-class ZeroTempCache:
-    def __init__(self):
-        self._d = {}
-
-    def get(self, prompt: str):
-        key = hashlib.sha256(prompt.encode()).hexdigest()
-        return self._d.get(key)
-
-    def put(self, prompt: str, value):
-        key = hashlib.sha256(prompt.encode()).hexdigest()
-        self._d[key] = value
-
-
 class Settings(BaseSettings):
     model: str = Field(
         description="The path to the model to use for generating completions."
@@ -153,6 +157,19 @@ class Settings(BaseSettings):
         default=2 << 30,
         description="The size of the cache in bytes. Only used if cache is True.",
     )
+    prefix_cache: bool = Field(
+        default=True,
+        description="Snapshot the model state after system prompt prefixes shared between requests.",
+    )
+    prefix_cache_size: int = Field(
+        default=2 << 30,
+        description="The size of the prefix cache in bytes. Only used if prefix_cache is True.",
+    )
+    prefix_cache_min_tokens: int = Field(
+        default=64,
+        ge=1,
+        description="Shared prefixes shorter than this are not worth a snapshot.",
+    )
     vocab_only: bool = Field(
         default=False, description="Whether to only return the vocabulary."
     )
@@ -160,33 +177,105 @@ class Settings(BaseSettings):
         default=True, description="Whether to print debug information."
     )
     port: int = 8100  # lol, on mac, port 6000 is unsafe
-    max_concurrent_threads: int = Field(
-        default=10, description="Number of threads that can access the LLM? Idk."
+    num_replicas: int = Field(
+        default=1,
+        ge=1,
+        description="Number of copies of the model to load. Each one serves one request at a time.",
+    )
+    max_queue_size: int = Field(
+        default=256,
+        ge=1,
+        description="Max number of requests waiting for a replica before we start returning 503s.",
+    )
+    logit_bias_cache_size: int = Field(
+        default=64,
+        ge=1,
+        description="Number of distinct logit bias maps to keep precomputed bias vectors for.",
+    )
+    guided_cache_size: int = Field(
+        default=16,
+        ge=1,
+        description="Number of regex token indices to keep in memory for guided decoding.",
+    )
+    response_cache: bool = Field(
+        default=True,
+        description="Replay completions for repeated zero temperature requests.",
+    )
+    response_cache_max_entries: int = Field(
+        default=4096,
+        ge=1,
+        description="Max number of completions in the in-process response cache.",
+    )
+    response_cache_size: int = Field(
+        default=64 << 20,
+        ge=1,
+        description="Max bytes of completions in the in-process response cache.",
+    )
+    response_cache_disk_path: Optional[str] = Field(
+        default=None,
+        description="Sqlite file for a persistent response cache tier, shared by every server using it.",
+    )
+    response_cache_disk_size: int = Field(
+        default=1 << 30,
+        ge=1,
+        description="Max bytes of completions in the on disk response cache.",
+    )
+    response_cache_redis_url: Optional[str] = Field(
+        default=None,
+        description="Redis url for a response cache tier shared between servers.",
+    )
+    response_cache_redis_ttl_seconds: int = Field(
+        default=7 * 24 * 3600,
+        ge=1,
+        description="How long completions stay in the redis response cache.",
+    )
+    guided_cache_dir: Optional[str] = Field(
+        default="fsm_cache",
+        description="Where to keep built regex token indices between restarts. Set to empty to disable.",
     )
 
 
-async def run_in_guarded_threadpool(func, *args, **kwargs):
-    async with MAX_THREADS_GUARD:
-        return await run_in_threadpool(func, *args, **kwargs)
+settings = Settings()
+logit_bias_cache = LogitBiasCache(max_size=settings.logit_bias_cache_size)
+token_index_cache = TokenIndexCache(
+    max_size=settings.guided_cache_size, cache_dir=settings.guided_cache_dir
+)
 
 
-settings = Settings()
-zero_temp_cache = ZeroTempCache()
-lock = threading.Lock()
-MAX_THREADS_GUARD = Semaphore(settings.max_concurrent_threads)
+def make_response_cache() -> ResponseCache | None:
+    if not settings.response_cache:
+        return None
+    tiers: list[CacheTier] = [
+        MemoryTier(
+            max_entries=settings.response_cache_max_entries,
+            capacity_bytes=settings.response_cache_size,
+        )
+    ]
+    if settings.response_cache_disk_path:
+        tiers.append(
+            SqliteTier(
+                settings.response_cache_disk_path,
+                capacity_bytes=settings.response_cache_disk_size,
+            )
+        )
+    if settings.response_cache_redis_url:
+        tiers.append(
+            RedisTier(
+                settings.response_cache_redis_url,
+                ttl_seconds=settings.response_cache_redis_ttl_seconds,
+            )
+        )
+    return ResponseCache(tiers)
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("Loading Llama model and performing warmup run.")
-    global LLM
-    global SPECIAL_TOKENS
+response_cache = make_response_cache()
+
+# how often a non-streaming request checks whether its client has gone away
+DISCONNECT_POLL_SECONDS = 0.5
 
-    SPECIAL_TOKENS = SpecialTokens.from_model_name(
-        ModelName.ehartford_dolphin_llama2_7b
-    )
 
-    LLM = llama_cpp.Llama(
+def load_model() -> llama_cpp.Llama:
+    llm = llama_cpp.Llama(
         model_path=settings.model,
         n_gpu_layers=settings.n_gpu_layers,
         f16_kv=settings.f16_kv,
@@ -204,11 +293,51 @@ async def lifespan(app: FastAPI):
     if settings.cache:
         logger.info("Using llamacpp prefill cache.")
         cache = llama_cpp.LlamaCache(capacity_bytes=settings.cache_size)
-        LLM.set_cache(cache)
-    with lock:
-        LLM("test", max_tokens=1)
+        llm.set_cache(cache)
+    llm("test", max_tokens=1)
+    return llm
+
+
+def load_vocab() -> llama_cpp.Llama:
+    """Just the tokenizer of the model, without the weights. Tokenizing and vocab
+    lookups happen on the event loop and the thread pool, while the replicas are
+    busy generating in their worker threads, so they get their own copy."""
+    return llama_cpp.Llama(
+        model_path=settings.model, vocab_only=True, verbose=settings.verbose
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info(
+        f"Loading {settings.num_replicas} Llama model(s) and performing warmup runs."
+    )
+    global VOCAB
+    global SCHEDULER
+    global SPECIAL_TOKENS
+
+    SPECIAL_TOKENS = SpecialTokens.from_model_name(
+        ModelName.ehartford_dolphin_llama2_7b
+    )
+
+    replicas = [load_model() for _ in range(settings.num_replicas)]
     logger.info("Warmup run completed ✅")
+    VOCAB = load_vocab()
+    prefix_cache = None
+    if settings.prefix_cache:
+        logger.info("Using system prompt prefix cache.")
+        prefix_cache = PrefixCache(
+            capacity_bytes=settings.prefix_cache_size,
+            min_prefix_tokens=settings.prefix_cache_min_tokens,
+        )
+    SCHEDULER = Scheduler(
+        replicas=replicas,
+        max_queue_size=settings.max_queue_size,
+        prefix_cache=prefix_cache,
+    )
+    SCHEDULER.start()
     yield
+    SCHEDULER.stop()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -248,37 +377,60 @@ def _convert_completion(x: dict):
     return r
 
 
-def make_logit_bias_processor(
-    llama: llama_cpp.Llama,
-    logit_bias: dict[str, float],
-    logit_bias_type: Optional[Literal["input_ids", "tokens"]],
-):
-    if logit_bias_type is None:
-        logit_bias_type = "input_ids"
+def _streamed_completion(last_chunk: dict, prompt: str, text: str) -> dict:
+    # what the non-streaming call would have returned, so either kind can replay it
+    prompt_tokens = len(VOCAB.tokenize(prompt.encode("utf-8")))
+    completion_tokens = len(VOCAB.tokenize(text.encode("utf-8"), add_bos=False))
+    return {
+        "id": last_chunk["id"],
+        "object": "text_completion",
+        "created": last_chunk["created"],
+        "model": last_chunk["model"],
+        "choices": [
+            {
+                "text": text,
+                "index": 0,
+                "logprobs": None,
+                "finish_reason": last_chunk["choices"][0]["finish_reason"],
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
 
-    to_bias: dict[int, float] = {}
-    if logit_bias_type == "input_ids":
-        for input_id, score in logit_bias.items():
-            input_id = int(input_id)
-            to_bias[input_id] = score
+async def replay_completion(completion: dict):
+    for chunk in completion_chunks(completion):
+        yield dict(data=json.dumps(_convert_chunk(chunk)))
+    yield dict(data="[DONE]")
 
-    elif logit_bias_type == "tokens":
-        for token, score in logit_bias.items():
-            token = token.encode("utf-8")
-            for input_id in llama.tokenize(token, add_bos=False):
-                to_bias[input_id] = score
 
-    def logit_bias_processor(
-        input_ids: list[int],
-        scores: list[float],
-    ) -> list[float]:
-        new_scores = [None] * len(scores)
-        for input_id, score in enumerate(scores):
-            new_scores[input_id] = score + to_bias.get(input_id, 0.0)
+def submit_job(
+    kwargs: dict, priority: Priority, stream: bool, cache_prefix: str | None
+) -> Job:
+    try:
+        return SCHEDULER.submit(
+            kwargs=kwargs, priority=priority, stream=stream, cache_prefix=cache_prefix
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
-        return new_scores
 
-    return logit_bias_processor
+async def wait_for_job(job: Job, request: Request) -> dict:
+    # starlette doesn't cancel the handler when the client goes away, so poll for it
+    result = asyncio.ensure_future(job.result())
+    while True:
+        done, _ = await asyncio.wait({result}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return result.result()
+        if await request.is_disconnected():
+            job.cancel()
+            result.cancel()
+            logger.info(f"Disconnected from client {request.client}, job cancelled")
+            raise HTTPException(status_code=499, detail="Client disconnected")
 
 
 @app.post("/v1/chat/completions", response_model=schemas.ChatCompletion)
@@ -298,40 +450,88 @@ async def v2_chat(
         "logit_bias",
         "logit_bias_type",
         "user",
+        "priority",
+        "regex",
     }
     kwargs = body.model_dump(exclude=exclude)
 
-    if body.logit_bias is not None:
-        kwargs["logits_processor"] = llama_cpp.LogitsProcessorList(
-            [
-                make_logit_bias_processor(LLM, body.logit_bias, "input_ids"),
-            ]
-        )
-
     messages = kwargs.pop("messages")
+    # the system prompt holds the clone preamble, which is shared between requests
+    cache_prefix = None
+    if messages and messages[0]["role"] == "system":
+        cache_prefix = (
+            f"{SPECIAL_TOKENS.system_start}{messages[0]['content']}"
+            f"{SPECIAL_TOKENS.system_end}"
+        )
     prompt = msgs2prompt(messages=messages, spec=SPECIAL_TOKENS)
     kwargs["prompt"] = prompt
     logger.info(f"\n~~~~~ Received prompt: ~~~~~:\n{prompt}")
 
-    if body.temperature <= 0 and (r := zero_temp_cache.get(kwargs["prompt"])):
-        logger.info("CACHE HIT!")
-        return r
+    cache_key = None
+    if response_cache is not None and body.temperature <= 0:
+        params = {k: v for k, v in kwargs.items() if k != "stream"}
+        cache_key = response_cache_key(
+            dict(
+                params,
+                model=settings.model,
+                logit_bias=body.logit_bias,
+                regex=body.regex,
+            )
+        )
+        if (cached := await response_cache.get(cache_key)) is not None:
+            logger.info("Response cache hit")
+            if body.stream:
+                return EventSourceResponse(replay_completion(cached))
+            return _convert_completion(cached)
+
+    processors = []
+    if body.logit_bias is not None:
+        processors.append(
+            logit_bias_cache.processor(VOCAB, body.logit_bias, "input_ids")
+        )
+    # last, so that nothing can bring a masked token back
+    if body.regex is not None and token_index_cache.available:
+        try:
+            processors.append(
+                await anyio.to_thread.run_sync(
+                    token_index_cache.processor, VOCAB, body.regex
+                )
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if processors:
+        kwargs["logits_processor"] = llama_cpp.LogitsProcessorList(processors)
+
+    priority = Priority[body.priority]
+    kwargs.pop("stream")
 
     if body.stream:
-        logger.info("Received STREAM chat request")
+        logger.info(f"Received STREAM chat request ({priority.name})")
+        job = submit_job(
+            kwargs, priority=priority, stream=True, cache_prefix=cache_prefix
+        )
         send_chan, recv_chan = anyio.create_memory_object_stream(10)
 
         async def event_publisher(inner_send_chan: MemoryObjectSendStream):
             async with inner_send_chan:
                 try:
-                    iterator = await run_in_guarded_threadpool(LLM, **kwargs)  # type: ignore
-                    async for chunk in iterate_in_threadpool(iterator):
-                        chunk = _convert_chunk(chunk)
-                        await inner_send_chan.send(dict(data=json.dumps(chunk)))
+                    texts: list[str] = []
+                    async for chunk in job:
+                        texts.append(chunk["choices"][0]["text"])
+                        finish_reason = chunk["choices"][0]["finish_reason"]
+                        await inner_send_chan.send(
+                            dict(data=json.dumps(_convert_chunk(chunk)))
+                        )
                         if await request.is_disconnected():
                             raise anyio.get_cancelled_exc_class()()
                     await inner_send_chan.send(dict(data="[DONE]"))
+                    if cache_key is not None and texts and finish_reason is not None:
+                        completion = await anyio.to_thread.run_sync(
+                            _streamed_completion, chunk, prompt, "".join(texts)
+                        )
+                        await response_cache.put(cache_key, completion)
                 except anyio.get_cancelled_exc_class() as e:
+                    job.cancel()
                     logger.exception("CreatCompletion disconnected")
                     with anyio.move_on_after(1, shield=True):
                         logger.exception(
@@ -344,15 +544,20 @@ async def v2_chat(
             recv_chan, data_sender_callable=partial(event_publisher, send_chan)
         )
     else:
-        print(kwargs)
-        completion = LLM(**kwargs)
-        # completion: llama_cpp.ChatCompletion = await run_in_guarded_threadpool(LLM, **kwargs)  # type: ignore
+        logger.info(f"Received chat request ({priority.name})")
+        job = submit_job(
+            kwargs, priority=priority, stream=False, cache_prefix=cache_prefix
+        )
+        try:
+            completion = await wait_for_job(job, request)
+        except JobCancelledError:
+            raise HTTPException(status_code=499, detail="Client disconnected")
         logger.info(
             f"\n~~~~~ Generated completion: ~~~~~\n{completion['choices'][0]['text']}"
         )
-        completion = _convert_completion(completion)
-        zero_temp_cache.put(kwargs["prompt"], completion)
-        return completion
+        if cache_key is not None:
+            await response_cache.put(cache_key, completion)
+        return _convert_completion(completion)
 
 
 class NumTokensRequest(BaseModel):
@@ -365,7 +570,19 @@ class NumTokensResponse(BaseModel):
 
 @app.post("/v1/tokens", response_model=NumTokensResponse)
 async def num_tokens(inp: NumTokensRequest):
-    return {"num_tokens": len(LLM.tokenize(inp.prompt.encode()))}
+    return {"num_tokens": len(VOCAB.tokenize(inp.prompt.encode()))}
+
+
+@app.get("/v1/scheduler/stats", response_model=SchedulerStats)
+async def scheduler_stats():
+    return SCHEDULER.stats()
+
+
+@app.get("/v1/cache/stats", response_model=ResponseCacheStats)
+async def response_cache_stats():
+    if response_cache is None:
+        raise HTTPException(status_code=404, detail="The response cache is disabled")
+    return response_cache.stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+import llama_cpp
+import numpy as np
+from pydantic import BaseModel
+
+
+def _key(tokens: np.ndarray) -> str:
+    return hashlib.sha256(tokens.astype(np.int32).tobytes()).hexdigest()
+
+
+def common_prefix_length(a: np.ndarray, b: np.ndarray) -> int:
+    n = min(len(a), len(b))
+    mismatches = np.flatnonzero(a[:n] != b[:n])
+    return int(mismatches[0]) if len(mismatches) else n
+
+
+def state_nbytes(state: llama_cpp.LlamaState) -> int:
+    n = state.llama_state_size
+    for name in ("input_ids", "scores"):
+        if (arr := getattr(state, name, None)) is not None:
+            n += arr.nbytes
+    return n
+
+
+class PrefixCacheStats(BaseModel):
+    entries: int
+    size_bytes: int
+    capacity_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    prefill_tokens_saved: int
+
+
+class PrefixCache:
+    """Byte-bounded LRU of model states, each snapshotted right after a prompt prefix
+    and keyed by the hash of that prefix's tokens.
+
+    Callers pass in the part of the prompt that might be shared with other requests
+    (the system prompt). There's no marker for where the static clone preamble ends,
+    so the cache figures it out: a new prefix is only worth snapshotting once a recent
+    request has shared at least `min_prefix_tokens` of it. For clone prompts, that
+    common part is the name, descriptions and example dialogues, and it stops where
+    the per-turn facts and memories start.
+
+    Thread-safe, so a single cache can be shared by every replica.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int,
+        min_prefix_tokens: int = 64,
+        history_size: int = 64,
+    ):
+        self.capacity_bytes = capacity_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._lock = threading.Lock()
+        self._states: OrderedDict[str, tuple[int, llama_cpp.LlamaState, int]] = (
+            OrderedDict()
+        )
+        # number of cached states per prefix length, so lookups only hash those lengths
+        self._lengths: dict[int, int] = {}
+        self._history: deque[np.ndarray] = deque(maxlen=history_size)
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._tokens_saved = 0
+
+    def lookup(self, tokens: np.ndarray) -> tuple[int, llama_cpp.LlamaState] | None:
+        """Returns the state for the longest cached prefix of `tokens`."""
+        with self._lock:
+            for n in sorted(self._lengths, reverse=True):
+                if n > len(tokens):
+                    continue
+                key = _key(tokens[:n])
+                if (item := self._states.get(key)) is not None:
+                    self._states.move_to_end(key)
+                    self._hits += 1
+                    self._tokens_saved += n
+                    return n, item[1]
+            self._misses += 1
+            return None
+
+    def shared_prefix_length(self, tokens: np.ndarray) -> int:
+        """Length of the longest prefix shared with a recent request, or 0 if that is
+        too short to be worth caching. Also remembers `tokens` for future requests."""
+        with self._lock:
+            n = max((common_prefix_length(tokens, x) for x in self._history), default=0)
+            self._history.append(tokens)
+        return n if n >= self.min_prefix_tokens else 0
+
+    def put(self, tokens: np.ndarray, state: llama_cpp.LlamaState):
+        nbytes = state_nbytes(state)
+        if nbytes > self.capacity_bytes:
+            return
+        key = _key(tokens)
+        with self._lock:
+            if key in self._states:
+                self._states.move_to_end(key)
+                return
+            while self._states and self._size + nbytes > self.capacity_bytes:
+                _, (n, _, size) = self._states.popitem(last=False)
+                self._remove_length(n)
+                self._size -= size
+                self._evictions += 1
+            self._states[key] = (len(tokens), state, nbytes)
+            self._lengths[len(tokens)] = self._lengths.get(len(tokens), 0) + 1
+            self._size += nbytes
+
+    def _remove_length(self, n: int):
+        self._lengths[n] -= 1
+        if not self._lengths[n]:
+            del self._lengths[n]
+
+    def stats(self) -> PrefixCacheStats:
+        with self._lock:
+            return PrefixCacheStats(
+                entries=len(self._states),
+                size_bytes=self._size,
+                capacity_bytes=self.capacity_bytes,
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                prefill_tokens_saved=self._tokens_saved,
+            )
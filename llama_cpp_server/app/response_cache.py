@@ -0,0 +1,320 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import anyio
+from loguru import logger
+from pydantic import BaseModel
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+def response_cache_key(params: dict[str, Any]) -> str:
+    """Everything that decides a zero temperature completion: the model, the prompt
+    and the sampling params (including any logit bias or regex)."""
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def completion_chunks(completion: dict) -> list[dict]:
+    """A cached completion, as the chunks a streamed one would have produced. The
+    whole text goes out as one chunk, along with the finish reason."""
+    choice = completion["choices"][0]
+    return [
+        {
+            "id": completion["id"],
+            "object": "text_completion",
+            "created": completion["created"],
+            "model": completion["model"],
+            "choices": [
+                {
+                    "text": choice["text"],
+                    "index": 0,
+                    "logprobs": None,
+                    "finish_reason": choice["finish_reason"],
+                }
+            ],
+        }
+    ]
+
+
+class TierStats(BaseModel):
+    name: str
+    entries: Optional[int]
+    size_bytes: Optional[int]
+    capacity_bytes: Optional[int]
+    hits: int
+    misses: int
+    evictions: int
+
+
+class ResponseCacheStats(BaseModel):
+    hits: int
+    misses: int
+    hit_ratio: Optional[float]
+    tiers: list[TierStats]
+
+
+class CacheTier:
+    """One level of the response cache. Values are the serialized completions."""
+
+    name: str = "tier"
+
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def put(self, key: str, value: bytes):
+        raise NotImplementedError
+
+    def _record(self, value: Optional[bytes]) -> Optional[bytes]:
+        if value is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return value
+
+    def stats(self) -> TierStats:
+        return TierStats(
+            name=self.name,
+            entries=None,
+            size_bytes=None,
+            capacity_bytes=None,
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+        )
+
+
+class MemoryTier(CacheTier):
+    """In-process LRU, bounded both by number of entries and by bytes."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, capacity_bytes: int):
+        super().__init__()
+        self.max_entries = max_entries
+        self.capacity_bytes = capacity_bytes
+        self._lock = threading.Lock()
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if (value := self._data.get(key)) is not None:
+                self._data.move_to_end(key)
+            return self._record(value)
+
+    async def put(self, key: str, value: bytes):
+        if len(value) > self.capacity_bytes:
+            return
+        with self._lock:
+            if (old := self._data.pop(key, None)) is not None:
+                self._size -= len(old)
+            while self._data and (
+                len(self._data) >= self.max_entries
+                or self._size + len(value) > self.capacity_bytes
+            ):
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+                self._evictions += 1
+            self._data[key] = value
+            self._size += len(value)
+
+    def stats(self) -> TierStats:
+        with self._lock:
+            return TierStats(
+                name=self.name,
+                entries=len(self._data),
+                size_bytes=self._size,
+                capacity_bytes=self.capacity_bytes,
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+            )
+
+
+class SqliteTier(CacheTier):
+    """On disk LRU in a sqlite file, bounded by bytes. Survives restarts, and is
+    shared by every server process pointed at the same file."""
+
+    name = "disk"
+
+    def __init__(self, path: str, capacity_bytes: int):
+        super().__init__()
+        self.path = path
+        self.capacity_bytes = capacity_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+                "ON responses (accessed_at)"
+            )
+            # running total of the value sizes, kept in the same transactions as the
+            # rows so that every process sharing the file agrees on it
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage "
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO usage "
+                "SELECT 0, COALESCE(SUM(size), 0) FROM responses"
+            )
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return row[0]
+
+    def _put(self, key: str, value: bytes):
+        if len(value) > self.capacity_bytes:
+            return
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            delta = len(value) - (row[0] if row else 0)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            size = self._add_size(delta)
+            while size > self.capacity_bytes:
+                # least recently used first, in batches
+                rows = self._conn.execute(
+                    "SELECT key, size FROM responses WHERE key != ? "
+                    "ORDER BY accessed_at LIMIT 64",
+                    (key,),
+                ).fetchall()
+                if not rows:
+                    break
+                for evicted, n in rows:
+                    if size <= self.capacity_bytes:
+                        break
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key = ?", (evicted,)
+                    )
+                    size = self._add_size(-n)
+                    self._evictions += 1
+
+    def _add_size(self, delta: int) -> int:
+        self._conn.execute("UPDATE usage SET size = size + ? WHERE id = 0", (delta,))
+        return self._conn.execute("SELECT size FROM usage WHERE id = 0").fetchone()[0]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._record(await anyio.to_thread.run_sync(self._get, key))
+
+    async def put(self, key: str, value: bytes):
+        await anyio.to_thread.run_sync(self._put, key, value)
+
+    def stats(self) -> TierStats:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM responses), size FROM usage WHERE id = 0"
+            ).fetchone()
+        return TierStats(
+            name=self.name,
+            entries=entries,
+            size_bytes=size,
+            capacity_bytes=self.capacity_bytes,
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+        )
+
+
+class RedisTier(CacheTier):
+    """Shared by every replica and server that talks to the same redis. Entries
+    expire after ttl_seconds, and the memory bound is redis' own maxmemory policy,
+    so only hits and misses are tracked here."""
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl_seconds: int, prefix: str = "llama:response:"):
+        super().__init__()
+        if aioredis is None:
+            raise ImportError("The redis response cache tier needs `pip install redis`")
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._client = aioredis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._record(await self._client.get(self.prefix + key))
+
+    async def put(self, key: str, value: bytes):
+        await self._client.set(self.prefix + key, value, ex=self.ttl_seconds)
+
+
+class ResponseCache:
+    """Zero temperature completions, looked up through a list of tiers, fastest first.
+
+    A hit in a slower tier is copied into the faster ones before it's returned, and
+    new completions are written to every tier. A tier that errors out (say redis is
+    down) is treated as a miss, the cache is never worth failing a request over.
+    """
+
+    def __init__(self, tiers: list[CacheTier]):
+        self.tiers = tiers
+        self._hits = 0
+        self._misses = 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = await tier.get(key)
+            except Exception as e:
+                logger.warning(f"Response cache {tier.name} get failed: {e}")
+                continue
+            if value is not None:
+                self._hits += 1
+                for faster in self.tiers[:i]:
+                    await self._put(faster, key, value)
+                return json.loads(value)
+        self._misses += 1
+        return None
+
+    async def put(self, key: str, completion: dict):
+        value = json.dumps(completion).encode()
+        for tier in self.tiers:
+            await self._put(tier, key, value)
+
+    async def _put(self, tier: CacheTier, key: str, value: bytes):
+        try:
+            await tier.put(key, value)
+        except Exception as e:
+            logger.warning(f"Response cache {tier.name} put failed: {e}")
+
+    def stats(self) -> ResponseCacheStats:
+        total = self._hits + self._misses
+        return ResponseCacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            hit_ratio=self._hits / total if total else None,
+            tiers=[tier.stats() for tier in self.tiers],
+        )
@@ -0,0 +1,265 @@
+import asyncio
+import enum
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import llama_cpp
+import numpy as np
+from loguru import logger
+from pydantic import BaseModel
+
+from app.prefix_cache import PrefixCache, PrefixCacheStats, common_prefix_length
+
+# how many of the most recent jobs the wait time and tokens/sec stats are computed over
+STATS_WINDOW = 1000
+
+
+class Priority(enum.IntEnum):
+    """Lower value runs first. Chat turns block a user, memory rating happens
+    after every message, and summarization is offline-ish work."""
+
+    chat = 0
+    memory = 1
+    summarize = 2
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+_DONE = object()
+
+
+@dataclass
+class Job:
+    priority: Priority
+    kwargs: dict[str, Any]
+    stream: bool
+    loop: asyncio.AbstractEventLoop
+    # the part of the prompt that may be shared with other requests, see PrefixCache
+    cache_prefix: str | None = None
+    outputs: asyncio.Queue = field(default_factory=asyncio.Queue)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+    def cancel(self):
+        """Drops the job if it's still queued, or stops generation at the next token."""
+        self.cancelled.set()
+
+    def _put(self, item):
+        # called from the worker thread
+        self.loop.call_soon_threadsafe(self.outputs.put_nowait, item)
+
+    async def _get(self):
+        item = await self.outputs.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    async def result(self) -> dict:
+        return await self._get()
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        while (item := await self._get()) is not _DONE:
+            yield item
+
+
+class SchedulerStats(BaseModel):
+    num_replicas: int
+    queue_depth: dict[str, int]
+    running: int
+    completed: int
+    cancelled: int
+    failed: int
+    wait_time_p50: float | None
+    wait_time_p95: float | None
+    tokens_per_second: float | None
+    prefix_cache: PrefixCacheStats | None
+
+
+class Scheduler:
+    """Owns the llama.cpp models and runs every request against them.
+
+    A llama.cpp model is not thread-safe and can only evaluate one sequence at a time,
+    so each replica gets a single worker thread that pulls jobs off a shared priority
+    queue. With more than one replica (each holding its own copy of the model), jobs
+    go to whichever replica frees up first; llama.cpp releases the GIL during eval so
+    the replicas really do run in parallel. Nothing outside of this class touches the
+    models (the endpoints tokenize with a separate vocab only copy), so replicas can
+    be swapped for separate processes without changing the endpoints.
+    """
+
+    def __init__(
+        self,
+        replicas: list[llama_cpp.Llama],
+        max_queue_size: int = 256,
+        prefix_cache: PrefixCache | None = None,
+    ):
+        self.replicas = replicas
+        self.max_queue_size = max_queue_size
+        self.prefix_cache = prefix_cache
+        # entries are (priority, seq, job), seq keeps FIFO order within a priority
+        self._queue: queue.PriorityQueue[
+            tuple[int, int, Job | None]
+        ] = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._depth = {p: 0 for p in Priority}
+        self._running = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._failed = 0
+        self._wait_times: deque[float] = deque(maxlen=STATS_WINDOW)
+        self._throughput: deque[tuple[int, float]] = deque(maxlen=STATS_WINDOW)
+
+    def start(self):
+        for i, model in enumerate(self.replicas):
+            t = threading.Thread(
+                target=self._worker,
+                args=(model,),
+                name=f"llama-worker-{i}",
+                daemon=True,
+            )
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        # sorts after every job, so the workers drain the queue first
+        for _ in self._threads:
+            self._queue.put_nowait((len(Priority), next(self._seq), None))
+        for t in self._threads:
+            t.join()
+        self._threads.clear()
+
+    def submit(
+        self,
+        kwargs: dict[str, Any],
+        priority: Priority,
+        stream: bool,
+        cache_prefix: str | None = None,
+    ) -> Job:
+        with self._lock:
+            if sum(self._depth.values()) >= self.max_queue_size:
+                raise QueueFullError(
+                    f"Scheduler queue is full ({self.max_queue_size} requests)."
+                )
+            self._depth[priority] += 1
+        job = Job(
+            priority=priority,
+            kwargs=kwargs,
+            stream=stream,
+            loop=asyncio.get_running_loop(),
+            cache_prefix=cache_prefix,
+        )
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return job
+
+    def stats(self) -> SchedulerStats:
+        with self._lock:
+            wait_times = list(self._wait_times)
+            throughput = list(self._throughput)
+            depth = {p.name: n for p, n in self._depth.items()}
+            running = self._running
+            completed, cancelled, failed = (
+                self._completed,
+                self._cancelled,
+                self._failed,
+            )
+        p50 = p95 = tok_per_sec = None
+        if wait_times:
+            p50, p95 = (float(x) for x in np.percentile(wait_times, [50, 95]))
+        if throughput and (duration := sum(d for _, d in throughput)) > 0:
+            tok_per_sec = sum(n for n, _ in throughput) / duration
+        return SchedulerStats(
+            num_replicas=len(self.replicas),
+            queue_depth=depth,
+            running=running,
+            completed=completed,
+            cancelled=cancelled,
+            failed=failed,
+            wait_time_p50=p50,
+            wait_time_p95=p95,
+            tokens_per_second=tok_per_sec,
+            prefix_cache=self.prefix_cache.stats() if self.prefix_cache else None,
+        )
+
+    def _worker(self, model: llama_cpp.Llama):
+        while (job := self._queue.get()[2]) is not None:
+            with self._lock:
+                self._depth[job.priority] -= 1
+            if job.cancelled.is_set():
+                with self._lock:
+                    self._cancelled += 1
+                job._put(JobCancelledError())
+                continue
+            start = time.perf_counter()
+            with self._lock:
+                self._wait_times.append(start - job.enqueued_at)
+                self._running += 1
+            try:
+                num_tokens = self._run(model, job)
+            except Exception as e:
+                logger.exception(e)
+                with self._lock:
+                    self._failed += 1
+                job._put(e)
+            else:
+                with self._lock:
+                    self._throughput.append((num_tokens, time.perf_counter() - start))
+                    if job.cancelled.is_set():
+                        self._cancelled += 1
+                    else:
+                        self._completed += 1
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def _prefill_from_cache(self, model: llama_cpp.Llama, job: Job):
+        """Restores (or snapshots) the model state for the shared part of the prompt.
+        The completion call then only has to evaluate the rest, since llama.cpp skips
+        whatever prefix of the prompt is already in the context."""
+        assert self.prefix_cache is not None and job.cache_prefix is not None
+        # same leading space that Llama.create_completion adds before tokenizing
+        prompt = np.array(model.tokenize(b" " + job.kwargs["prompt"].encode("utf-8")))
+        prefix = np.array(model.tokenize(b" " + job.cache_prefix.encode("utf-8")))
+        # tokens can merge across the boundary, so only trust what the two agree on
+        prefix = prompt[: common_prefix_length(prompt, prefix)]
+
+        if (hit := self.prefix_cache.lookup(prefix)) is not None:
+            _, state = hit
+            model.load_state(state)
+        elif n := self.prefix_cache.shared_prefix_length(prefix):
+            model.reset()
+            model.eval(prefix[:n].tolist())
+            self.prefix_cache.put(prefix[:n], model.save_state())
+
+    def _run(self, model: llama_cpp.Llama, job: Job) -> int:
+        if self.prefix_cache is not None and job.cache_prefix:
+            self._prefill_from_cache(model, job)
+        # checked after every sampled token, so a client disconnect frees up the model
+        stopping_criteria = llama_cpp.StoppingCriteriaList(
+            [lambda input_ids, logits: job.cancelled.is_set()]
+        )
+        kwargs = dict(
+            job.kwargs, stream=job.stream, stopping_criteria=stopping_criteria
+        )
+        if not job.stream:
+            completion = model(**kwargs)
+            job._put(completion)
+            return completion["usage"]["completion_tokens"]
+        num_tokens = 0
+        for chunk in model(**kwargs):
+            num_tokens += 1
+            job._put(chunk)
+        job._put(_DONE)
+        return num_tokens
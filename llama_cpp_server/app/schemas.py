@@ -137,6 +137,16 @@ class CreateChatCompletionRequest(BaseModel):
     top_k: int = top_k_field
     repeat_penalty: float = repeat_penalty_field
 
+    # server specific parameters
+    priority: Literal["chat", "memory", "summarize"] = Field(
+        default="chat",
+        description="Scheduling priority. Queued chat requests run before memory requests, which run before summarization.",
+    )
+    regex: Optional[str] = Field(
+        default=None,
+        description="Constrain the completion to fully match this regex (the regular subset of the syntax, see clonr.utils.fsm).",
+    )
+
     class Config:
         schema_extra = {
             "example": {
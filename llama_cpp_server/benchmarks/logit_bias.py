@@ -0,0 +1,112 @@
+"""Tokens/sec of the logit bias processor, against the old pure python one.
+
+Run from the llama_cpp_server directory:
+
+    python -m benchmarks.logit_bias --num-tokens 2000
+    python -m benchmarks.logit_bias --model /models/llama-2-7b.Q4_K_M.gguf --num-tokens 64
+
+Without --model, only the processors are timed, on random logits over a llama sized
+vocab. That is the per token overhead they add on top of the model. With --model,
+the same bias (a memory rating style +100 on the digits) is used for real
+completions, which shows how much of the end to end rate it was eating.
+"""
+import argparse
+import time
+from typing import Callable
+
+import llama_cpp
+import numpy as np
+
+from app.logit_bias import LogitBiasCache
+
+
+def make_legacy_processor(logit_bias: dict[str, float]) -> Callable:
+    # what make_logit_bias_processor used to build, for input_ids
+    to_bias = {int(k): v for k, v in logit_bias.items()}
+
+    def logit_bias_processor(input_ids: list[int], scores: list[float]) -> list[float]:
+        new_scores = [None] * len(scores)
+        for input_id, score in enumerate(scores):
+            new_scores[input_id] = score + to_bias.get(input_id, 0.0)
+        return new_scores
+
+    return logit_bias_processor
+
+
+class Vocab:
+    """Stands in for the model when only timing the processors."""
+
+    def __init__(self, n_vocab: int):
+        self._n_vocab = n_vocab
+
+    def n_vocab(self) -> int:
+        return self._n_vocab
+
+
+def bench_processors(args: argparse.Namespace, logit_bias: dict[str, float]):
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(16, args.n_vocab)).astype(np.single)
+    cache = LogitBiasCache()
+    processors = {
+        "legacy": make_legacy_processor(logit_bias),
+        "numpy": cache.processor(Vocab(args.n_vocab), logit_bias),  # type: ignore
+    }
+    expected = make_legacy_processor(logit_bias)([], logits[0].copy())
+    for name, fn in processors.items():
+        # llama_cpp assigns the result back into its logits buffer, same as here
+        buf = logits[0].copy()
+        buf[:] = fn([], buf)
+        assert np.allclose(buf, expected), name
+        start = time.perf_counter()
+        for i in range(args.num_tokens):
+            buf = logits[i % len(logits)].copy()
+            buf[:] = fn([], buf)
+        total = time.perf_counter() - start
+        print(
+            f"{name:<8} {args.num_tokens / total:12.0f} tokens/s  "
+            f"{1e6 * total / args.num_tokens:9.1f} us/token"
+        )
+
+
+def bench_model(args: argparse.Namespace, logit_bias: dict[str, float]):
+    llama = llama_cpp.Llama(
+        model_path=args.model, n_ctx=512, n_gpu_layers=args.n_gpu_layers, verbose=False
+    )
+    cache = LogitBiasCache()
+    processors = {
+        "none": None,
+        "legacy": make_legacy_processor(logit_bias),
+        "numpy": cache.processor(llama, logit_bias),
+    }
+    prompt = "USER: Rate this memory from 0 to 9.\nASSISTANT:"
+    for name, fn in processors.items():
+        lp = llama_cpp.LogitsProcessorList([fn]) if fn is not None else None
+        start = time.perf_counter()
+        r = llama.create_completion(
+            prompt,
+            max_tokens=args.num_tokens,
+            temperature=0,
+            logits_processor=lp,
+        )
+        total = time.perf_counter() - start
+        n = r["usage"]["completion_tokens"]
+        print(f"{name:<8} {n / total:12.1f} tokens/s  ({n} tokens)")
+
+
+def main(args: argparse.Namespace):
+    # the llama-2 digit tokens, as in MemoryRating.get_constraints
+    logit_bias = {str(29900 + i): 100.0 for i in range(10)}
+    print(f"n_vocab={args.n_vocab} num_tokens={args.num_tokens}")
+    bench_processors(args, logit_bias)
+    if args.model:
+        print(f"\nend to end, {args.model}")
+        bench_model(args, logit_bias)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--n-vocab", type=int, default=32_000)
+    parser.add_argument("--num-tokens", type=int, default=2000)
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    main(parser.parse_args())
@@ -1,4 +1,4 @@
 # model=../../../llm-models/open-llama-7b-instruct/open-llama-7B-open-instruct.ggmlv3.q5_K_M.bin python -m app.main
 # model=../../../llm-models/WizardLM-1.0-Uncensored-Llama2-13B-GGML/wizardlm-1.0-uncensored-llama2-13b.ggmlv3.q5_K_M.bin python -m app.main
 # model=./wizard-uncensored-llama2-13b.ggmlv3.q5_K_M.bin python -m app.main
-model=./luna-ai-llama2-uncensored.ggmlv3.q5_1.bin python -m app.main
\ No newline at end of file
+PYTHONPATH=../backend model=./luna-ai-llama2-uncensored.ggmlv3.q5_1.bin python -m app.main
\ No newline at end of file
@@ -0,0 +1,78 @@
+import types
+
+import numpy as np
+
+from app.prefix_cache import PrefixCache, common_prefix_length
+
+tokens = np.arange(100, 120)
+
+
+def state(nbytes: int):
+    return types.SimpleNamespace(llama_state_size=nbytes)
+
+
+def test_common_prefix_length():
+    assert common_prefix_length(tokens, tokens[:5]) == 5
+    assert common_prefix_length(tokens, np.array([100, 101, 7])) == 2
+    assert common_prefix_length(tokens, np.array([7])) == 0
+
+
+def test_lookup_longest_prefix():
+    cache = PrefixCache(capacity_bytes=100)
+    short, long = state(1), state(1)
+    cache.put(tokens[:3], short)
+    cache.put(tokens[:8], long)
+    cache.put(np.arange(10), state(1))
+
+    assert cache.lookup(tokens) == (8, long)
+    assert cache.lookup(tokens[:6]) == (3, short)
+    assert cache.lookup(tokens[:2]) is None
+    assert cache.lookup(tokens[1:]) is None
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.prefill_tokens_saved) == (2, 2, 11)
+
+
+def test_byte_bounded_eviction():
+    cache = PrefixCache(capacity_bytes=10)
+    cache.put(tokens[:3], state(4))
+    cache.put(tokens[:4], state(4))
+    # touching the first one makes the second the least recently used
+    assert cache.lookup(tokens[:3]) is not None
+    cache.put(tokens[:5], state(4))
+
+    assert cache.lookup(tokens[:4])[0] == 3
+    assert cache._lengths == {3: 1, 5: 1}
+    stats = cache.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (2, 8, 1)
+
+
+def test_lengths_count_entries():
+    cache = PrefixCache(capacity_bytes=8)
+    cache.put(tokens[:3], state(4))
+    cache.put(np.arange(3), state(4))
+    # same prefix again is only moved to the end, not counted twice
+    cache.put(tokens[:3], state(4))
+    assert cache._lengths == {3: 2}
+    assert cache.stats().size_bytes == 8
+
+    cache.put(tokens[:6], state(4))
+    assert cache._lengths == {3: 1, 6: 1}
+    cache.put(tokens[:7], state(8))
+    assert cache._lengths == {7: 1}
+    assert cache.stats().evictions == 3
+
+
+def test_oversized_state_is_skipped():
+    cache = PrefixCache(capacity_bytes=10)
+    cache.put(tokens[:3], state(4))
+    cache.put(tokens[:5], state(11))
+    assert cache._lengths == {3: 1}
+    stats = cache.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (1, 4, 0)
+
+
+def test_shared_prefix_length():
+    cache = PrefixCache(capacity_bytes=10, min_prefix_tokens=4)
+    assert cache.shared_prefix_length(tokens) == 0
+    assert cache.shared_prefix_length(tokens[:3]) == 0
+    assert cache.shared_prefix_length(np.concatenate([tokens[:6], [1, 2]])) == 6
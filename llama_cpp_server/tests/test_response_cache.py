@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import types
+
+import pytest
+
+from app import response_cache
+from app.response_cache import CacheTier, MemoryTier, ResponseCache, SqliteTier
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # strictly increasing access times, so the LRU order never ties
+    ticks = itertools.count()
+    monkeypatch.setattr(
+        response_cache, "time", types.SimpleNamespace(time=lambda: next(ticks))
+    )
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_memory_tier_max_entries_lru():
+    tier = MemoryTier(max_entries=2, capacity_bytes=100)
+    run(tier.put("a", b"1"))
+    run(tier.put("b", b"2"))
+    assert run(tier.get("a")) == b"1"
+    run(tier.put("c", b"3"))
+    assert run(tier.get("b")) is None
+    assert run(tier.get("a")) == b"1"
+    stats = tier.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (2, 2, 1)
+    assert (stats.hits, stats.misses) == (2, 1)
+
+
+def test_memory_tier_capacity_bytes():
+    tier = MemoryTier(max_entries=10, capacity_bytes=10)
+    run(tier.put("a", b"x" * 6))
+    run(tier.put("a", b"x" * 4))
+    assert tier.stats().size_bytes == 4
+    run(tier.put("b", b"x" * 6))
+    run(tier.put("c", b"x" * 3))
+    assert run(tier.get("a")) is None
+    assert tier.stats().size_bytes == 9
+    # too big for the tier at all, and doesn't evict anything
+    run(tier.put("d", b"x" * 11))
+    stats = tier.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (2, 9, 1)
+
+
+def test_sqlite_tier_shares_usage(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = SqliteTier(path, capacity_bytes=100)
+    second = SqliteTier(path, capacity_bytes=100)
+    run(first.put("a", b"x" * 4))
+    run(second.put("b", b"x" * 6))
+    run(second.put("a", b"x" * 10))
+    for tier in [first, second, SqliteTier(path, capacity_bytes=100)]:
+        stats = tier.stats()
+        assert (stats.entries, stats.size_bytes) == (2, 16)
+    assert run(first.get("a")) == b"x" * 10
+
+
+def test_sqlite_tier_evicts_least_recently_used(tmp_path):
+    tier = SqliteTier(str(tmp_path / "cache.db"), capacity_bytes=10)
+    run(tier.put("a", b"x" * 4))
+    run(tier.put("b", b"x" * 4))
+    assert run(tier.get("a")) is not None
+    run(tier.put("c", b"x" * 4))
+    assert run(tier.get("b")) is None
+    assert run(tier.get("a")) is not None
+    stats = tier.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (2, 8, 1)
+
+
+def test_sqlite_tier_evicts_across_batches(tmp_path):
+    tier = SqliteTier(str(tmp_path / "cache.db"), capacity_bytes=100)
+    for i in range(100):
+        run(tier.put(str(i), b"x"))
+    run(tier.put("big", b"x" * 80))
+    stats = tier.stats()
+    assert (stats.entries, stats.size_bytes, stats.evictions) == (21, 100, 80)
+    assert run(tier.get("79")) is None
+    assert run(tier.get("80")) == b"x"
+    assert run(tier.get("big")) == b"x" * 80
+
+
+class FailingTier(CacheTier):
+    name = "failing"
+
+    async def get(self, key):
+        raise ConnectionError("down")
+
+    async def put(self, key, value):
+        raise ConnectionError("down")
+
+
+def test_response_cache_promotes_hits(tmp_path):
+    memory = MemoryTier(max_entries=10, capacity_bytes=1000)
+    disk = SqliteTier(str(tmp_path / "cache.db"), capacity_bytes=1000)
+    cache = ResponseCache([memory, FailingTier(), disk])
+    run(disk.put("k", b'{"id": "x"}'))
+
+    assert run(cache.get("k")) == {"id": "x"}
+    assert run(memory.get("k")) == b'{"id": "x"}'
+    assert run(cache.get("k")) == {"id": "x"}
+    assert run(cache.get("missing")) is None
+    stats = cache.stats()
+    assert (stats.hits, stats.misses) == (2, 1)
+    assert [t.hits for t in stats.tiers] == [2, 0, 1]
+
+
+def test_response_cache_put_writes_every_tier(tmp_path):
+    memory = MemoryTier(max_entries=10, capacity_bytes=1000)
+    disk = SqliteTier(str(tmp_path / "cache.db"), capacity_bytes=1000)
+    run(ResponseCache([memory, FailingTier(), disk]).put("k", {"id": "x"}))
+    assert run(memory.get("k")) == run(disk.get("k")) == b'{"id": "x"}'